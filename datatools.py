@@ -11,22 +11,25 @@ import re
 import sys
 import subprocess
 import tempfile
-from math import sqrt
+import zlib
+from array import array
+from math import ceil, sqrt
 from pprint import pprint
 
-# Library available from http://code.google.com/p/python-graph/
-from pygraph.classes.digraph import digraph
-# http://www.nltk.org/download
-import nltk
+# NumPy (http://www.numpy.org/), python-graph (http://code.google.com/p/python-graph/) and nltk (http://www.nltk.org/download) are slow
+# to import and each only needed by one or two of the functions below, so they are imported in the functions that use them
 
 # Local files
 from lib.browser import WMTBrowser
 from lib.database import WMTDatabase
 from lib.dataparsers import filter_tube_train
-from lib.geo import convertWGS84toOSGB36, LatLongToOSGrid
+from lib.geo import convertOSEastingNorthingtoWGS84, convertWGS84toOSEastingNorthingBatch, convertWGS84toOSGB36Batch, LatLongToOSGridBatch, LONDON_TRANSFORM_BOUNDS, LONDON_TRANSFORM_ORIGIN
 from lib.listutils import unique_values
 from lib.locations import RailStationLocations
-from lib.models import TubeTrain, RailStation
+from lib.models import BusStop, TubeTrain, RailStation
+from lib.network import NO_NODE, NetworkGraph, is_direct_path, save_network
+from lib.stringutils import cleanup_name_from_undesirables, normalise_placename
+from lib.textparser import save_tagger
 from whensmytrain import get_line_code, LINE_NAMES
 
 
@@ -92,6 +95,7 @@ def import_bus_csv_to_db():
     export_sql_to_db("./db/whensmybus.geodata.db", sql)
     # Drop SSV file now we don't need it
     os.unlink(outputpath)
+    export_precomputed_names_to_db("whensmybus", BusStop, ('clean_name', 'normalised_name'))
     print "...done"
 
 def import_dlr_xml_to_db():
@@ -131,6 +135,7 @@ def import_dlr_xml_to_db():
 
     rows = [[station[fieldname.split(' ')[0]] for fieldname in fieldnames] for station in stations.values()]
     export_rows_to_db("./db/whensmytrain.geodata.db", "locations", fieldnames, rows)
+    export_precomputed_names_to_db("whensmytrain", RailStation, ('abbreviated_name',))
     print "...done"
 
 def import_tube_xml_to_db():
@@ -201,12 +206,64 @@ def import_tube_xml_to_db():
                 rows.append(field_data)
 
     export_rows_to_db("./db/whensmytrain.geodata.db", "locations", fieldnames, rows, ('name', 'line'), delete_existing=True)
+    export_precomputed_names_to_db("whensmytrain", RailStation, ('abbreviated_name',))
+    print "...done"
+
+
+def import_gazetteer_to_db(cluster_radius=1000):
+    """
+    Utility script that builds a gazetteer of placenames, for geocoding users' requests without using a remote geocoder, and saves it
+    in the bus database ./db/whensmybus.geodata.db
+
+    Names come from the bus stops in ./sourcedata/bus-routes.csv and the stations in ./sourcedata/tube-locations.kml. Places with
+    the same name are grouped together if they are within cluster_radius metres of each other (e.g. stops on either side of the
+    road), and each group is saved as the (latitude, longitude) of its centre. Names used in more than one part of London (e.g.
+    "High Street") end up with a row for each part
+    """
+    print "Importing gazetteer into database..."
+    positions = {}
+    reader = csv.DictReader(open('./sourcedata/bus-routes.csv'))
+    for line in reader:
+        if not line or not line.get('Run', '') or line['Virtual_Bus_Stop'] == '1':
+            continue
+        name = normalise_placename(cleanup_name_from_undesirables(line['Stop_Name'], ('<>', '#', r'\[DLR\]', '>T<')))
+        positions.setdefault(name, set()).add((int(line['Location_Easting']), int(line['Location_Northing'])))
+    for station in parse_stations_from_kml().values():
+        for name in (station['name'], station['name'] + ' Station'):
+            positions.setdefault(normalise_placename(name), set()).add((int(station['location_easting']), int(station['location_northing'])))
+
+    rows = []
+    for (name, name_positions) in sorted(positions.items()):
+        if not name:
+            continue
+        # Each cluster is a list of positions, the first of which is used as the cluster's anchor
+        clusters = []
+        for (easting, northing) in sorted(name_positions):
+            for cluster in clusters:
+                if (cluster[0][0] - easting) ** 2 + (cluster[0][1] - northing) ** 2 <= cluster_radius ** 2:
+                    cluster.append((easting, northing))
+                    break
+            else:
+                clusters.append([(easting, northing)])
+        for cluster in clusters:
+            easting = float(sum([position[0] for position in cluster])) / len(cluster)
+            northing = float(sum([position[1] for position in cluster])) / len(cluster)
+            (latitude, longitude) = convertOSEastingNorthingtoWGS84(easting, northing)
+            rows.append((name, round(latitude, 6), round(longitude, 6)))
+
+    database = WMTDatabase("whensmybus.geodata.db")
+    database.write_query("DROP TABLE IF EXISTS gazetteer")
+    database.write_query("CREATE TABLE gazetteer (name, latitude REAL, longitude REAL)")
+    database.write_queries("INSERT INTO gazetteer VALUES (?, ?, ?)", rows)
+    database.write_query("CREATE INDEX gazetteer_name_index ON gazetteer (name)")
+    print "%s places imported" % len(rows)
     print "...done"
 
 
 def import_network_data_to_graph():
     """
-    Import data from a file describing the edges of the Tube network and turn it into a graph object which we pickle and save
+    Import data from a file describing the edges of the Tube network and turn it into graph objects which we save in our compact
+    network format
     """
     print "Importing Tube & DLR network data into graph..."
     database = WMTDatabase("whensmytrain.geodata.db")
@@ -268,15 +325,89 @@ def import_network_data_to_graph():
         graphs[get_line_code(line)] = create_graph_from_dict(this_line_only, database, interchanges_by_foot)
     graphs['All'] = create_graph_from_dict(stations_neighbours, database, interchanges_by_foot)
 
-    pickle.dump(graphs, open("./db/whensmytrain.network.gr", "w"))
+    network_graphs = dict([(line_code, create_network_graph_from_digraph(graph)) for (line_code, graph) in graphs.items()])
+    save_network(network_graphs, 'whensmytrain.network.dat')
+    print "...done"
+    export_graphs_to_route_tables(network_graphs)
+    export_fastest_lines()
+
+
+def export_graphs_to_route_tables(graphs):
+    """
+    Precompute the shortest route between every pair of stations for each of the graphs produced by import_network_data_to_graph(), so that
+    routes can be looked up while serving a Tweet rather than searched for
+    """
+    print "Precomputing routes between all stations..."
+    tables = {}
+    for (line_code, graph) in graphs.items():
+        tables[line_code] = create_route_table_from_graph(graph)
+    pickle.dump(tables, open("./db/whensmytrain.routes.obj", "wb"), pickle.HIGHEST_PROTOCOL)
+    print "...done"
+
+
+def export_fastest_lines():
+    """
+    Work out the fastest line going directly between every pair of stations, so that when a user doesn't specify a line, we can look up
+    which one to use rather than work it out. Must be run after the route tables have been produced
+    """
+    print "Precomputing fastest lines between all stations..."
+    geodata = RailStationLocations()
+    geodata.fastest_lines = {}
+    names = sorted(set([name for stations in geodata.station_lines.values() for (name, _line_code) in stations]))
+    destinations = [geodata.find_exact_match({'name': name}) for name in names]
+    fastest_lines = {}
+    for code in geodata.station_lines.keys():
+        origin = RailStation(code=code)
+        fastest_lines[code] = {}
+        for destination in destinations:
+            lines = geodata.get_lines_serving(origin, destination)
+            if lines:
+                fastest_lines[code][destination.name] = lines[0]
+    pickle.dump(fastest_lines, open("./db/whensmytrain.lines.obj", "wb"), pickle.HIGHEST_PROTOCOL)
     print "...done"
 
 
+def fit_london_grid_transform(samples=121):
+    """
+    Fit the cubic polynomials used by lib.geo.convertWGS84toOSEastingNorthingFast() to a grid of samples x samples points across the area
+    it covers, using least squares, and print out the Python to paste into lib/geo.py, along with the worst error found on random points
+    """
+    import numpy
+    ((min_lat, max_lat), (min_lon, max_lon)) = LONDON_TRANSFORM_BOUNDS
+    (origin_lat, origin_lon) = LONDON_TRANSFORM_ORIGIN
+    # Terms are (power of latitude, power of longitude), in the order that lib.geo expects them
+    terms = [(i, j) for i in range(0, 4) for j in range(0, 4 - i)]
+
+    def get_eastings_and_northings(lats, lons):
+        """
+        Return arrays of the exact (unrounded) eastings & northings, and a matrix of polynomial terms, for arrays lats & lons
+        """
+        (new_lats, new_lons, _ignore) = convertWGS84toOSGB36Batch(lats, lons)
+        (eastings, northings) = LatLongToOSGridBatch(new_lats, new_lons, rounded=False)
+        matrix = numpy.array([(lats - origin_lat) ** i * (lons - origin_lon) ** j for (i, j) in terms]).T
+        return (eastings, northings, matrix)
+
+    (lats, lons) = numpy.meshgrid(numpy.linspace(min_lat, max_lat, samples), numpy.linspace(min_lon, max_lon, samples))
+    (eastings, northings, matrix) = get_eastings_and_northings(lats.ravel(), lons.ravel())
+    easting_coefficients = numpy.linalg.lstsq(matrix, eastings, rcond=None)[0]
+    northing_coefficients = numpy.linalg.lstsq(matrix, northings, rcond=None)[0]
+
+    random_state = numpy.random.RandomState(0)
+    (eastings, northings, matrix) = get_eastings_and_northings(random_state.uniform(min_lat, max_lat, 100000),
+                                                               random_state.uniform(min_lon, max_lon, 100000))
+    print "# Worst error found: %0.3f m easting, %0.3f m northing" % (numpy.fabs(matrix.dot(easting_coefficients) - eastings).max(),
+                                                                     numpy.fabs(matrix.dot(northing_coefficients) - northings).max())
+    for (name, coefficients) in (('LONDON_TRANSFORM_EASTING', easting_coefficients), ('LONDON_TRANSFORM_NORTHING', northing_coefficients)):
+        print "%s = (%s)" % (name, ', '.join([repr(float(coefficient)) for coefficient in coefficients]))
+
+
 def parse_stations_from_kml(filter_function=lambda a, b: True):
     """
     Parses KML file of stations & associated data, and returns them as a dictionary
     """
-    stations = {}
+    import numpy
+    names = []
+    positions = []
     kml = WMTBrowser().fetch_xml_tree('file:///%s/sourcedata/tube-locations.kml' % os.getcwd())
     for station in kml.findall('.//Placemark'):
         name = station.find('name').text.strip().replace(' Station', '')
@@ -284,10 +415,16 @@ def parse_stations_from_kml(filter_function=lambda a, b: True):
         if filter_function(name, style):
             coordinates = station.find('Point/coordinates').text
             (lon, lat) = tuple([float(c) for c in coordinates.split(',')[0:2]])
-            (lat, lon) = convertWGS84toOSGB36(lat, lon)[:2]
-            (easting, northing) = LatLongToOSGrid(lat, lon)
-            stations[name.lower()] = {'name': name, 'location_easting': str(easting), 'location_northing': str(northing),
-                                      'code': '', 'lines': '', 'inner': '', 'outer': ''}
+            names.append(name)
+            positions.append((lat, lon))
+
+    # Convert all the stations' positions in one go
+    (eastings, northings) = convertWGS84toOSEastingNorthingBatch(numpy.array([lat for (lat, lon) in positions]),
+                                                                 numpy.array([lon for (lat, lon) in positions]))
+    stations = {}
+    for (name, easting, northing) in zip(names, eastings, northings):
+        stations[name.lower()] = {'name': name, 'location_easting': str(easting), 'location_northing': str(northing),
+                                  'code': '', 'lines': '', 'inner': '', 'outer': ''}
     return stations
 
 
@@ -302,13 +439,39 @@ def export_rows_to_db(db_filename, tablename, fieldnames, rows, indices=(), dele
         for index in indices:
             sql += "CREATE INDEX %s_index ON %s (%s);\r\n" % (index, tablename, index)
 
+    # Name the columns, as the table may have more columns than these (e.g. those added by export_precomputed_names_to_db())
+    column_names = [fieldname.split(' ')[0] for fieldname in fieldnames]
     for field_data in rows:
-        sql += "insert into locations values "
+        sql += "insert into %s (%s) values " % (tablename, ", ".join(column_names))
         sql += "(\"%s\");\r\n" % '", "'.join(field_data)
 
     export_sql_to_db(db_filename, sql)
 
 
+def export_precomputed_names_to_db(instance_name, location_class, column_names):
+    """
+    Work out the versions of each location's name that the models would otherwise have to work out with regular expressions every
+    time they are used (e.g. 'clean_name', which is what BusStop.get_clean_name() returns), and store them in columns of the same name
+    in the locations table of the geodata database for instance_name. location_class is the model to work them out with
+    """
+    database = WMTDatabase("%s.geodata.db" % instance_name)
+    existing_column_names = [row['name'] for row in database.get_rows("PRAGMA table_info(locations)")]
+    for column_name in column_names:
+        if column_name not in existing_column_names:
+            database.write_query("ALTER TABLE locations ADD COLUMN %s" % column_name)
+
+    # Many locations share the same name (e.g. a stop served by several bus routes), so only work out each name's versions once
+    precomputed_names = {}
+    rows = []
+    for (rowid, name) in database.get_rows("SELECT rowid, name FROM locations"):
+        if name not in precomputed_names:
+            location = location_class(name)
+            precomputed_names[name] = [getattr(location, 'get_%s' % column_name)() for column_name in column_names]
+        rows.append(precomputed_names[name] + [rowid])
+    assignments = ", ".join(["%s=?" % column_name for column_name in column_names])
+    database.write_queries("UPDATE locations SET %s WHERE rowid=?" % assignments, rows)
+
+
 def export_sql_to_db(db_filename, sql):
     """
     Generic database SQL export function
@@ -329,6 +492,7 @@ def create_graph_from_dict(stations, database, interchanges_by_foot):
     #
     # If the station needs to have directional info handled (e.g. the line is splitting, or looping on itself), we have one node for each
     # direction on each line that needs to be split. Else the direction is an empty string and so both directions are handled by the same node
+    from pygraph.classes.digraph import digraph
     graph = digraph()
 
     for (station, station_data) in stations.items():
@@ -399,6 +563,95 @@ def create_graph_from_dict(stations, database, interchanges_by_foot):
     return graph
 
 
+def create_network_graph_from_digraph(graph):
+    """
+    Take a digraph object and return a lib.network.NetworkGraph with the same nodes and edges
+    """
+    names = sorted(graph.nodes())
+    node_ids = dict([(node, i) for (i, node) in enumerate(names)])
+    offsets = array('I', [0])
+    targets = array('H')
+    weights = array('d')
+    for node in names:
+        for neighbour in graph.neighbors(node):
+            targets.append(node_ids[neighbour])
+            weights.append(graph.edge_weight((node, neighbour)))
+        offsets.append(len(targets))
+    return NetworkGraph(names, offsets, targets, weights)
+
+
+def create_route_table_from_graph(graph):
+    """
+    Take a lib.network.NetworkGraph object and return a dictionary of the arguments needed to construct a lib.network.RouteTable for it
+
+    For each station, we run a single-source shortest path search from its entrance, and record the time taken to the exit of every
+    other station, and the predecessor of each node in the shortest path tree. Nodes are referred to by their index in a sorted list
+
+    We also record what we need to tell quickly whether a route is direct (see RouteTable.direct_route_exists()): for every pair of stations,
+    whether the shortest route between them is direct, and the first two nodes on it; and for every origin, the order in which a
+    depth-first walk of the shortest path tree reaches each node, and the number of nodes below each node
+    """
+    nodes = sorted(graph.names)
+    node_ids = dict([(node, i) for (i, node) in enumerate(nodes)])
+    node_stations = [node.partition(':')[0] for node in nodes]
+    stations = sorted([node.partition(':')[0] for node in nodes if node.endswith(':entrance')])
+
+    times = array('h')
+    predecessors = array('H')
+    direct_routes = array('B')
+    first_nodes = array('H')
+    second_nodes = array('H')
+    preorder = array('H')
+    subtree_sizes = array('H')
+    for station in stations:
+        (previous, distances) = graph.shortest_path("%s:entrance" % station)
+        times.extend([int(ceil(distances.get("%s:exit" % destination, -1))) for destination in stations])
+        tree = [node_ids[previous[node]] if previous.get(node) is not None else NO_NODE for node in nodes]
+        predecessors.extend(tree)
+
+        for destination in stations:
+            path_taken = []
+            if "%s:exit" % destination in distances:
+                node = node_ids["%s:exit" % destination]
+                while node != NO_NODE:
+                    path_taken.append(node)
+                    node = tree[node]
+                path_taken = path_taken[1:-1][::-1]
+            path_stations = [node_stations[node] for node in path_taken]
+            direct_routes.append(int(bool(path_stations) and is_direct_path(path_stations)))
+            first_nodes.append(path_taken[0] if path_taken else NO_NODE)
+            second_nodes.append(path_taken[1] if len(path_taken) > 1 else NO_NODE)
+
+        # Number the nodes in the order a depth-first walk of the tree reaches them, so that one node is on the shortest path to
+        # another if and only if the other's number is between the first's and the last number in the first's subtree. We store the
+        # size of each subtree rather than the last number in it, as it is mostly zero and so compresses much better
+        children = [[] for _node in nodes]
+        for (node, predecessor) in enumerate(tree):
+            if predecessor != NO_NODE:
+                children[predecessor].append(node)
+        order = [NO_NODE] * len(nodes)
+        sizes = [NO_NODE] * len(nodes)
+        counter = 0
+        stack = [(node_ids["%s:entrance" % station], False)]
+        while stack:
+            (node, finished) = stack.pop()
+            if finished:
+                sizes[node] = counter - 1 - order[node]
+                continue
+            order[node] = counter
+            counter += 1
+            stack.append((node, True))
+            stack += [(child, False) for child in children[node]]
+        preorder.extend(order)
+        subtree_sizes.extend(sizes)
+
+    # Predecessor tables in particular are very repetitive, so compress them to keep the file small
+    compress = lambda values: zlib.compress(values.tostring(), 9)
+    return {'nodes': nodes, 'stations': stations, 'times': compress(times), 'predecessors': compress(predecessors),
+            'direct_routes': compress(direct_routes), 'first_nodes': compress(first_nodes), 'second_nodes': compress(second_nodes),
+            'preorder': compress(preorder), 'subtree_sizes': compress(subtree_sizes)}
+
+
 def scrape_odd_platform_directions(write_file=False):
     """
     Check Tfl Tube API for Underground platforms that are not designated with a *-bound direction, and (optionally)
@@ -473,6 +726,7 @@ def import_tube_xml_to_text_corpus():
     """
     Creates a corpus of text data for our parser to understand requests with
     """
+    import nltk
     print "Creating corpus of data for Tube station & line parser"
     tokenizer = nltk.tokenize.regexp.WhitespaceTokenizer()
     line_phrases = [tokenizer.tokenize(line_name.lower()) for (_line_code, line_name) in LINE_NAMES.keys()]
@@ -510,6 +764,13 @@ def import_tube_xml_to_text_corpus():
     unigram_tagger = nltk.UnigramTagger(unigram_tokens, backoff=regex_tagger)
     bigram_tagger = nltk.BigramTagger(bigram_tokens, backoff=unigram_tagger)
     pickle.dump(bigram_tagger, open("./db/whensmytrain.tagger.obj", "w"))
+
+    # The bot itself uses a WMTBigramTagger, which does the same job from flat lookup tables without needing nltk. nltk's taggers only
+    # keep the contexts their backoff would get wrong, so the tables are small. We keep the pickled tagger above to test it against
+    #pylint: disable=W0212
+    bigrams = dict([((context and context[0] or '', word), tag) for ((context, word), tag) in bigram_tagger._context_to_tag.items()])
+    unigrams = dict(unigram_tagger._context_to_tag.items())
+    save_tagger(bigrams, unigrams, tagging_regexes, 'whensmytrain.tagger.dat')
     print "...done"
 
 def scrape_tfl_destination_codes():
@@ -544,10 +805,7 @@ def check_tfl_destination_codes():
 
     rows = database.get_rows("SELECT destination_name, destination_code, line_code FROM destination_codes")
     for (destination_name, destination_code, line_code) in rows:
-        # Hack: Fake a ElementTree object to use the XML parser's tube train filter function
-        fake_tag = lambda x: 1
-        fake_tag.attrib = {'Destination': destination_name, 'DestCode': str(destination_code)}
-        if not filter_tube_train(fake_tag):
+        if not filter_tube_train({'Destination': destination_name, 'DestCode': str(destination_code)}):
             continue
         train = TubeTrain(destination_name, "Northbound", "1200", "C", "001")
         destination = train.get_destination_no_via()
@@ -562,6 +820,7 @@ if __name__ == "__main__":
     import_bus_csv_to_db()
     import_tube_xml_to_db()
     import_dlr_xml_to_db()
+    import_gazetteer_to_db()
     import_network_data_to_graph()
     #scrape_odd_platform_designations()
     import_tube_xml_to_text_corpus()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#pylint: disable=C0103
+"""
+In-memory caching utilities for WhensMyTransport
+"""
+from collections import OrderedDict
+import threading
+
+
+class LRUCache():
+    """
+    A dictionary-like cache of bounded size. When full, adding a new item evicts the least recently used one
+    """
+    def __init__(self, maximum_size=128):
+        self.maximum_size = maximum_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        # Pop and reinsert the item so it becomes the most recently used
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            del self.data[key]
+        if self.maximum_size <= 0:
+            return
+        if len(self.data) >= self.maximum_size:
+            self.data.popitem(last=False)
+        self.data[key] = value
+
+    def get(self, key, default=None):
+        """
+        Return the value for key if it is in the cache (counting it as a hit), else default (counting it as a miss)
+        """
+        if key in self.data:
+            self.hits += 1
+            return self[key]
+        else:
+            self.misses += 1
+            return default
+
+    def clear(self):
+        """
+        Empty the cache
+        """
+        self.data.clear()
+
+
+class lazy_property(object):
+    """
+    Decorator that turns a method taking no arguments into an attribute whose value is only worked out the first time it is used,
+    e.g. for data files that are expensive to load but not needed for every request
+
+    The value is then stored on the instance, replacing the decorator, so later lookups cost nothing. A lock makes sure the method
+    is only called once, even if several threads use the attribute at the same time
+    """
+    def __init__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with self.lock:
+            if self.__name__ not in instance.__dict__:
+                instance.__dict__[self.__name__] = self.function(instance)
+        return instance.__dict__[self.__name__]
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Clock handling for When's My Transport
+"""
+from datetime import datetime
+from time import localtime
+
+
+class WMTClock():
+    """
+    Class representing a snapshot of the time, taken once per request, so that every departure in a reply is worked out against the
+    same time, and we only ask the system for the time once
+
+    Times of departures are given in minutes past midnight. Those before the start of the service day (an hour before the start of
+    the current hour) are taken to be tomorrow's
+    """
+    #pylint: disable=R0903
+    def __init__(self, now=None, is_dst=None):
+        """
+        Take a snapshot of the time now. For testing & benchmarks, now (a datetime) and is_dst (whether British Summer Time is in
+        operation) can be given to freeze the clock at that time
+        """
+        self.now = now or datetime.now()
+        self.is_dst = bool(localtime().tm_isdst if is_dst is None else is_dst)
+        self.minutes = self.now.hour * 60 + self.now.minute
+        self.service_day_start = max(self.now.hour - 1, 0) * 60
@@ -29,6 +29,13 @@ class WMTDatabase():
         self.cursor.execute(sql, args)
         self.db_connection.commit()
 
+    def write_queries(self, sql, rows):
+        """
+        Performs the same insert or update query on the database for each of the tuples of args in rows, in one transaction
+        """
+        self.cursor.executemany(sql, rows)
+        self.db_connection.commit()
+
     def get_rows(self, sql, args=()):
         """
         Returns a list of sqlite3.Row objects, representing all the rows from the query's results
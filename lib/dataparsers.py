@@ -4,18 +4,21 @@ Data parsers for Whens My Transport?
 """
 import logging
 import re
-from datetime import datetime, timedelta
+from datetime import datetime
+from xml.parsers import expat
 
+from lib.clock import WMTClock
 from lib.exceptions import WhensMyTransportException
-from lib.models import TubeTrain, Bus, DLRTrain, DepartureCollection
-from lib.stringutils import capwords, gmt_to_localtime
+from lib.models import TubeTrain, Bus, DLRTrain, DepartureCollection, MINUTES_IN_A_DAY
+from lib.stringutils import capwords, gmt_to_local_minutes
 
 
-def parse_bus_data(bus_data, route_number):
+def parse_bus_data(bus_data, route_number, clock=None):
     """
-    Take a parsed JSON object bus_data from a single bus stop and a specified route_number
+    Take a parsed JSON object bus_data from a single bus stop and a specified route_number, and optionally the WMTClock for the request
     Returns a list of Bus objects for that bus stop and route
     """
+    clock = clock or WMTClock()
     arrivals = bus_data.get('arrivals', [])
 
     # Handle TfL's JSON-encoded error message
@@ -31,15 +34,18 @@ def parse_bus_data(bus_data, route_number):
     for a in relevant_arrivals[:3]:
         logging.debug("Found bus %s going to %s at %s" % (a['routeName'], a['destination'], a['scheduledTime']))
 
-    relevant_buses = [Bus(a['destination'], gmt_to_localtime(a['scheduledTime'])) for a in relevant_arrivals[:3]]
+    relevant_buses = [Bus(a['destination'], gmt_to_local_minutes(a['scheduledTime'], clock.is_dst), clock=clock)
+                      for a in relevant_arrivals[:3]]
     return relevant_buses
 
 
-def parse_dlr_data(dlr_data, station):
+def parse_dlr_data(dlr_data, station, clock=None):
     """
-    Takes a parsed XML elementTree dlr_data and the RailStation object for the station whose departures we are querying
+    Takes a parsed XML elementTree dlr_data and the RailStation object for the station whose departures we are querying, and
+    optionally the WMTClock for the request
     Returns a DepartureCollection object of all departures from the station in question, classified by platform
     """
+    clock = clock or WMTClock()
     train_info_regex = re.compile(r"[1-4] (\D+)(([0-9]+) mins?)?", flags=re.I)
     platforms_to_ignore = [('tog', 'P1'),
                            ('wiq', 'P1')]
@@ -61,6 +67,7 @@ def parse_dlr_data(dlr_data, station):
         info = platform.find("div[@id='platformmiddle']")
         publication_time = info.find("div[@id='time']").text.strip()
         publication_time = datetime.strptime(publication_time, "%H:%M")
+        publication_minutes = publication_time.hour * 60 + publication_time.minute
         line1 = info.find("div[@id='line1']")
         line2 = info.find("div[@id='line23']/p")
         line3 = info.find("div[@id='line23']/p/br")
@@ -73,10 +80,10 @@ def parse_dlr_data(dlr_data, station):
                 destination = capwords(result.group(1).strip())
                 if destination == 'Terminates Here':
                     continue
-                departure_delta = timedelta(minutes=(result.group(3) and int(result.group(3)) or 0))
-                departure_time = datetime.strftime(publication_time + departure_delta, "%H%M")
-                trains_by_platform.add_to_slot(platform_name, DLRTrain(destination, departure_time))
-                logging.debug("Found a train going to %s at %s", destination, departure_time)
+                departure_time = (publication_minutes + (result.group(3) and int(result.group(3)) or 0)) % MINUTES_IN_A_DAY
+                train_obj = DLRTrain(destination, departure_time, clock)
+                trains_by_platform.add_to_slot(platform_name, train_obj)
+                logging.debug("Found a train going to %s at %s", destination, train_obj.get_departure_time())
             else:
                 logging.debug("Error - could not parse this line: %s", train)
 
@@ -90,64 +97,132 @@ def parse_dlr_data(dlr_data, station):
     return trains_by_platform
 
 
-def parse_tube_data(tube_data, station, line_code):
+def parse_tube_data(tube_data, station, line_code, clock=None):
     """
-    Takes a parsed XML elementTree tube_data, the RailStation object for the station whose departures we are querying,
-    and a string representing the one-character code for the line we want trains for
+    Takes a string tube_data of the XML TrackerNet gives us for a station, the RailStation object for the station whose departures we
+    are querying, and a string representing the one-character code for the line we want trains for, and optionally the WMTClock for
+    the request
 
     Returns a DepartureCollection object of all departures from the station in question, classified by direction
     """
-    # Go through each platform and get data about every train arriving, including which direction it's headed
-    trains_by_direction = DepartureCollection()
-    publication_time = tube_data.find('WhenCreated').text
-    publication_time = datetime.strptime(publication_time, "%d %b %Y %H:%M:%S")
-    for platform in tube_data.findall('.//P'):
-        platform_name = platform.attrib['N']
-        direction = re.search("(North|East|South|West)bound", platform_name, re.I)
-        rail = re.search("(Inner|Outer) Rail", platform_name, re.I)
-
-        # Most stations tell us whether they are -bound in a certain direction
-        if direction:
-            direction = capwords(direction.group(0))
-        # Some Circle/Central Line platforms called "Inner" and "Outer" Rail, which make no sense to customers, so I've manually
-        # entered Inner and Outer attributes in the object (taken from the database) in the attribute circular_directions,
-        # which translate from these into North/South/East/West
-        elif rail:
-            direction = station.circular_directions[rail.group(1).lower()] + 'bound'
-        else:
-            # Some odd cases. Chesham and Chalfont & Latimer don't say anything at all for the platforms on the Chesham branch of the Met Line
-            if station.code == "CHM":
-                direction = "Southbound"
-            elif station.code == "CLF" and platform.attrib['Num'] == '3':
-                direction = "Northbound"
-            else:
-                # The following stations will have "issues" with bidrectional platforms: North Acton, Edgware Road, Loughton, White City
-                # These are dealt with by analysing the location of the destination by the calling WhensMyTrain object
-                direction = "Unknown"
-                logging.debug("Have encountered a platform without direction specified (%s)", platform_name)
-
-        # Use the filter function to filter out trains that are out of service, specials or National Rail first
-        platform_trains = platform.findall("T[@LN='%s']" % line_code)
-        platform_trains = [train for train in platform_trains if filter_tube_train(train)]
-        for train in platform_trains:
-            # Create a TubeTrain object
-            destination = train.attrib['Destination']
-            departure_delta = timedelta(seconds=int(train.attrib['SecondsTo']))
-            departure_time = datetime.strftime(publication_time + departure_delta, "%H%M")
-            set_number = train.attrib['SetNo']
-            train_obj = TubeTrain(destination, direction, departure_time, line_code, set_number)
-            trains_by_direction.add_to_slot(direction, train_obj)
-
-    return trains_by_direction
-
-
-def filter_tube_train(train_tag):
+    return WMTTrackerNetParser(station, line_code, clock).parse(tube_data)
+
+
+class WMTTrackerNetParser():
+    """
+    Streaming parser for TrackerNet's PredictionDetailed XML. Rather than building a tree of the whole document, which for a big
+    interchange has trains for several lines, it goes through it once, element by element, and only makes TubeTrains for the trains on
+    our line that we are interested in, filing them by the direction of the platform they are due at
+    """
+    def __init__(self, station, line_code, clock=None):
+        self.station = station
+        self.line_code = line_code
+        self.clock = clock or WMTClock()
+        self.trains_by_direction = DepartureCollection()
+        # Where we are in the document: the tags of the elements we are inside, and the attributes of the platform we are on
+        self.open_tags = []
+        self.platform = None
+        # The direction of the platform we are on, only worked out if it has a train we are interested in
+        self.direction = None
+        self.publication_time = ''
+        self.publication_seconds = None
+
+    def parse(self, tube_data):
+        """
+        Parse the XML string tube_data, and return a DepartureCollection of the trains in it
+        """
+        parser = expat.ParserCreate()
+        # TrackerNet's data is all ASCII, so give us plain strings, as ElementTree does
+        parser.returns_unicode = False
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        try:
+            parser.Parse(tube_data, True)
+        # If the XML parser is choking, probably a 503 Error message in HTML
+        except expat.ExpatError, exc:
+            logging.error("%s encountered when parsing TrackerNet data - likely not XML!", exc)
+            raise WhensMyTransportException('tfl_server_down')
+        # A TypeError means a train came before the time the data was published, and a ValueError a time we could not read
+        except (TypeError, ValueError), exc:
+            logging.error("%s (%s) encountered when parsing TrackerNet data - not in the format we expect", exc.__class__.__name__, exc)
+            raise WhensMyTransportException('tfl_server_down')
+        return self.trains_by_direction
+
+    def start_element(self, tag, attributes):
+        """
+        Handle the start of an element with name tag and dictionary of attributes
+        """
+        if tag == 'P':
+            self.platform = attributes
+            self.direction = None
+        # Only trains for our line, directly on a platform, and that aren't out of service, specials or National Rail are any use to us
+        elif tag == 'T' and self.open_tags[-1:] == ['P'] and attributes.get('LN') == self.line_code and filter_tube_train(attributes):
+            if self.direction is None:
+                self.direction = get_tube_platform_direction(self.platform, self.station)
+            departure_time = (self.publication_seconds + int(attributes['SecondsTo'])) // 60 % MINUTES_IN_A_DAY
+            train = TubeTrain(attributes['Destination'], self.direction, departure_time, self.line_code, attributes['SetNo'], self.clock)
+            self.trains_by_direction.add_to_slot(self.direction, train)
+        self.open_tags.append(tag)
+
+    def end_element(self, tag):
+        """
+        Handle the end of an element with name tag
+        """
+        self.open_tags.pop()
+        if tag == 'WhenCreated' and self.publication_seconds is None:
+            publication_time = datetime.strptime(self.publication_time.strip(), "%d %b %Y %H:%M:%S")
+            self.publication_seconds = publication_time.hour * 3600 + publication_time.minute * 60 + publication_time.second
+
+    def character_data(self, data):
+        """
+        Handle text inside an element. We only need that of the time the data was published, which may come in more than one piece
+        """
+        if self.open_tags[-1:] == ['WhenCreated'] and self.publication_seconds is None:
+            self.publication_time += data
+
+
+TUBE_DIRECTION_REGEX = re.compile("(North|East|South|West)bound", re.I)
+TUBE_RAIL_REGEX = re.compile("(Inner|Outer) Rail", re.I)
+
+
+def get_tube_platform_direction(platform_attributes, station):
+    """
+    Takes the dictionary of attributes of a platform from TrackerNet, and the RailStation object for the station it is at, and returns
+    the direction trains from that platform are going in, e.g. "Eastbound"
+    """
+    platform_name = platform_attributes['N']
+    direction = TUBE_DIRECTION_REGEX.search(platform_name)
+    # Most stations tell us whether they are -bound in a certain direction
+    if direction:
+        return capwords(direction.group(0))
+
+    # Some Circle/Central Line platforms called "Inner" and "Outer" Rail, which make no sense to customers, so I've manually
+    # entered Inner and Outer attributes in the object (taken from the database) in the attribute circular_directions,
+    # which translate from these into North/South/East/West
+    rail = TUBE_RAIL_REGEX.search(platform_name)
+    if rail:
+        return station.circular_directions[rail.group(1).lower()] + 'bound'
+
+    # Some odd cases. Chesham and Chalfont & Latimer don't say anything at all for the platforms on the Chesham branch of the Met Line
+    if station.code == "CHM":
+        return "Southbound"
+    elif station.code == "CLF" and platform_attributes['Num'] == '3':
+        return "Northbound"
+    # The following stations will have "issues" with bidrectional platforms: North Acton, Edgware Road, Loughton, White City
+    # These are dealt with by analysing the location of the destination by the calling WhensMyTrain object
+    logging.debug("Have encountered a platform without direction specified (%s)", platform_name)
+    return "Unknown"
+
+
+def filter_tube_train(train_attributes):
     """
-    XML tag filter function for whether to include trains, to get rid of misleading, out of service or downright bogus trains
+    Filter function for whether to include trains, given the dictionary of attributes of their XML tag, to get rid of misleading,
+    out of service or downright bogus trains
     """
-    destination = train_tag.attrib['Destination']
-    destination_code = train_tag.attrib['DestCode']
-    location = train_tag.attrib.get('Location', '')
+    destination = train_attributes['Destination']
+    destination_code = train_attributes['DestCode']
+    location = train_attributes.get('Location', '')
     # 341 & 342 are codes for Northumberland Park depot
     # 433 is code for Triangle sidings depot (only used at night?)
     # 546 and 749 appear to be codes for Out of Service http://wiki.opentfl.co.uk/TrackerNet_predictions_detailed
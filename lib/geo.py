@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 #pylint: disable=C0103,R0201,W0231,W0142,R0903,R0914,R0913
 """
-Geotools for WhensMyTransport. Include GeoCoders for Yahoo!, Bing and Google Maps, and functions
+Geotools for WhensMyTransport. Include GeoCoders for Yahoo!, Bing and Google Maps and our own gazetteer, and functions
 to convert between different co-ordinate systems
 """
+import logging
 import math
+import Queue
+import threading
+import time
 import urllib
 from pprint import pprint
 
+from lib.exceptions import WhensMyTransportException
+from lib.stringutils import normalise_placename
+
 # Geocoders Define the URL and how to parse the resulting JSON object
 
 class BaseGeocoder():
@@ -22,17 +29,27 @@ class BaseGeocoder():
         self.params = {}
         return
 
-    def get_query_url(self):
+    def get_query_url(self, params):
         """
-        Fetch a URL to fetch geodata
+        Fetch a URL to fetch geodata, given a dictionary of query parameters. These are passed in rather than set on self.params,
+        so that the same geocoder can safely be used from several threads at once
         """
-        for (key, value) in self.params.items():
+        params = dict(params)
+        for (key, value) in params.items():
             if isinstance(value, unicode):
-                self.params[key] = value.encode('utf-8')
+                params[key] = value.encode('utf-8')
 
-        query_url = self.url % urllib.urlencode(self.params)
+        query_url = self.url % urllib.urlencode(params)
         return query_url
 
+    def geocode(self, placename, browser):
+        """
+        Look up placename, fetching the geodata with browser (a WMTBrowser), and return list of matching place(s), each represented by
+        a (latitude, longitude) tuple. Raises a WhensMyTransportException if the geocoder cannot be reached
+        """
+        geodata = browser.fetch_json(self.get_geocode_url(placename), 'geocoder_server_down')
+        return self.parse_geodata(geodata)
+
 
 class BingGeocoder(BaseGeocoder):
     """
@@ -51,8 +68,7 @@ class BingGeocoder(BaseGeocoder):
         """
         Get URL to access API, given a search query
         """
-        self.params['query'] = placename + ', London'
-        return self.get_query_url()
+        return self.get_query_url(dict(self.params, query=placename + ', London'))
 
     def parse_geodata(self, obj):
         """
@@ -85,8 +101,7 @@ class YahooGeocoder(BaseGeocoder):
         """
         Get URL to access API, given a search query
         """
-        self.params['q'] = placename + ', London, UK'
-        return self.get_query_url()
+        return self.get_query_url(dict(self.params, q=placename + ', London, UK'))
 
     def parse_geodata(self, obj):
         """
@@ -121,8 +136,7 @@ class GoogleGeocoder(BaseGeocoder):
         """
         Get URL to access API, given a search query
         """
-        self.params['address'] = placename + ', London'
-        return self.get_query_url()
+        return self.get_query_url(dict(self.params, address=placename + ', London'))
 
     def parse_geodata(self, obj):
         """
@@ -137,6 +151,146 @@ class GoogleGeocoder(BaseGeocoder):
         return points
 
 
+class LocalGazetteerGeocoder(BaseGeocoder):
+    """
+    Geocoder that looks up places in our own gazetteer of bus stop and station names, built by datatools.import_gazetteer_to_db()
+    from the same data as our geodata databases. It needs no network, so should be tried before any of the geocoders above
+    """
+    def __init__(self, database):
+        """
+        Constructor - takes the WMTDatabase object holding the gazetteer table. If the gazetteer has not been built yet, then
+        this geocoder never finds anything
+        """
+        self.url = ''
+        self.params = {}
+        self.database = database
+        self.has_gazetteer = database.check_existence_of('sqlite_master', 'name', 'gazetteer')
+
+    def get_geocode_url(self, placename):
+        """
+        As there is no API to access, this just returns the normalised placename to look up in the gazetteer
+        """
+        return normalise_placename(placename)
+
+    def parse_geodata(self, obj):
+        """
+        Given a normalised placename, return list of matching place(s), each represented by a (latitude, longitude) tuple
+        """
+        if not self.has_gazetteer:
+            return []
+        rows = self.database.get_rows("SELECT latitude, longitude FROM gazetteer WHERE name = ?", (obj,))
+        return [(row['latitude'], row['longitude']) for row in rows]
+
+    def geocode(self, placename, browser=None):
+        """
+        Look up placename in the gazetteer and return list of matching place(s), each represented by a (latitude, longitude) tuple
+        """
+        return self.parse_geodata(self.get_geocode_url(placename))
+
+
+class RacingGeocoder(BaseGeocoder):
+    """
+    Geocoder that asks several other geocoders at once, and returns the first answer that has places in the UK, so we only have to
+    wait as long as the quickest geocoder. Slower answers are ignored. Keeps count of how often each geocoder wins and how long each
+    takes to answer
+    """
+    def __init__(self, geocoders, timeout=10):
+        """
+        Constructor - takes a list of geocoder objects to race, and the maximum number of seconds to wait for an answer
+        """
+        self.url = ''
+        self.params = {}
+        self.geocoders = geocoders
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.statistics = dict([(geocoder.__class__.__name__, {'requests': 0, 'wins': 0, 'total_time': 0.0}) for geocoder in geocoders])
+
+    def geocode(self, placename, browser):
+        """
+        Look up placename with all our geocoders at once, and return the first non-empty list of matching place(s) in the UK, each
+        represented by a (latitude, longitude) tuple. browser is not used, as a WMTBrowser is not safe to share between threads, so
+        each geocoder is given a browser of its own instead
+
+        Raises a WhensMyTransportException if none of the geocoders can be reached, or if we time out waiting for them
+
+        Lookups that lose the race, or are still going when we time out, are abandoned rather than cancelled: their threads run on
+        until their geocoders answer, and put their answers on a queue that nothing reads any more
+        """
+        # Each request has its own queue, so answers to an earlier request can never be taken for answers to this one
+        answers = Queue.Queue()
+        for geocoder in self.geocoders:
+            thread = threading.Thread(target=self.fetch_answer, args=(geocoder, placename, answers))
+            thread.daemon = True
+            thread.start()
+
+        deadline = time.time() + self.timeout
+        failures = 0
+        for _i in range(0, len(self.geocoders)):
+            try:
+                (name, points) = answers.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                logging.debug("Timed out waiting for geocoders to geocode %s", placename)
+                self.log_statistics()
+                raise WhensMyTransportException('geocoder_server_down')
+            if points is None:
+                failures += 1
+            elif points:
+                logging.debug("%s was first to geocode %s", name, placename)
+                with self.lock:
+                    self.statistics[name]['wins'] += 1
+                self.log_statistics()
+                return points
+
+        self.log_statistics()
+        if failures == len(self.geocoders):
+            raise WhensMyTransportException('geocoder_server_down')
+        return []
+
+    def fetch_answer(self, geocoder, placename, answers):
+        """
+        Look up placename with a single geocoder and put a tuple of its name and the places it finds in the UK (or None, if it
+        cannot be reached) on the answers queue, recording how long it took
+        """
+        from lib.browser import WMTBrowser
+        name = geocoder.__class__.__name__
+        start = time.time()
+        try:
+            points = [point for point in geocoder.geocode(placename, WMTBrowser()) if is_in_uk(*point)]
+        except WhensMyTransportException:
+            points = None
+        except Exception as exc:  # Geocoders can choke on unexpected JSON in many ways; treat it the same as the server being down
+            logging.error("%s (%s) encountered by %s, ignoring", exc.__class__.__name__, exc, name)
+            points = None
+        with self.lock:
+            self.statistics[name]['requests'] += 1
+            self.statistics[name]['total_time'] += time.time() - start
+        answers.put((name, points))
+
+    def get_win_rates(self):
+        """
+        Return a dictionary of the proportion of answered requests each geocoder has won, keyed by geocoder name
+        """
+        with self.lock:
+            return dict([(name, stats['requests'] and float(stats['wins']) / stats['requests'])
+                         for (name, stats) in self.statistics.items()])
+
+    def get_mean_latencies(self):
+        """
+        Return a dictionary of the average time in seconds each geocoder has taken to answer, keyed by geocoder name
+        """
+        with self.lock:
+            return dict([(name, stats['requests'] and stats['total_time'] / stats['requests'])
+                         for (name, stats) in self.statistics.items()])
+
+    def log_statistics(self):
+        """
+        Log how often each geocoder has won so far, and how long each takes to answer on average
+        """
+        (win_rates, latencies) = (self.get_win_rates(), self.get_mean_latencies())
+        for name in sorted(self.statistics.keys()):
+            logging.debug("%s has won %0.2f of its races, taking %0.2fs on average", name, win_rates[name], latencies[name])
+
+
 # Thanks go to Chris Veness, as this is basically
 # a translation of his JavaScript co-ordinate translation scripts
 # http://www.movable-type.co.uk/scripts/latlong-gridref.html
@@ -236,6 +390,19 @@ def gridrefNumToLet(e, n, digits=10):
     return gridRef
 
 
+# ellipse parameters
+ELLIPSES = { 'WGS84':    { 'a': 6378137.0,   'b': 6356752.3142, 'f': 1/298.257223563 },
+             'Airy1830': { 'a': 6377563.396, 'b': 6356256.910,  'f': 1/299.3249646   } }
+
+# helmert transform parameters
+HELMERT_TRANSFORMS = { 'WGS84toOSGB36': { 'tx': -446.448,  'ty':  125.157,   'tz': -542.060,   # m
+                                          'rx':   -0.1502, 'ry':   -0.2470,  'rz':   -0.8421,  # sec
+                                          's':    20.4894 },                               # ppm
+                       'OSGB36toWGS84': { 'tx':  446.448,  'ty': -125.157,   'tz':  542.060,
+                                          'rx':    0.1502, 'ry':    0.2470,  'rz':    0.8421,
+                                          's':   -20.4894 } }
+
+
 def convertWGS84toOSGB36(lat, lon, height=0):
     """
     Convert a latitude & longitude from WGS84 (used by GPS) and return a (latitude, longitude)
@@ -244,19 +411,7 @@ def convertWGS84toOSGB36(lat, lon, height=0):
     This allows us to convert from one model of the earth's spherality to another and make our
     geolocations *really* accurate
     """
-    # ellipse parameters
-    e = { 'WGS84':    { 'a': 6378137.0,   'b': 6356752.3142, 'f': 1/298.257223563 },
-              'Airy1830': { 'a': 6377563.396, 'b': 6356256.910,  'f': 1/299.3249646   } }
-
-    # helmert transform parameters
-    h = { 'WGS84toOSGB36': { 'tx': -446.448,  'ty':  125.157,   'tz': -542.060,   # m
-                               'rx':   -0.1502, 'ry':   -0.2470,  'rz':   -0.8421,  # sec
-                               's':    20.4894 },                               # ppm
-          'OSGB36toWGS84': { 'tx':  446.448,  'ty': -125.157,   'tz':  542.060,
-                               'rx':    0.1502, 'ry':    0.2470,  'rz':    0.8421,
-                               's':   -20.4894 } }
-
-    return convert(lat, lon, height, e['WGS84'], h['WGS84toOSGB36'], e['Airy1830'])
+    return convert(lat, lon, height, ELLIPSES['WGS84'], HELMERT_TRANSFORMS['WGS84toOSGB36'], ELLIPSES['Airy1830'])
 
 
 def convert(lat, lon, height, e1, t, e2):
@@ -330,6 +485,276 @@ def convertWGS84toOSEastingNorthing(latitude, longitude):
     return (easting, northing)
 
 
+def OSGridToLatLong(E, N):
+    """
+    Convert an OS grid reference, given as an easting & northing, to Geodesic co-ordinates, returned as a (latitude, longitude) tuple
+    """
+    a = 6377563.396
+    b = 6356256.910          # Airy 1830 major & minor semi-axes
+    F0 = 0.9996012717                         # NatGrid scale factor on central meridian
+    lat0 = math.radians(49)
+    lon0 = math.radians(-2)  # NatGrid true origin
+    N0 = -100000
+    E0 = 400000                 # northing & easting of true origin, metres
+    e2 = 1 - (b*b)/(a*a)                      # eccentricity squared
+    n = (a-b)/(a+b)
+    n2 = n*n
+    n3 = n*n*n
+
+    lat = lat0
+    M = 0
+    while True:
+        lat = (N-N0-M)/(a*F0) + lat
+
+        Ma = (1 + n + (5.0/4.0)*n2 + (5.0/4.0)*n3) * (lat-lat0)
+        Mb = (3*n + 3*n*n + (21.0/8.0)*n3) * math.sin(lat-lat0) * math.cos(lat+lat0)
+        Mc = ((15.0/8.0)*n2 + (15.0/8.0)*n3) * math.sin(2*(lat-lat0)) * math.cos(2*(lat+lat0))
+        Md = (35.0/24.0)*n3 * math.sin(3*(lat-lat0)) * math.cos(3*(lat+lat0))
+        M = b * F0 * (Ma - Mb + Mc - Md)              # meridional arc
+        if N-N0-M < 0.00001:  # ie until < 0.01mm
+            break
+
+    cosLat = math.cos(lat)
+    sinLat = math.sin(lat)
+    nu = a*F0/math.sqrt(1-e2*sinLat*sinLat)              # transverse radius of curvature
+    rho = a*F0*(1-e2)/math.pow(1-e2*sinLat*sinLat, 1.5)  # meridional radius of curvature
+    eta2 = nu/rho-1
+
+    tanLat = math.tan(lat)
+    tan2lat = tanLat*tanLat
+    tan4lat = tan2lat*tan2lat
+    tan6lat = tan4lat*tan2lat
+    secLat = 1/cosLat
+    nu3 = nu*nu*nu
+    nu5 = nu3*nu*nu
+    nu7 = nu5*nu*nu
+    VII = tanLat/(2*rho*nu)
+    VIII = tanLat/(24*rho*nu3)*(5+3*tan2lat+eta2-9*tan2lat*eta2)
+    IX = tanLat/(720*rho*nu5)*(61+90*tan2lat+45*tan4lat)
+    X = secLat/nu
+    XI = secLat/(6*nu3)*(nu/rho+2*tan2lat)
+    XII = secLat/(120*nu5)*(5+28*tan2lat+24*tan4lat)
+    XIIA = secLat/(5040*nu7)*(61+662*tan2lat+1320*tan4lat+720*tan6lat)
+
+    dE = E-E0
+    dE2 = dE*dE
+    dE3 = dE2*dE
+    dE4 = dE2*dE2
+    dE5 = dE3*dE2
+    dE6 = dE4*dE2
+    dE7 = dE5*dE2
+
+    lat = lat - VII*dE2 + VIII*dE4 - IX*dE6
+    lon = lon0 + X*dE - XI*dE3 + XII*dE5 - XIIA*dE7
+
+    return (math.degrees(lat), math.degrees(lon))
+
+
+def convertOSGB36toWGS84(lat, lon, height=0):
+    """
+    Convert a latitude & longitude from OSGB36 (used by OS maps) and return a (latitude, longitude) tuple of its equivalent in WGS84
+    (used by GPS)
+    """
+    return convert(lat, lon, height, ELLIPSES['Airy1830'], HELMERT_TRANSFORMS['OSGB36toWGS84'], ELLIPSES['WGS84'])
+
+
+def convertOSEastingNorthingtoWGS84(easting, northing):
+    """
+    Convert an OS (easting, northing) position, returns a WGS84 (latitude, longitude) tuple
+    """
+    (latitude, longitude) = OSGridToLatLong(easting, northing)
+    (new_latitude, new_longitude, _ignore) = convertOSGB36toWGS84(latitude, longitude)
+    return (new_latitude, new_longitude)
+
+
+# Batch versions of the above, which take NumPy arrays of co-ordinates and do the same sums on the whole array at once. These are many
+# times faster than calling the functions above on each point in turn, and give the same results to within a centimetre or so
+#
+# NumPy (http://www.numpy.org/) is only needed for these, and is slow to import, so it is imported when they are first called and never
+# at all by the bots themselves
+#
+def LatLongToOSGridBatch(lats, lons, rounded=True):
+    """
+    Convert NumPy arrays of Geodesic co-ordinates to OS grid references, returned as an (eastings, northings) tuple of integer arrays
+    (or arrays of floats, if rounded is False)
+    """
+    import numpy
+    lat = numpy.radians(lats)
+    lon = numpy.radians(lons)
+
+    a = 6377563.396
+    b = 6356256.910          # Airy 1830 major & minor semi-axes
+    F0 = 0.9996012717                         # NatGrid scale factor on central meridian
+    lat0 = math.radians(49)
+    lon0 = math.radians(-2)  # NatGrid true origin
+    N0 = -100000
+    E0 = 400000                 # northing & easting of true origin, metres
+    e2 = 1 - (b*b)/(a*a)                      # eccentricity squared
+    n = (a-b)/(a+b)
+    n2 = n*n
+    n3 = n*n*n
+
+    cosLat = numpy.cos(lat)
+    sinLat = numpy.sin(lat)
+    nu = a*F0/numpy.sqrt(1-e2*sinLat*sinLat)              # transverse radius of curvature
+    rho = a*F0*(1-e2)/numpy.power(1-e2*sinLat*sinLat, 1.5)  # meridional radius of curvature
+    eta2 = nu/rho-1
+
+    Ma = (1 + n + (5.0/4.0)*n2 + (5.0/4.0)*n3) * (lat-lat0)
+    Mb = (3*n + 3*n*n + (21.0/8.0)*n3) * numpy.sin(lat-lat0) * numpy.cos(lat+lat0)
+    Mc = ((15.0/8.0)*n2 + (15.0/8.0)*n3) * numpy.sin(2*(lat-lat0)) * numpy.cos(2*(lat+lat0))
+    Md = (35.0/24.0)*n3 * numpy.sin(3*(lat-lat0)) * numpy.cos(3*(lat+lat0))
+    M = b * F0 * (Ma - Mb + Mc - Md)              # meridional arc
+
+    cos3lat = cosLat*cosLat*cosLat
+    cos5lat = cos3lat*cosLat*cosLat
+    tan2lat = numpy.tan(lat)*numpy.tan(lat)
+    tan4lat = tan2lat*tan2lat
+
+    I = M + N0
+    II = (nu/2)*sinLat*cosLat
+    III = (nu/24)*sinLat*cos3lat*(5-tan2lat+9*eta2)
+    IIIA = (nu/720)*sinLat*cos5lat*(61-58*tan2lat+tan4lat)
+    IV = nu*cosLat
+    V = (nu/6)*cos3lat*(nu/rho-tan2lat)
+    VI = (nu/120) * cos5lat * (5 - 18*tan2lat + tan4lat + 14*eta2 - 58*tan2lat*eta2)
+
+    dLon = lon-lon0
+    dLon2 = dLon*dLon
+    dLon3 = dLon2*dLon
+    dLon4 = dLon3*dLon
+    dLon5 = dLon4*dLon
+    dLon6 = dLon5*dLon
+
+    N = I + II*dLon2 + III*dLon4 + IIIA*dLon6
+    E = E0 + IV*dLon + V*dLon3 + VI*dLon5
+
+    if not rounded:
+        return (E, N)
+    # Round halves away from zero, as round() does (NumPy's own rounding rounds them to the nearest even number)
+    return (numpy.floor(E + 0.5).astype(int), numpy.floor(N + 0.5).astype(int))
+
+
+def convertWGS84toOSGB36Batch(lats, lons, heights=0):
+    """
+    Convert NumPy arrays of latitudes & longitudes from WGS84 and return a (latitudes, longitudes, heights) tuple of arrays of
+    their equivalents in OSGB36
+    """
+    return convertBatch(lats, lons, heights, ELLIPSES['WGS84'], HELMERT_TRANSFORMS['WGS84toOSGB36'], ELLIPSES['Airy1830'])
+
+
+def convertBatch(lats, lons, heights, e1, t, e2):
+    """
+    General-purpose spheroid conversion function, for NumPy arrays of co-ordinates
+    """
+    import numpy
+    # -- convert polar to cartesian coordinates (using ellipse 1)
+    lat = numpy.radians(lats)
+    lon = numpy.radians(lons)
+
+    a = e1['a']
+    b = e1['b']
+
+    sinPhi = numpy.sin(lat)
+    cosPhi = numpy.cos(lat)
+    sinLambda = numpy.sin(lon)
+    cosLambda = numpy.cos(lon)
+    H = heights
+
+    eSq = (a*a - b*b) / (a*a)
+    nu = a / numpy.sqrt(1 - eSq*sinPhi*sinPhi)
+
+    x1 = (nu+H) * cosPhi * cosLambda
+    y1 = (nu+H) * cosPhi * sinLambda
+    z1 = ((1-eSq)*nu + H) * sinPhi
+    # -- apply helmert transform using appropriate params
+    tx = t['tx']
+    ty = t['ty']
+    tz = t['tz']
+    rx = t['rx']/3600 * math.pi/180
+    # normalise seconds to radians
+    ry = t['ry']/3600 * math.pi/180
+    rz = t['rz']/3600 * math.pi/180
+    s1 = t['s']/1e6 + 1 # normalise ppm to (s+1)
+
+    # apply transform
+    x2 = tx + x1*s1 - y1*rz + z1*ry
+    y2 = ty + x1*rz + y1*s1 - z1*rx
+    z2 = tz - x1*ry + y1*rx + z1*s1
+
+    # -- convert cartesian to polar coordinates (using ellipse 2)
+
+    a = e2['a']
+    b = e2['b']
+    precision = 4 / a
+
+    eSq = (a*a - b*b) / (a*a)
+    p = numpy.sqrt(x2*x2 + y2*y2)
+    phi = numpy.arctan2(z2, p*(1-eSq))
+    phiP = 2*math.pi
+    nu = a / numpy.sqrt(1 - eSq*numpy.sin(phi)*numpy.sin(phi))
+    # Keep iterating until every point has converged; those that converge early just become slightly more accurate
+    while numpy.any(numpy.fabs(phi-phiP) > precision):
+        nu = a / numpy.sqrt(1 - eSq*numpy.sin(phi)*numpy.sin(phi))
+        phiP = phi
+        phi = numpy.arctan2(z2 + eSq*nu*numpy.sin(phi), p)
+
+    Lambda = numpy.arctan2(y2, x2)
+    H = p/numpy.cos(phi) - nu
+
+    return (numpy.round(numpy.degrees(phi), 7), numpy.round(numpy.degrees(Lambda), 7), H)
+
+
+def convertWGS84toOSEastingNorthingBatch(lats, lons):
+    """
+    Convert NumPy arrays of WGS84 latitudes & longitudes, returns an (eastings, northings) tuple of integer arrays
+    """
+    (new_lats, new_lons, _ignore) = convertWGS84toOSGB36Batch(lats, lons)
+    return LatLongToOSGridBatch(new_lats, new_lons)
+
+
+# A fast approximation of convertWGS84toOSEastingNorthing() for points in and around London (i.e. all the points we would ever accept
+# from a user), which avoids the expense of the full conversion. Within the bounds below, the easting and northing are each a cubic
+# polynomial of the latitude & longitude (relative to the origin below), fitted by datatools.fit_london_grid_transform()
+#
+# The worst error of the polynomials (compared to the unrounded result of the exact conversion) is under 1cm, so once rounded to the
+# nearest metre the results are the same as the exact conversion's, except rarely off by a metre when the exact result is very close to
+# half a metre. Points outside the bounds use the exact conversion
+#
+LONDON_TRANSFORM_BOUNDS = ((51.2, 51.8), (-0.65, 0.45))
+LONDON_TRANSFORM_ORIGIN = (51.5, -0.1)
+# Coefficients of each polynomial, for the terms 1, x, x^2, x^3, y, xy, x^2y, y^2, xy^2, y^3, where x is the longitude and y the latitude
+LONDON_TRANSFORM_EASTING = (531979.2918235937, 69406.22559966735, -4.507763405475998, -0.7960613282607354, -2886.6036339492293,
+                            -1520.2348203405918, -0.5851088418499663, -20.25918957345857, -10.642488168159288, 0.1417903569186672)
+LONDON_TRANSFORM_NORTHING = (179606.9090429963, 1801.6461525325176, 474.41071809079244, 0.12200568010892725, 111202.89415607094,
+                             -14.44694076216158, -3.822569057044191, 8.47018038356731, -1.0983621436976458, -0.019223081177059065)
+
+
+def convertWGS84toOSEastingNorthingFast(latitude, longitude):
+    """
+    Convert a WGS84 (latitude, longitude) position, returns a (easting, northing) tuple, using a fast approximation if the position is
+    in the London area, and the exact conversion if not
+    """
+    ((min_lat, max_lat), (min_lon, max_lon)) = LONDON_TRANSFORM_BOUNDS
+    if not (min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon):
+        return convertWGS84toOSEastingNorthing(latitude, longitude)
+    y = latitude - LONDON_TRANSFORM_ORIGIN[0]
+    x = longitude - LONDON_TRANSFORM_ORIGIN[1]
+    # Evaluate the polynomials using Horner's method, which is quickest
+    (c0, c1, c2, c3, c4, c5, c6, c7, c8, c9) = LONDON_TRANSFORM_EASTING
+    easting = c0 + x*(c1 + x*(c2 + x*c3)) + y*(c4 + x*(c5 + x*c6) + y*(c7 + x*c8 + y*c9))
+    (c0, c1, c2, c3, c4, c5, c6, c7, c8, c9) = LONDON_TRANSFORM_NORTHING
+    northing = c0 + x*(c1 + x*(c2 + x*c3)) + y*(c4 + x*(c5 + x*c6) + y*(c7 + x*c8 + y*c9))
+    return (int(round(easting)), int(round(northing)))
+
+
+def is_in_uk(latitude, longitude):
+    """
+    Return True if a WGS84 (latitude, longitude) position is within the bounds of the OS National Grid, i.e. in or around the UK
+    """
+    return bool(gridrefNumToLet(*convertWGS84toOSEastingNorthing(latitude, longitude)))
+
+
 def heading_to_direction(heading):
     """
     Helper function to convert a heading (in degrees), returns a human-readable direction as a string
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Persistent cache of geocoder results for When's My Transport
+"""
+import json
+import logging
+import time
+
+from lib.database import WMTDatabase
+from lib.stringutils import normalise_placename
+
+GEOCODE_CACHE_MAXIMUM_AGE = 60 * 60 * 24 * 90  # Places don't move very often, so keep results for 90 days
+GEOCODE_CACHE_MAXIMUM_SIZE = 10000  # Maximum number of results to keep
+
+
+class WMTGeocodeCache():
+    """
+    Class representing a cache of geocoder results, stored in a database so they are remembered between sessions. Results are keyed
+    on the normalised placename and the name of the geocoder that produced them, and expire after maximum_age seconds. When there are
+    more than maximum_size results, the oldest are thrown away. Empty results are never stored, as geocoders also give them when they
+    are throttled or too slow, and we don't want one of those to count as "nowhere matches" for months
+    """
+    def __init__(self, instance_name, maximum_age=GEOCODE_CACHE_MAXIMUM_AGE, maximum_size=GEOCODE_CACHE_MAXIMUM_SIZE):
+        self.maximum_age = maximum_age
+        self.maximum_size = maximum_size
+        self.database = WMTDatabase('%s.geocache.db' % instance_name)
+        self.database.write_query("create table if not exists geocodes "
+                                  "(placename, provider, points, time, primary key (placename, provider))")
+        self.database.write_query("create index if not exists geocodes_time on geocodes (time)")
+        self.hits = 0
+        self.misses = 0
+
+    def get_points(self, placename, provider):
+        """
+        Return the list of (latitude, longitude) tuples stored for placename from the geocoder named provider, or None if there is no
+        fresh result stored
+        """
+        key = (normalise_placename(placename), provider)
+        row = self.database.get_row("select points, time from geocodes where placename = ? and provider = ?", key)
+        if row is None or time.time() - row['time'] > self.maximum_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.debug("Using cached geocode for %s from %s", placename, provider)
+        return [tuple(point) for point in json.loads(row['points'])]
+
+    def set_points(self, placename, provider, points):
+        """
+        Store the list of (latitude, longitude) tuples found for placename by the geocoder named provider, throwing away the oldest
+        results if the cache is now too big. Empty lists are not stored
+        """
+        if not points:
+            return
+        self.database.write_query("insert or replace into geocodes (placename, provider, points, time) values (?, ?, ?, ?)",
+                                  (normalise_placename(placename), provider, json.dumps(points), time.time()))
+        excess = self.database.get_value("select count(*) from geocodes") - self.maximum_size
+        if excess > 0:
+            self.database.write_query("delete from geocodes where rowid in (select rowid from geocodes order by time limit ?)", (excess,))
+
+    def get_hit_rate(self):
+        """
+        Return the proportion of lookups this session that were answered from the cache, between 0 and 1
+        """
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups
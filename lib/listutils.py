@@ -18,3 +18,19 @@ def unique_values(seq):
         seen[item] = 1
         result.append(item)
     return result
+
+
+def filter_by_group(seq, key_function, filter_function):
+    """
+    Return the values of sequence seq for which filter_function returns True. filter_function must always give the same answer for values
+    that key_function gives the same key for, as it is only called once per key. Keys must be hashable for this to work
+    """
+    results = {}
+    filtered = []
+    for item in seq:
+        key = key_function(item)
+        if key not in results:
+            results[key] = filter_function(item)
+        if results[key]:
+            filtered.append(item)
+    return filtered
@@ -3,22 +3,24 @@
 """
 Location-finding service for WhensMyTransport
 """
-import cPickle as pickle
 import logging
 from math import sqrt, ceil
 import os.path
 from pprint import pprint
 
-# http://code.google.com/p/python-graph/
-from pygraph.algorithms.minmax import shortest_path
-
+from lib.cache import LRUCache, lazy_property
+from lib.listutils import filter_by_group
 from lib.models import Location, BusStop, RailStation
 from lib.stringutils import get_best_fuzzy_match
 from lib.database import WMTDatabase
-from lib.geo import convertWGS84toOSEastingNorthing
+from lib.geo import convertWGS84toOSEastingNorthingFast
+from lib.network import is_direct_path, load_fastest_lines, load_network, load_route_tables
 
 
 DB_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/../db/')
+# Maximum number of single-source shortest path results to keep in memory for graph searches. The graph is only searched for line
+# codes without a precomputed route table (e.g. if the route tables have not been built), so this is not used with the full data
+SHORTEST_PATH_CACHE_SIZE = 256
 
 
 class WMTLocations():
@@ -28,7 +30,6 @@ class WMTLocations():
     """
     def __init__(self, instance_name):
         self.database = WMTDatabase('%s.geodata.db' % instance_name)
-        self.network = None
         self.returned_object = Location
 
     def find_closest(self, position, params):
@@ -38,7 +39,7 @@ class WMTLocations():
         """
         # GPSes use WGS84 model of Globe, but Easting/Northing based on OSGB36, so convert to an easting/northing
         logging.debug("Position in WGS84 determined as lat/long: %s %s", position[0], position[1])
-        easting, northing = convertWGS84toOSEastingNorthing(*position)
+        easting, northing = convertWGS84toOSEastingNorthingFast(*position)
         logging.debug("Translated into OS Easting %s, Northing %s", easting, northing)
 
         # Do a funny bit of Pythagoras to work out closest stop. We can't find square root of a number in sqlite
@@ -55,13 +56,39 @@ class WMTLocations():
                 """ % (easting, easting, northing, northing, where_statement)
         row = self.database.get_row(query, where_values)
         if row:
-            obj = self.returned_object(Distance=sqrt(row['dist_squared']), **row)
+            obj = self.returned_object(distance=sqrt(row['dist_squared']), **row)
             logging.debug("Have found nearest location %s", obj)
             return obj
         else:
             logging.debug("No location found near %s, sorry", position)
             return None
 
+    def find_closest_in_each_group(self, positions, params, group_column):
+        """
+        Find the closest location to any of the (lat, long) positions specified, for each value of group_column (e.g. each run of a
+        bus route), querying the database with dictionary params, of the format { Column Name : value }. Returns a dictionary of
+        objects of class returned_object, keyed by the value of group_column
+
+        This gives the same results as calling find_closest() for every position and every group and keeping the closest, but
+        needs only a single query
+        """
+        grid_positions = [convertWGS84toOSEastingNorthingFast(*position) for position in positions]
+        (where_statement, where_values) = self.database.make_where_statement('locations', params)
+        rows = self.database.get_rows("SELECT * FROM locations WHERE %s" % where_statement, where_values)
+
+        closest_rows = {}
+        for row in rows:
+            (row_easting, row_northing) = (row['location_easting'], row['location_northing'])
+            dist_squared = min([(row_easting - easting) ** 2 + (row_northing - northing) ** 2 for (easting, northing) in grid_positions])
+            group = row[group_column]
+            if group not in closest_rows or dist_squared < closest_rows[group][0]:
+                closest_rows[group] = (dist_squared, row)
+
+        closest = dict([(group, self.returned_object(distance=sqrt(dist_squared), **row))
+                        for (group, (dist_squared, row)) in closest_rows.items()])
+        logging.debug("Have found nearest locations %s", closest)
+        return closest
+
     def find_fuzzy_match(self, stop_or_station_name, params):
         """
         Find the best fuzzy match to the query_string, querying the database with dictionary params, of the format
@@ -114,21 +141,57 @@ class RailStationLocations(WMTLocations):
     """
     def __init__(self):
         WMTLocations.__init__(self, 'whensmytrain')
-        network_file = DB_PATH + '/whensmytrain.network.gr'
-        logging.debug("Opening network node data %s", os.path.basename(network_file))
-        self.network = pickle.load(open(network_file))
+        self.shortest_paths = LRUCache(SHORTEST_PATH_CACHE_SIZE)
         self.returned_object = RailStation
 
+    @lazy_property
+    def station_lines(self):
+        """
+        Dictionary of the lines serving each station, keyed by station code. Values are lists of (station name, line code) tuples,
+        in database order
+        """
+        station_lines = {}
+        for (name, code, line_code) in self.database.get_rows("SELECT name,code,line FROM locations"):
+            station_lines.setdefault(code, []).append((name, line_code))
+        return station_lines
+
+    @lazy_property
+    def fastest_lines(self):
+        """
+        Dictionary of the fastest line going directly from each station to each other station, as worked out by get_lines_serving() and
+        precomputed by datatools.py. Keyed by origin station code, values are dictionaries of line codes keyed by destination station name.
+        Only loaded when we first need it
+        """
+        return load_fastest_lines('whensmytrain.lines.obj')
+
+    @lazy_property
+    def network(self):
+        """
+        Dictionary of graphs of the rail network, keyed by line code. Only loaded when we first need to route something
+        """
+        return load_network('whensmytrain.network.dat')
+
+    @lazy_property
+    def route_tables(self):
+        """
+        Dictionary of precomputed route tables, keyed by line code. These let us look up, rather than search for, routes; the network
+        graph is only searched for lines without a table. Only loaded when we first need to route something
+        """
+        return load_route_tables('whensmytrain.routes.obj')
+
     def get_lines_serving(self, origin, destination=None):
         """
         Return a list of line codes that the RailStation origin is served by. If RailStation destination is specified, then
         only the quickest line that directly goes from origin to destination is returned as a single element of that list
         """
-        rows = self.database.get_rows("SELECT name,line FROM locations WHERE code=?", (origin.code,))
-        stations = [(RailStation(name), line) for (name, line) in rows]
+        stations = self.station_lines.get(origin.code, [])
         # If a destination exists, filter using it. If multiple ways of getting to destination,
-        # sort by quickest and return line code for that
-        if stations and destination:
+        # sort by quickest and return line code for that. This has usually been worked out already
+        if stations and destination and origin.code in self.fastest_lines:
+            line_code = self.fastest_lines[origin.code].get(destination.name)
+            return line_code and [line_code] or []
+        elif stations and destination:
+            stations = [(RailStation(name), line_code) for (name, line_code) in stations]
             stations = [(station, line_code, self.length_of_route(station, destination, line_code)) for (station, line_code) in stations if self.direct_route_exists(station, destination, line_code)]
             stations.sort(lambda (a, b, c), (d, e, f): cmp(c, f))
             return [line_code for (station, line_code, time_taken) in stations][:1]
@@ -141,10 +204,11 @@ class RailStationLocations(WMTLocations):
         via the specified line_code (if any)
         Returns -1 if there is no route between the two
         """
+        if line_code in self.route_tables:
+            return self.route_tables[line_code].length_of_route(origin.name, destination.name)
         origin_name = origin.name + ":entrance"
         destination_name = destination.name + ":exit"
-        network = self.network[line_code]
-        shortest_path_times = shortest_path(network, origin_name)[1]
+        shortest_path_times = self.get_shortest_paths(line_code, origin_name)[1]
         return int(ceil(shortest_path_times.get(destination_name, -1)))
 
     def describe_route(self, origin, destination, line_code='All', via=None):
@@ -152,7 +216,7 @@ class RailStationLocations(WMTLocations):
         Return the shortest route between origin and destination. Returns an list describing the route from start to finish
         Each element of the list is a tuple of form (station_name, direction, line_code)
         """
-        if not self.network:
+        if not self.route_tables and not self.network:
             return []
         if via:
             first_half = self.describe_route(origin, via, line_code)
@@ -161,12 +225,12 @@ class RailStationLocations(WMTLocations):
                 del second_half[0]
             return first_half + second_half
 
+        if line_code in self.route_tables:
+            return self.route_tables[line_code].describe_route(origin.name, destination.name)
         origin_name = origin.name + ":entrance"
         destination_name = destination.name + ":exit"
 
-        network = self.network[line_code]
-        shortest_path_values = shortest_path(network, origin_name)
-        shortest_path_dictionary = shortest_path_values[0]
+        shortest_path_dictionary = self.get_shortest_paths(line_code, origin_name)[0]
 
         if origin_name not in shortest_path_dictionary or destination_name not in shortest_path_dictionary:
             return []
@@ -182,6 +246,21 @@ class RailStationLocations(WMTLocations):
         path_taken = path_taken[1:-1][::-1]
         return path_taken
 
+    def get_shortest_paths(self, line_code, origin_name):
+        """
+        Return the result of a single-source shortest path search of the graph for line_code, from the node origin_name. This is
+        a tuple of two dictionaries - the predecessor of each node on the shortest path to it, and the time taken to get to each node
+
+        The search is the most expensive part of routing, and the same origin is routed from many times when filtering a single
+        station's departures, so results are kept in a least-recently-used cache. This is only called for line codes that have no
+        route table
+        """
+        shortest_path_values = self.shortest_paths.get((line_code, origin_name))
+        if shortest_path_values is None:
+            shortest_path_values = self.network[line_code].shortest_path(origin_name)
+            self.shortest_paths[(line_code, origin_name)] = shortest_path_values
+        return shortest_path_values
+
     def direct_route_exists(self, origin, destination, line_code, via=None, must_stop_at=None):
         """
         Return whether there is a direct route (i.e. one that does work without changing) between origin and destination on the line
@@ -196,6 +275,11 @@ class RailStationLocations(WMTLocations):
         if origin == destination:
             return True
 
+        # Precomputed route tables can tell us without having to trace the route
+        if line_code in self.route_tables:
+            return self.route_tables[line_code].direct_route_exists(origin.name, destination.name,
+                                                                    via and via.name, must_stop_at and must_stop_at.name)
+
         path_taken = [stop[0] for stop in self.describe_route(origin, destination, line_code, via)]
         # If no path possible, then of course return False
         if not path_taken:
@@ -203,15 +287,8 @@ class RailStationLocations(WMTLocations):
         # If must_stop_at not in the list, then return False
         if must_stop_at and must_stop_at.name not in path_taken:
             return False
-
-        for i in range(1, len(path_taken)):
-            # If same station twice in a row, then we must have a change
-            if path_taken[i] == path_taken[i - 1]:
-                return False
-            # If visiting same station with one in between, then we must have visited a station & doubled back
-            if i > 1 and path_taken[i] == path_taken[i - 2]:
-                return False
-        return True
+        # If the same station is visited twice in a row, or twice with one in between, we must have changed or doubled back
+        return is_direct_path(path_taken)
 
     def is_correct_direction(self, direction, origin, destination, line_code):
         """
@@ -251,3 +328,30 @@ class RailStationLocations(WMTLocations):
             return self.is_correct_direction(train.direction, origin, desired_station, train.line_code)
         else:
             return False
+
+    def get_trains_stopping_at(self, trains, origin, desired_station):
+        """
+        Return a list of those Trains in trains from RailStation origin that will stop at RailStation desired_station on the way
+
+        This gives the same result as calling does_train_stop_at() on each train, but the answer only depends on where a train is
+        going (or the direction it is going in, if we don't know that), so we only work it out once for each group of trains that
+        share a destination and via. On a busy station, this means we only have to do as much work as there are destinations
+        """
+        train_key = lambda train: train.destination and (get_station_key(train.destination), get_station_key(train.via), train.line_code) \
+                                  or (train.direction, train.line_code)
+        return filter_by_group(trains, train_key, lambda train: self.does_train_stop_at(train, origin, desired_station))
+
+    def get_trains_in_direction(self, trains, origin, direction, line_code):
+        """
+        Return a list of those Trains in trains from RailStation origin whose destination is in the direction direction, on the line
+        with code line_code. Like get_trains_stopping_at(), we only work this out once for each destination
+        """
+        train_key = lambda train: get_station_key(train.destination)
+        return filter_by_group(trains, train_key, lambda train: self.is_correct_direction(direction, origin, train.destination, line_code))
+
+
+def get_station_key(station):
+    """
+    Return a hashable value that identifies the RailStation station, or None if there is no station
+    """
+    return station and (station.name, station.code) or None
@@ -2,11 +2,15 @@
 #pylint: disable=R0913
 """
 Models and abstractions of concepts such as stations, trains, bus stops etc.
+
+Locations and departures are new-style classes with __slots__ rather than an instance dictionary, as we create a great many of them
+(e.g. one for every bus stop on a route, each time we fuzzy match a stop name), so keeping them small makes them faster to create
 """
-from datetime import datetime, timedelta
 import logging
 import re
+from operator import attrgetter, itemgetter
 
+from lib.clock import WMTClock
 from lib.listutils import unique_values
 from lib.stringutils import cleanup_name_from_undesirables, get_name_similarity
 
@@ -15,11 +19,13 @@ from lib.stringutils import cleanup_name_from_undesirables, get_name_similarity
 # Representations of stations, stops etc
 #
 
-class Location():
+class Location(object):
     #pylint: disable=R0903
     """
     Class representing any kind of location (bus stop or station)
     """
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
@@ -37,14 +43,21 @@ class BusStop(Location):
     #pylint: disable=W0613
     """
     Class representing a bus stop
+
+    The clean and normalised versions of its name are precomputed by datatools and stored in the database, so are usually passed in
+    when the stop is made; if not, they are worked out the first time they are needed
     """
-    def __init__(self, name='', bus_stop_code='', heading=0, sequence=1, distance=0.0, run=0, **kwargs):
+    __slots__ = ('number', 'heading', 'sequence', 'distance_away', 'run', 'clean_name', 'normalised_name')
+
+    def __init__(self, name='', bus_stop_code='', heading=0, sequence=1, distance=0.0, run=0, clean_name='', normalised_name='', **kwargs):
         Location.__init__(self, name)
         self.number = bus_stop_code
         self.heading = heading
         self.sequence = sequence
         self.distance_away = distance
         self.run = run
+        self.clean_name = clean_name
+        self.normalised_name = normalised_name
 
     def __cmp__(self, other):
         return cmp(self.distance_away, other.distance_away)
@@ -59,12 +72,17 @@ class BusStop(Location):
         """
         Get rid of TfL's ASCII symbols for Tube, National Rail, DLR & Tram from this stop's name
         """
-        return cleanup_name_from_undesirables(self.name, ('<>', '#', r'\[DLR\]', '>T<'))
+        if self.clean_name:
+            return self.clean_name
+        self.clean_name = cleanup_name_from_undesirables(self.name, ('<>', '#', r'\[DLR\]', '>T<'))
+        return self.clean_name
 
     def get_normalised_name(self):
         """
         Normalise a bus stop name, sorting out punctuation, capitalisation, abbreviations & symbols
         """
+        if self.normalised_name:
+            return self.normalised_name
         # Upper-case and abbreviate road names
         normalised_name = self.get_clean_name().upper()
         for (word, abbreviation) in (('SQUARE', 'SQ'), ('AVENUE', 'AVE'), ('STREET', 'ST'), ('ROAD', 'RD'), ('STATION', 'STN'), ('PUBLIC HOUSE', 'PUB')):
@@ -73,8 +91,8 @@ class BusStop(Location):
         for common_word in ('THE',):
             normalised_name = re.sub(r'\b' + common_word + r'\b', '', normalised_name)
         # Remove spaces and punctuation and return
-        normalised_name = re.sub('[\W]', '', normalised_name)
-        return normalised_name
+        self.normalised_name = re.sub('[\W]', '', normalised_name)
+        return self.normalised_name
 
     def get_similarity(self, test_string=''):
         """
@@ -109,17 +127,26 @@ class RailStation(Location):
     #pylint: disable=W0613
     """
     Class representing a railway station
+
+    The abbreviated version of its name is precomputed by datatools and stored in the database, so is usually passed in when the
+    station is made; if not, it is worked out the first time it is needed
     """
-    def __init__(self, name='', code='', location_easting=0, location_northing=0, inner='', outer='', **kwargs):
+    __slots__ = ('code', 'location_easting', 'location_northing', 'circular_directions', 'abbreviated_name')
+
+    def __init__(self, name='', code='', location_easting=0, location_northing=0, inner='', outer='', abbreviated_name='', **kwargs):
         Location.__init__(self, name)
         self.code = code
         self.location_easting = location_easting
         self.location_northing = location_northing
         self.circular_directions = {'inner': inner, 'outer': outer}
+        self.abbreviated_name = abbreviated_name
 
     def __eq__(self, other):
         return self.name == other.name and self.code == other.code
 
+    # Stations with an __eq__ but no __hash__ were never hashable when this was an old-style class, so keep it that way
+    __hash__ = None
+
     def get_name(self):
         """
         Return this station's name
@@ -130,49 +157,10 @@ class RailStation(Location):
         """
         Take this station's name and abbreviate it to make it fit on Twitter better
         """
-        # Stations we just have to cut down by hand
-        translations = {
-            "High Street Kensington": "High St Ken",
-            "King's Cross St. Pancras": "Kings X St P",
-            "Kensington (Olympia)": "Olympia",
-            "W'wich Arsenal": "Woolwich A",
-        }
-        station_name = translations.get(self.name, self.name)
-
-        # Punctuation marks can be cut down
-        punctuation_to_remove = (r'\.', ', ', r'\(', r'\)', "'",)
-        station_name = cleanup_name_from_undesirables(station_name, punctuation_to_remove)
-
-        # Words like Road and Park can be slimmed down as well
-        abbreviations = {
-            'Bridge': 'Br',
-            'Broadway': 'Bdwy',
-            'Central': 'Ctrl',
-            'Court': 'Ct',
-            'Cross': 'X',
-            'Crescent': 'Cresc',
-            'East': 'E',
-            'Gardens': 'Gdns',
-            'Green': 'Grn',
-            'Heathway': 'Hthwy',
-            'Junction': 'Jct',
-            'Market': 'Mkt',
-            'North': 'N',
-            'Park': 'Pk',
-            'Road': 'Rd',
-            'South': 'S',
-            'Square': 'Sq',
-            'Street': 'St',
-            'Terminal': 'T',
-            'Terminals': 'T',
-            'West': 'W',
-        }
-        station_name = ' '.join([abbreviations.get(word, word) for word in station_name.split(' ')])
-
-        # Any station with & in it gets only the initial of the second word - e.g. Elephant & C
-        if station_name.find('&') > -1:
-            station_name = station_name[:station_name.find('&') + 2]
-        return station_name
+        if self.abbreviated_name:
+            return self.abbreviated_name
+        self.abbreviated_name = get_abbreviated_station_name(self.name)
+        return self.abbreviated_name
 
     def get_similarity(self, test_string=''):
         """
@@ -187,22 +175,99 @@ class RailStation(Location):
                 return min(abbreviated_score, 99)  # Never 100, in case it overrides an exact match
         return score
 
+
+# Abbreviated names for each station name we have been asked to abbreviate. Every departure in a Tweet has its destination
+# abbreviated, but there are only a few hundred stations, so we only need to abbreviate each one once
+ABBREVIATED_STATION_NAMES = {}
+ABBREVIATED_STATION_NAMES_MAXIMUM_SIZE = 4096
+
+
+def get_abbreviated_station_name(station_name):
+    """
+    Take a station's name and abbreviate it to make it fit on Twitter better
+    """
+    if station_name in ABBREVIATED_STATION_NAMES:
+        return ABBREVIATED_STATION_NAMES[station_name]
+    full_station_name = station_name
+
+    # Stations we just have to cut down by hand
+    translations = {
+        "High Street Kensington": "High St Ken",
+        "King's Cross St. Pancras": "Kings X St P",
+        "Kensington (Olympia)": "Olympia",
+        "W'wich Arsenal": "Woolwich A",
+    }
+    station_name = translations.get(station_name, station_name)
+
+    # Punctuation marks can be cut down
+    punctuation_to_remove = (r'\.', ', ', r'\(', r'\)', "'",)
+    station_name = cleanup_name_from_undesirables(station_name, punctuation_to_remove)
+
+    # Words like Road and Park can be slimmed down as well
+    abbreviations = {
+        'Bridge': 'Br',
+        'Broadway': 'Bdwy',
+        'Central': 'Ctrl',
+        'Court': 'Ct',
+        'Cross': 'X',
+        'Crescent': 'Cresc',
+        'East': 'E',
+        'Gardens': 'Gdns',
+        'Green': 'Grn',
+        'Heathway': 'Hthwy',
+        'Junction': 'Jct',
+        'Market': 'Mkt',
+        'North': 'N',
+        'Park': 'Pk',
+        'Road': 'Rd',
+        'South': 'S',
+        'Square': 'Sq',
+        'Street': 'St',
+        'Terminal': 'T',
+        'Terminals': 'T',
+        'West': 'W',
+    }
+    station_name = ' '.join([abbreviations.get(word, word) for word in station_name.split(' ')])
+
+    # Any station with & in it gets only the initial of the second word - e.g. Elephant & C
+    if station_name.find('&') > -1:
+        station_name = station_name[:station_name.find('&') + 2]
+
+    # Just in case we get asked about garbage, don't let this grow without limit
+    if len(ABBREVIATED_STATION_NAMES) >= ABBREVIATED_STATION_NAMES_MAXIMUM_SIZE:
+        ABBREVIATED_STATION_NAMES.clear()
+    ABBREVIATED_STATION_NAMES[full_station_name] = station_name
+    return station_name
+
 #
 # Representations of departures
 #
 
+MINUTES_IN_A_DAY = 24 * 60
 
-class Departure():
+
+
+class Departure(object):
     """
     Class representing a train or bus
     """
     #pylint: disable=R0903
-    def __init__(self, destination, departure_time):
+    __slots__ = ('destination', 'departure_time')
+
+    def __init__(self, destination, departure_time, clock=None):
+        """
+        departure_time is the number of minutes past midnight the departure is due (or a string of the same in "HHMM" format). It is
+        kept as the number of minutes since the start of today, so departures after tonight's midnight are more than a day's worth
+
+        clock is the WMTClock for the request this departure is for; if not given, the time now is used
+        """
         self.destination = destination
-        self.departure_time = datetime.strptime(departure_time, "%H%M")
+        if isinstance(departure_time, basestring):
+            departure_time = int(departure_time[0:2]) * 60 + int(departure_time[2:4])
         # Deal with us being one side of midnight from the prescribed times
-        if datetime.now().hour > self.departure_time.hour + 1:
-            self.departure_time += timedelta(days=1)
+        if departure_time < (clock or WMTClock()).service_day_start:
+            departure_time += MINUTES_IN_A_DAY
+        self.departure_time = departure_time
 
     def __cmp__(self, other):
         return cmp(self.departure_time, other.departure_time)
@@ -226,7 +291,7 @@ class Departure():
         """
         Returns human-readable version of departure time, in the 24-hour clock
         """
-        return self.departure_time.strftime("%H%M")
+        return "%02d%02d" % divmod(self.departure_time % MINUTES_IN_A_DAY, 60)
 
 
 class NullDeparture(Departure):
@@ -234,8 +299,11 @@ class NullDeparture(Departure):
     Class representing a non-existent train or bus (i.e. when none is showing)
     """
     #pylint: disable=R0903
-    def __init__(self, direction=""):
-        Departure.__init__(self, "None", datetime.now().strftime("%H%M"))
+    __slots__ = ('direction',)
+
+    def __init__(self, direction="", clock=None):
+        clock = clock or WMTClock()
+        Departure.__init__(self, "None", clock.minutes, clock)
         self.direction = direction
 
     def get_destination(self, abbreviated=False):
@@ -259,8 +327,10 @@ class Bus(Departure):
     by recording the departure point as well
     """
     #pylint: disable=R0903
-    def __init__(self, destination, departure_time, _departure_point=""):
-        Departure.__init__(self, destination, departure_time)
+    __slots__ = ()
+
+    def __init__(self, destination, departure_time, _departure_point="", clock=None):
+        Departure.__init__(self, destination, departure_time, clock)
 
 
 class Train(Departure):
@@ -269,8 +339,10 @@ class Train(Departure):
 
     Unlike Buses, trains can have unknown destinations or complicated destination names
     """
-    def __init__(self, destination_name, departure_time):
-        Departure.__init__(self, destination_name, departure_time)
+    __slots__ = ('via', 'direction', 'line_code')
+
+    def __init__(self, destination_name, departure_time, clock=None):
+        Departure.__init__(self, destination_name, departure_time, clock)
         if destination_name == "Unknown":
             self.destination = None
         else:
@@ -316,45 +388,11 @@ class TubeTrain(Train):
     Class representing a Tube train
     """
     #pylint: disable=W0231
-    def __init__(self, destination_name, direction, departure_time, line_code, set_number):
-        manual_translations = {"Heathrow T123 + 5": "Heathrow Terminal 5",
-                               "Olympia": "Kensington (Olympia)"}
-        destination_name = manual_translations.get(destination_name, destination_name)
-        # Get rid of TfL's odd designations in the Destination field to make it compatible with our list of stations in the database
-        # Destination names are full of garbage. What I would like is a database mapping codes to canonical names, but this does not exist
-        destination_name = re.sub(r"\band\b", "&", destination_name, flags=re.I)
-
-        # Destinations that are line names or Unknown get boiled down to Unknown
-        if destination_name in ("Unknown", "Circle & Hammersmith & City") or destination_name.startswith("Circle Line") \
-            or destination_name.endswith("Train") or destination_name.endswith("Line"):
-            destination_name = "Unknown"
-        else:
-            # Regular expressions of instructions, depot names (presumably instructions for shunting after arrival), or platform numbers
-            undesirables = ('\(rev to .*\)',
-                            '\(Rev\) Bank Branch',
-                            r'sidings?\b',
-                            '(then )?depot',
-                            'ex (barnet|edgware) branch',
-                            '\(ex .*\)',
-                            '/ london road',
-                            '27 Road',
-                            r'24r/25r',
-                            '\(plat\. [0-9]+\)',
-                            ' loop',
-                            '\(circle\)',
-                            '\(district\)',
-                            ' TOC',)
-            destination_name = cleanup_name_from_undesirables(destination_name, undesirables)
-
-        via_match = re.search(" \(?via ([^)]*)\)?$", destination_name, flags=re.I)
-        if via_match:
-            manual_translations = {"CX": "Charing Cross", "T4": "Heathrow Terminal 4"}
-            via = manual_translations.get(via_match.group(1), via_match.group(1))
-            destination_name = re.sub(" \(?via .*$", "", destination_name, flags=re.I)
-        else:
-            via = ""
+    __slots__ = ('set_number',)
 
-        Train.__init__(self, destination_name, departure_time)
+    def __init__(self, destination_name, direction, departure_time, line_code, set_number, clock=None):
+        (destination_name, via) = get_tube_destination_and_via(destination_name)
+        Train.__init__(self, destination_name, departure_time, clock)
         if via:
             self.via = RailStation(via)
         self.direction = direction
@@ -368,12 +406,73 @@ class TubeTrain(Train):
         return hash('-'.join([self.set_number, self.get_destination(), self.get_departure_time()]))
 
 
+# Cleaned-up (destination, via) names for each raw destination name TrackerNet has given us. There are only a few hundred different
+# ones (see whensmytube.destinationcodes.db), so we only need to clean each one up once
+TUBE_DESTINATIONS = {}
+TUBE_DESTINATIONS_MAXIMUM_SIZE = 4096
+
+
+def get_tube_destination_and_via(destination_name):
+    """
+    Take a raw destination name from TrackerNet and return a (destination, via) tuple of cleaned-up station names we can look up in our
+    database. via is an empty string if the train is not going via anywhere in particular
+    """
+    if destination_name in TUBE_DESTINATIONS:
+        return TUBE_DESTINATIONS[destination_name]
+    raw_destination_name = destination_name
+
+    manual_translations = {"Heathrow T123 + 5": "Heathrow Terminal 5",
+                           "Olympia": "Kensington (Olympia)"}
+    destination_name = manual_translations.get(destination_name, destination_name)
+    # Get rid of TfL's odd designations in the Destination field to make it compatible with our list of stations in the database
+    # Destination names are full of garbage. What I would like is a database mapping codes to canonical names, but this does not exist
+    destination_name = re.sub(r"\band\b", "&", destination_name, flags=re.I)
+
+    # Destinations that are line names or Unknown get boiled down to Unknown
+    if destination_name in ("Unknown", "Circle & Hammersmith & City") or destination_name.startswith("Circle Line") \
+        or destination_name.endswith("Train") or destination_name.endswith("Line"):
+        destination_name = "Unknown"
+    else:
+        # Regular expressions of instructions, depot names (presumably instructions for shunting after arrival), or platform numbers
+        undesirables = ('\(rev to .*\)',
+                        '\(Rev\) Bank Branch',
+                        r'sidings?\b',
+                        '(then )?depot',
+                        'ex (barnet|edgware) branch',
+                        '\(ex .*\)',
+                        '/ london road',
+                        '27 Road',
+                        r'24r/25r',
+                        '\(plat\. [0-9]+\)',
+                        ' loop',
+                        '\(circle\)',
+                        '\(district\)',
+                        ' TOC',)
+        destination_name = cleanup_name_from_undesirables(destination_name, undesirables)
+
+    via_match = re.search(" \(?via ([^)]*)\)?$", destination_name, flags=re.I)
+    if via_match:
+        manual_translations = {"CX": "Charing Cross", "T4": "Heathrow Terminal 4"}
+        via = manual_translations.get(via_match.group(1), via_match.group(1))
+        destination_name = re.sub(" \(?via .*$", "", destination_name, flags=re.I)
+    else:
+        via = ""
+
+    # Just in case TrackerNet starts giving us garbage, don't let this grow without limit
+    if len(TUBE_DESTINATIONS) >= TUBE_DESTINATIONS_MAXIMUM_SIZE:
+        TUBE_DESTINATIONS.clear()
+    TUBE_DESTINATIONS[raw_destination_name] = (destination_name, via)
+    return (destination_name, via)
+
+
 class DLRTrain(Train):
     """
     Class representing a DLR train
     """
-    def __init__(self, destination, departure_time):
-        Train.__init__(self, destination, departure_time)
+    __slots__ = ()
+
+    def __init__(self, destination, departure_time, clock=None):
+        Train.__init__(self, destination, departure_time, clock)
         self.line_code = "DLR"
 
 
@@ -381,6 +480,10 @@ class DLRTrain(Train):
 # Representation of a collection of Departures
 #
 
+# Sort keys for departures, and for (destination, [list of times]) tuples, which compare the same way as the departures themselves do
+get_departure_time_in_minutes = attrgetter('departure_time')
+get_first_departure_time = lambda (destination, times): times[0]
+
 
 class DepartureCollection:
     """
@@ -398,7 +501,8 @@ class DepartureCollection:
         self.departure_data = {}
 
     def __setitem__(self, slot, departures):
-        self.departure_data[slot] = departures
+        # Copy, so that adding to the slot afterwards does not change the list we were given
+        self.departure_data[slot] = list(departures)
 
     def __getitem__(self, slot):
         return self.departure_data[slot]
@@ -428,25 +532,24 @@ class DepartureCollection:
         departures_output = {}
         for slot in sorted(self.departure_data.keys()):
 
-            # Group by departure within each slot
-            departures = unique_values(sorted(self.departure_data[slot]))[:5]
-            destinations = unique_values([departure.get_destination(True) for departure in departures])
+            # Group by departure within each slot, in one pass over the earliest five, working out each one's destination only once
             departures_by_destination = {}
-            for destination in destinations:
-                departures_by_destination[destination] = [departure.get_departure_time() for departure in departures if departure.get_destination(True) == destination]
+            for departure in unique_values(sorted(self.departure_data[slot], key=get_departure_time_in_minutes))[:5]:
+                departures_by_destination.setdefault(departure.get_destination(True), []).append(departure.get_departure_time())
 
             # Then sort grouped departures, earliest first within the slot. Different destinations separated by commas
-            sort_earliest_departure_first = lambda (destination1, times1), (destination2, times2): cmp(times1[0], times2[0])
-            destinations_and_times = sorted(departures_by_destination.items(), sort_earliest_departure_first)
+            destinations_and_times = sorted(departures_by_destination.items(), key=get_first_departure_time)
             departures_for_this_slot = ["%s %s" % (destination, ' '.join(times[:3])) for (destination, times) in destinations_and_times]
-            departures_output[slot] = ', '.join([departure.strip() for departure in departures_for_this_slot])
+            output_for_this_slot = ', '.join([departure.strip() for departure in departures_for_this_slot])
 
             # Bus stops get their names included as well, if there is a departure
-            if isinstance(slot, BusStop) and not departures_output[slot].startswith("None shown"):
-                departures_output[slot] = "%s to %s" % (slot.get_clean_name(), departures_output[slot])
+            if isinstance(slot, BusStop) and not output_for_this_slot.startswith("None shown"):
+                output_for_this_slot = "%s to %s" % (slot.get_clean_name(), output_for_this_slot)
+            # Bus stops are expensive to hash, so only put each one in the dictionary once
+            departures_output[slot] = output_for_this_slot
 
         # Return slots separated by semi-colons
-        return '; '.join([departures_output[slot] for slot in sorted(departures_output.keys())])
+        return '; '.join([output for (_slot, output) in sorted(departures_output.items(), key=itemgetter(0))])
 
     def __repr__(self):
         return self.departure_data.__repr__()
@@ -455,7 +558,7 @@ class DepartureCollection:
         """
         Adds departure to slot, creating said slot if it doesn't already exist
         """
-        self.departure_data[slot] = self.departure_data.get(slot, []) + [departure]
+        self.departure_data.setdefault(slot, []).append(departure)
 
     def merge_common_slots(self):
         """
@@ -464,14 +567,19 @@ class DepartureCollection:
         Some slots run departures the same way (e.g. at termini). The DLR doesn't tell us if this is the case, so we look at the destinations
         on each pair of slots and see if there is any overlap, using the set object and its intersection function. Any such
         overlapping slots, we merge their data together (though only for the first pair though, to be safe)
+
+        Each slot's destinations are worked out once, here, rather than as departures are added, as a departure's destination can
+        change after it has been added (e.g. when a bot replaces it with the canonical station name)
         """
-        slot_pairs = [(slot1, slot2) for slot1 in self.departure_data.keys() for slot2 in self.departure_data.keys() if slot1 < slot2]
-        common_slots = [(slot1, slot2) for (slot1, slot2) in slot_pairs
-                             if set([t.get_destination() for t in self.departure_data[slot1]]).intersection([t.get_destination() for t in self.departure_data[slot2]])]
-        for (slot1, slot2) in common_slots[:1]:
-            logging.debug("Merging platforms %s and %s", slot1, slot2)
-            self.departure_data[slot1 + ' & ' + slot2] = unique_values(self.departure_data[slot1] + self.departure_data[slot2])
-            del self.departure_data[slot1], self.departure_data[slot2]
+        destinations = dict([(slot, set([departure.get_destination() for departure in departures]))
+                             for (slot, departures) in self.departure_data.items()])
+        slots = destinations.keys()
+        for (slot1, slot2) in [(slot1, slot2) for slot1 in slots for slot2 in slots if slot1 < slot2]:
+            if destinations[slot1] & destinations[slot2]:
+                logging.debug("Merging platforms %s and %s", slot1, slot2)
+                self[slot1 + ' & ' + slot2] = unique_values(self.departure_data[slot1] + self.departure_data[slot2])
+                del self[slot1], self[slot2]
+                break
 
     def filter(self, filter_function, delete_existing_empty_slots=False):
         """
@@ -481,11 +589,11 @@ class DepartureCollection:
         """
         for (slot, departures) in self.departure_data.items():
             if departures or delete_existing_empty_slots:
-                departures = [d for d in departures if filter_function(d)]
-                if not departures:
-                    del self.departure_data[slot]
-                else:
-                    self.departure_data[slot] = departures
+                filtered_departures = [d for d in departures if filter_function(d)]
+                if not filtered_departures:
+                    del self[slot]
+                elif len(filtered_departures) < len(departures):
+                    self[slot] = filtered_departures
 
     def cleanup(self, null_object_constructor=NullDeparture):
         """
@@ -504,4 +612,4 @@ class DepartureCollection:
         # If there is an empty list (no departures) then we replace it with the null object specified ("None shown...").
         for slot in self.departure_data.keys():
             if self.departure_data[slot] == []:
-                self.departure_data[slot] = [null_object_constructor(slot)]
+                self[slot] = [null_object_constructor(slot)]
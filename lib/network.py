@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+Rail network routing for WhensMyTransport - a compact representation of the network graph with its own shortest path search, and
+lookups on route tables that have been precomputed from that graph
+"""
+from array import array
+import cPickle as pickle
+from heapq import heappush, heappop
+import logging
+import os.path
+import struct
+import zlib
+
+DB_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/../db/')
+
+# Value used in the predecessor tables for a node that has no predecessor (i.e. it is the start of the route, or is unreachable)
+NO_NODE = 0xFFFF
+
+# First line of a network file, identifying its format
+NETWORK_FILE_HEADER = "WMTNETWORK 1\n"
+
+
+class NetworkGraph():
+    """
+    Directed, weighted graph of a rail network (or a single line of it), stored in compressed sparse row (CSR) form
+
+    Nodes are strings of the form Name:Direction:Line (or Name:entrance and Name:exit), which are given integer ids in alphabetical order.
+    The edges leaving the node with id i are held at positions offsets[i] to offsets[i+1] - 1 of the arrays targets (the id of the node
+    the edge goes to) and weights (the time taken in minutes)
+    """
+    def __init__(self, names, offsets, targets, weights):
+        self.names = names
+        self.node_ids = dict([(name, i) for (i, name) in enumerate(names)])
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+
+    def has_node(self, name):
+        """
+        Return True if the node with name name is in this graph
+        """
+        return name in self.node_ids
+
+    def neighbors(self, name):
+        """
+        Return a list of the names of nodes that can be reached directly from the node with name name
+        """
+        node = self.node_ids[name]
+        return [self.names[target] for target in self.targets[self.offsets[node]:self.offsets[node + 1]]]
+
+    def edge_weight(self, (origin_name, destination_name)):
+        """
+        Return the weight of the edge from node origin_name to node destination_name
+        """
+        node = self.node_ids[origin_name]
+        edges = self.targets[self.offsets[node]:self.offsets[node + 1]]
+        return self.weights[self.offsets[node] + list(edges).index(self.node_ids[destination_name])]
+
+    def shortest_path(self, source):
+        """
+        Return the shortest paths from the node named source to all other nodes, using Dijkstra's algorithm. Returns a tuple of two
+        dictionaries keyed by node name - the predecessor of each node on the shortest path to it (None for the source), and the
+        time taken to get to each node. Nodes that cannot be reached appear in neither
+
+        This gives exactly the same results as pygraph's shortest_path(), which we used to use. Its queue is sorted by distance and then
+        node name, and as node ids are in alphabetical order, our queue of (distance, id) tuples breaks ties between equal distances
+        the same way
+        """
+        source_id = self.node_ids[source]
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        distances = {source_id: 0}
+        previous = {source_id: None}
+        finished = set()
+        queue = [(0, source_id)]
+        while queue:
+            (distance, node) = heappop(queue)
+            if node in finished:
+                continue
+            finished.add(node)
+            for i in xrange(offsets[node], offsets[node + 1]):
+                target = targets[i]
+                if target not in finished:
+                    new_distance = distance + weights[i]
+                    if target not in distances or new_distance < distances[target]:
+                        distances[target] = new_distance
+                        previous[target] = node
+                        heappush(queue, (new_distance, target))
+
+        names = self.names
+        return (dict([(names[node], names[predecessor] if predecessor is not None else None) for (node, predecessor) in previous.items()]),
+                dict([(names[node], distance) for (node, distance) in distances.items()]))
+
+
+class RouteTable():
+    """
+    Table of the shortest routes between every pair of stations on a single line (or on the network as a whole)
+
+    Stations and nodes are identified by integer indices into the lists of station names and node names. The table holds, for each
+    origin station:
+        - the time taken (in whole minutes) to every destination station, or -1 if there is no route, and
+        - the predecessor of every node in the shortest path tree from that origin's entrance
+
+    Both are stored as flat arrays of (number of origins x number of stations) and (number of origins x number of nodes) respectively,
+    and are zlib-compressed in the file
+
+    So that we can tell whether a route is direct without tracing it, the table also holds, for each pair of stations, whether the
+    shortest route between them is direct and the first two nodes on it; and for each origin, a numbering of the nodes in the order
+    a depth-first walk of its shortest path tree reaches them, along with the number of nodes below each node
+    """
+    def __init__(self, nodes, stations, times, predecessors, direct_routes, first_nodes, second_nodes, preorder, subtree_sizes):
+        self.nodes = [tuple(node.split(':')) for node in nodes]
+        node_ids = dict([(node, i) for (i, node) in enumerate(nodes)])
+        self.station_ids = dict([(station, i) for (i, station) in enumerate(stations)])
+        self.exits = [node_ids[station + ':exit'] for station in stations]
+        self.platforms = {}
+        for (i, node) in enumerate(self.nodes):
+            if len(node) == 3:
+                self.platforms.setdefault(node[0], []).append(i)
+        self.times = decompress_array('h', times)
+        self.predecessors = decompress_array('H', predecessors)
+        self.direct_routes = decompress_array('B', direct_routes)
+        self.first_nodes = decompress_array('H', first_nodes)
+        self.second_nodes = decompress_array('H', second_nodes)
+        self.preorder = decompress_array('H', preorder)
+        self.subtree_sizes = decompress_array('H', subtree_sizes)
+
+    def has_station(self, station_name):
+        """
+        Return True if the station with name station_name is on this table
+        """
+        return station_name in self.station_ids
+
+    def length_of_route(self, origin_name, destination_name):
+        """
+        Return the time (in whole minutes) taken to get from origin_name to destination_name, or -1 if there is no route
+        """
+        if origin_name not in self.station_ids or destination_name not in self.station_ids:
+            return -1
+        return self.times[self.station_ids[origin_name] * len(self.station_ids) + self.station_ids[destination_name]]
+
+    def describe_route(self, origin_name, destination_name):
+        """
+        Return the shortest route from origin_name to destination_name as a list of (station_name, direction, line) tuples,
+        not including the entrance and exit. Returns an empty list if there is no route
+        """
+        if self.length_of_route(origin_name, destination_name) < 0:
+            return []
+        offset = self.station_ids[origin_name] * len(self.nodes)
+        # Count back from the exit of our destination to the entrance of our origin, then trim and reverse the list
+        path_taken = []
+        node = self.exits[self.station_ids[destination_name]]
+        while node != NO_NODE:
+            path_taken.append(self.nodes[node])
+            node = self.predecessors[offset + node]
+        return path_taken[1:-1][::-1]
+
+    def direct_route_exists(self, origin_name, destination_name, via_name=None, must_stop_at_name=None):
+        """
+        Return whether the shortest route from origin_name to destination_name (going via via_name, if specified) is direct, i.e.
+        does not involve changing trains, and (if must_stop_at_name is specified) whether it stops at must_stop_at_name
+
+        This gives the same answers as tracing the route with describe_route() and checking it with is_direct_path(), but without
+        having to trace the route
+        """
+        if not via_name:
+            return self.is_direct(origin_name, destination_name) and \
+                (not must_stop_at_name or self.stops_at(origin_name, destination_name, must_stop_at_name))
+
+        # A route via a station is made up of two halves. If either half is empty (because there is no route, or the via is the same as
+        # the origin or destination), then the route is just the other half
+        first_half_exists = origin_name != via_name and self.length_of_route(origin_name, via_name) >= 0
+        second_half_exists = via_name != destination_name and self.length_of_route(via_name, destination_name) >= 0
+        if not first_half_exists or not second_half_exists:
+            if first_half_exists:
+                return self.direct_route_exists(origin_name, via_name, must_stop_at_name=must_stop_at_name)
+            elif second_half_exists:
+                return self.direct_route_exists(via_name, destination_name, must_stop_at_name=must_stop_at_name)
+            return False
+        if not self.is_direct(origin_name, via_name) or not self.is_direct(via_name, destination_name):
+            return False
+
+        # The halves must join up at the same platform of the via station, and the train must not double back on itself there
+        second_half_offset = self.station_ids[via_name] * len(self.station_ids) + self.station_ids[destination_name]
+        first_half_offset = self.station_ids[origin_name] * len(self.nodes)
+        last_node = self.predecessors[first_half_offset + self.exits[self.station_ids[via_name]]]
+        if last_node != self.first_nodes[second_half_offset]:
+            return False
+        penultimate_node = self.predecessors[first_half_offset + last_node]
+        next_node = self.second_nodes[second_half_offset]
+        # (The penultimate node is only part of the first half if it is not the origin's entrance, i.e. the root of the tree)
+        if self.predecessors[first_half_offset + penultimate_node] != NO_NODE and next_node != NO_NODE and \
+           self.nodes[penultimate_node][0] == self.nodes[next_node][0]:
+            return False
+
+        return not must_stop_at_name or self.stops_at(origin_name, via_name, must_stop_at_name) or \
+            self.stops_at(via_name, destination_name, must_stop_at_name)
+
+    def is_direct(self, origin_name, destination_name):
+        """
+        Return True if there is a route from origin_name to destination_name, and the shortest one is direct
+        """
+        if origin_name not in self.station_ids or destination_name not in self.station_ids:
+            return False
+        return bool(self.direct_routes[self.station_ids[origin_name] * len(self.station_ids) + self.station_ids[destination_name]])
+
+    def stops_at(self, origin_name, destination_name, station_name):
+        """
+        Return True if the shortest route from origin_name to destination_name (which must exist) goes through station_name
+        """
+        offset = self.station_ids[origin_name] * len(self.nodes)
+        destination_order = self.preorder[offset + self.exits[self.station_ids[destination_name]]]
+        # A station is on the route if one of its platforms is, i.e. the destination is in the subtree below that platform
+        for platform in self.platforms.get(station_name, ()):
+            if 0 <= destination_order - self.preorder[offset + platform] <= self.subtree_sizes[offset + platform]:
+                return True
+        return False
+
+
+def is_direct_path(path_stations):
+    """
+    Return True if the list of station names path_stations describes a journey without changing trains - i.e. it never has the same
+    station twice in a row (which means changing lines), or twice with one in between (which means doubling back)
+    """
+    for i in range(1, len(path_stations)):
+        if path_stations[i] == path_stations[i - 1]:
+            return False
+        if i > 1 and path_stations[i] == path_stations[i - 2]:
+            return False
+    return True
+
+
+def decompress_array(typecode, data):
+    """
+    Return an array of type typecode from the zlib-compressed string data
+    """
+    values = array(typecode)
+    values.fromstring(zlib.decompress(data))
+    return values
+
+
+def save_network(graphs, filename):
+    """
+    Save graphs, a dictionary of NetworkGraph objects keyed by line code, to filename in the database directory
+
+    All the graphs share a single table of node names. After the header, the file holds the length of the name table and number
+    of graphs, the name table itself, and then for each graph the ids of its nodes in the name table, and its offsets, targets and
+    weights arrays, each preceded by their lengths
+    """
+    names = sorted(set([name for graph in graphs.values() for name in graph.names]))
+    name_ids = dict([(name, i) for (i, name) in enumerate(names)])
+    name_table = "\n".join(names)
+
+    network_file = open(DB_PATH + '/' + filename, 'wb')
+    network_file.write(NETWORK_FILE_HEADER)
+    network_file.write(struct.pack('=II', len(name_table), len(graphs)))
+    network_file.write(name_table)
+    for (line_code, graph) in sorted(graphs.items()):
+        network_file.write(struct.pack('=III', len(line_code), len(graph.names), len(graph.targets)))
+        network_file.write(line_code)
+        array('H', [name_ids[name] for name in graph.names]).tofile(network_file)
+        array('I', graph.offsets).tofile(network_file)
+        array('H', graph.targets).tofile(network_file)
+        array('d', graph.weights).tofile(network_file)
+    network_file.close()
+
+
+def load_network(filename):
+    """
+    Load the network graphs produced by datatools.py from filename in the database directory, and return a dictionary of NetworkGraph
+    objects keyed by line code. Returns an empty dictionary if the file does not exist
+    """
+    network_file = DB_PATH + '/' + filename
+    if not os.path.exists(network_file):
+        logging.debug("No network graph found at %s", os.path.basename(network_file))
+        return {}
+    logging.debug("Opening network graph %s", os.path.basename(network_file))
+    network_file = open(network_file, 'rb')
+    if network_file.readline() != NETWORK_FILE_HEADER:
+        raise ValueError("%s is not a network file in a format we can read" % os.path.basename(network_file.name))
+
+    def read_array(typecode, length):
+        """
+        Read an array of length items of type typecode from the network file
+        """
+        values = array(typecode)
+        values.fromfile(network_file, length)
+        return values
+
+    (name_table_length, graph_count) = struct.unpack('=II', network_file.read(8))
+    names = network_file.read(name_table_length).split("\n")
+    graphs = {}
+    for _i in range(0, graph_count):
+        (line_code_length, node_count, edge_count) = struct.unpack('=III', network_file.read(12))
+        line_code = network_file.read(line_code_length)
+        node_names = [names[name_id] for name_id in read_array('H', node_count)]
+        offsets = read_array('I', node_count + 1)
+        targets = read_array('H', edge_count)
+        weights = read_array('d', edge_count)
+        graphs[line_code] = NetworkGraph(node_names, offsets, targets, weights)
+    network_file.close()
+    return graphs
+
+
+def load_route_tables(filename):
+    """
+    Load the route tables produced by datatools.py from filename in the database directory, and return a dictionary of
+    RouteTable objects keyed by line code. Returns an empty dictionary if the file does not exist
+    """
+    route_file = DB_PATH + '/' + filename
+    if not os.path.exists(route_file):
+        logging.debug("No route tables found at %s", os.path.basename(route_file))
+        return {}
+    logging.debug("Opening route tables %s", os.path.basename(route_file))
+    tables = pickle.load(open(route_file, 'rb'))
+    return dict([(line_code, RouteTable(**table)) for (line_code, table) in tables.items()])
+
+
+def load_fastest_lines(filename):
+    """
+    Load the fastest lines between stations produced by datatools.py from filename in the database directory, and return them as a
+    dictionary keyed by origin station code, whose values are dictionaries of line codes keyed by destination station name. Returns an
+    empty dictionary if the file does not exist
+    """
+    lines_file = DB_PATH + '/' + filename
+    if not os.path.exists(lines_file):
+        logging.debug("No fastest lines found at %s", os.path.basename(lines_file))
+        return {}
+    logging.debug("Opening fastest lines %s", os.path.basename(lines_file))
+    return pickle.load(open(lines_file, 'rb'))
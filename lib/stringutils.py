@@ -29,6 +29,14 @@ def cleanup_name_from_undesirables(name, undesirables):
     return capwords(name)
 
 
+def normalise_placename(placename):
+    """
+    Normalise a placename for looking it up (e.g. in the geocode cache or the gazetteer), so that trivial differences in case,
+    punctuation and spacing (e.g. "Elephant & Castle" and "elephant  & castle") count as the same place
+    """
+    return re.sub(r'[^\w&]+', ' ', placename.lower(), flags=re.U).strip()
+
+
 def get_name_similarity(string1, string2):
     """
     Return a score between 0 and 100 of the strings' similarity, based on difflib's string similarity algorithm returning an integer
@@ -71,10 +79,18 @@ def gmt_to_localtime(date_and_time_string):
     The string is normally just hour and minute (e.g. "12:34") but if it is just before midnight GMT, then the
     string can possibly be "Tue 00:01" so we need to take this into account
     """
+    return "%02d%02d" % divmod(gmt_to_local_minutes(date_and_time_string), 60)
+
+
+def gmt_to_local_minutes(date_and_time_string, is_dst=None):
+    """
+    Takes a string of a possible GMT date/time, as for gmt_to_localtime(), and returns the local time as the number of minutes
+    past midnight. is_dst says whether British Summer Time is in operation; if not given, we ask the system
+    """
     time_string = date_and_time_string.split(' ')[-1]
     time_string = time_string.replace(':', '')
     hour = int(time_string[0:2])
     minute = int(time_string[2:4])
-    if localtime().tm_isdst:
+    if localtime().tm_isdst if is_dst is None else is_dst:
         hour = (hour + 1) % 24
-    return "%02d%02d" % (hour, minute)
+    return hour * 60 + minute
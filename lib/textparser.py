@@ -1,20 +1,27 @@
 #!/usr/bin/env python
-#pylint: disable=R0903,W0231,R0201
+#pylint: disable=R0903,R0201
 """
 Text parsing class for When's My Transport?
 """
-import cPickle as pickle
 import logging
 import os
+import re
 
+from lib.cache import LRUCache, lazy_property
 from lib.stringutils import capwords
 
-# http://www.nltk.org/download
-import nltk
-
 
 DB_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/../db/')
 
+# Splits a message into words, in the same way as nltk's WhitespaceTokenizer
+WHITESPACE = re.compile(r'\s+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+# First line of a tagger file, identifying its format
+TAGGER_FILE_HEADER = "WMTTAGGER 1\n"
+
+# Number of parsed messages to remember - many people send exactly the same request every day
+PARSE_CACHE_SIZE = 512
+
 
 class WMTTextParser():
     """
@@ -22,35 +29,47 @@ class WMTTextParser():
     """
     def __init__(self):
         # Parsing split into two roles: tagger (that identifies words and classifies them as a part of speech) and parser (that takes
-        # those tagged words and works out a parse tree for them). This gets overridden
-        self.tagger = None
+        # those tagged words and works out a parse tree for them). These get set by child classes
         self.parser = None
+        # Results of parsing, keyed on the lower-cased message (parsing ignores case)
+        self.parse_cache = LRUCache(PARSE_CACHE_SIZE)
 
     def parse_message(self, text):
         """
         Parses the text and returns a tuple of (routes, origin, destination). routes is a list of strings; origin and destination strings
         """
-        # Get tokens, tag them and remove any tagged with None
         logging.debug("Parsing message: '%s'", text)
         if not text:
             logging.debug("Message is empty, returning nothing")
             return (None, None, None, None)
-        tokenizer = nltk.tokenize.regexp.WhitespaceTokenizer()
-        tokens = tokenizer.tokenize(text.lower())
+        parsed_message = self.parse_cache.get(text.lower())
+        if parsed_message:
+            logging.debug("Message has been parsed before, using cached result")
+        else:
+            parsed_message = self.parse_uncached_message(text)
+            self.parse_cache[text.lower()] = parsed_message
+        return parsed_message
+
+    def parse_uncached_message(self, text):
+        """
+        Does the work of parse_message() for a non-empty text we have not seen before
+        """
+        # Get tokens, tag them and remove any tagged with None
+        tokens = [token for token in WHITESPACE.split(text.lower()) if token]
         tagged_tokens = [(word, tag) for (word, tag) in self.tagger.tag(tokens) if tag]
 
         # Some tags may be unknown type so we run a method on them to resolve such unknowns
         tagged_tokens = self.fix_unknown_tokens(tagged_tokens)
 
         # Parse the tree. If we cannot parse a legitimate request then return nothing
-        parsed_tokens = self.parser.parse(tagged_tokens)
-        if not subtree_exists(parsed_tokens, 'REQUEST'):
+        subtrees = get_subtrees(self.parser.parse(tagged_tokens))
+        if not [child for child in subtrees if child.node == 'REQUEST']:
             logging.debug("Message did not conform to message format, returning nothing")
             return (None, None, None, None)
 
         # Else extract the right tagged words from the parsed tree, applying capitalisation appropriately
         routes, origin, destination, direction = (None, None, None, None)
-        for child in parsed_tokens.subtrees():
+        for child in subtrees:
             if child.node == 'LINE_NAME':
                 routes = extract_words(child, ('TUBE_LINE_WORD', 'DLR_LINE_NAME', 'AND', 'CITY'))
                 routes = ' '.join(routes) or None
@@ -88,6 +107,7 @@ class WMTBusParser(WMTTextParser):
     Parser for bus requests
     """
     def __init__(self):
+        WMTTextParser.__init__(self)
         # Regexes for tagging parts of speech. Platitudes are ignored, and any word not matching is initially classified as Unknown
         tagging_regexes = [
             (r"^[0-9]{5}$", 'BUS_STOP_NUMBER'),
@@ -98,11 +118,11 @@ class WMTBusParser(WMTTextParser):
             (r'^the$', None),
             (r'.*', 'UNKNOWN'),
         ]
-        self.tagger = nltk.RegexpTagger(tagging_regexes)
+        self.tagger = WMTRegexpTagger(tagging_regexes)
 
         # Grammar for user requests - a route must be specified, followed by optional origin then optional destination
         # Alternatively, we can have destination then origin but in which case the destination must be specified with a "to" prefix
-        grammar = r"""
+        self.grammar = r"""
             BUS_ROUTES: {<ROUTE_NUMBER>+}
             BUS_STOP_PHRASE: {<BUS_STOP_WORD>+}
             BUS_STOP: {<BUS_STOP_PHRASE|BUS_STOP_NUMBER>}
@@ -111,7 +131,7 @@ class WMTBusParser(WMTTextParser):
             REQUEST: {^<BUS_ROUTES><ORIGIN>?<DESTINATION>?$}
                      {^<BUS_ROUTES><DESTINATION><ORIGIN>$}
         """
-        self.parser = nltk.RegexpParser(grammar)
+        self.parser = WMTChunkParser(self.grammar)
 
     def fix_unknown_tokens(self, tagged_tokens):
         """
@@ -138,13 +158,10 @@ class WMTTrainParser(WMTTextParser):
     Parser for train requests
     """
     def __init__(self):
-        # The tagger for WMT is so expensive to create, we prebuild it and load via pickle.
-        # Thus tagging regexes for trains are created in dataparser.py
-        self.tagger = pickle.load(open(DB_PATH + '/whensmytrain.tagger.obj'))
-
+        WMTTextParser.__init__(self)
         # Grammar for train requests consist of a line name, followed by optional origin then optional destination
         # Alternatively, we can have destination then origin but in which case the destination must be specified with a "to" prefix
-        grammar = r"""
+        self.grammar = r"""
             TUBE_LINE_NAME: {<TUBE_LINE_WORD><AND><CITY><LINE>?}
                             {<TUBE_LINE_WORD><LINE>?}
             LINE_NAME: {<DLR_LINE_NAME|TUBE_LINE_NAME>}
@@ -156,7 +173,15 @@ class WMTTrainParser(WMTTextParser):
                      {^<LINE_NAME>?<ORIGIN>?<DESTINATION>?$}
                      {^<LINE_NAME>?<DESTINATION><ORIGIN>$}
         """
-        self.parser = nltk.RegexpParser(grammar)
+        self.parser = WMTChunkParser(self.grammar)
+
+    @lazy_property
+    def tagger(self):
+        """
+        The tagger for WMT is so expensive to create, we prebuild its lookup tables in datatools.py and load them from a file. Thus
+        tagging regexes for trains are created in datatools.py. We only load it when we first have a message to parse
+        """
+        return load_tagger('whensmytrain.tagger.dat')
 
     def fix_unknown_tokens(self, tagged_tokens):
         """
@@ -201,28 +226,232 @@ def last_occurence_of_tag_chain(sequence, tag_type):
     return len(sequence)
 
 
-def subtree_exists(tree, subtree_node_name):
+def get_subtrees(tree):
     """
-    Checks to see if a subtree or node exists within a parsed tree
+    Returns a list of a parsed tree and all the subtrees within it, in the same order as nltk's Tree.subtrees()
     """
-    try:
-        tree.node
-    except AttributeError:
-        return tree[1] == subtree_node_name
-    else:
-        return tree.node == subtree_node_name or reduce(lambda a, b: a or b, [subtree_exists(child, subtree_node_name) for child in tree])
+    subtrees = []
+    stack = [tree]
+    while stack:
+        subtree = stack.pop()
+        subtrees.append(subtree)
+        stack += reversed([child for child in subtree if isinstance(child, list)])
+    return subtrees
 
 
 def extract_words(tree, word_types_to_return):
     """
     Extracts words of certain types from a parsed tree. Types to return is list or tuple of types
     """
-    try:
-        tree.node
-    except AttributeError:
-        if tree[1] in word_types_to_return:
-            return [tree[0]]
-        else:
-            return []
-    else:
-        return reduce(lambda a, b: a + b, [extract_words(child, word_types_to_return) for child in tree])
+    words = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack += reversed(node)
+        elif node[1] in word_types_to_return:
+            words.append(node[0])
+    return words
+
+
+class WMTRegexpTagger():
+    """
+    Tagger that tags each word with the tag for the first of a list of (regular expression, tag) pairs it matches, exactly as
+    nltk's RegexpTagger does
+    """
+    def __init__(self, tagging_regexes):
+        self.tagging_regexes = tagging_regexes
+        self.tags = dict([('g%s' % i, tag) for (i, (_regex, tag)) in enumerate(tagging_regexes)])
+        self.regex = re.compile('|'.join(['(?P<g%s>%s)' % (i, regex) for (i, (regex, _tag)) in enumerate(tagging_regexes)]))
+
+    def tag(self, tokens):
+        """
+        Takes a list of words and returns a list of (word, tag) tuples. Words that do not match any regex are tagged None
+        """
+        tagged_tokens = []
+        for token in tokens:
+            match = self.regex.match(token)
+            tagged_tokens.append((token, match and self.tags[match.lastgroup] or None))
+        return tagged_tokens
+
+
+class WMTBigramTagger():
+    """
+    Tagger that tags each word using lookup tables, exactly as nltk's BigramTagger with a UnigramTagger and RegexpTagger as backoffs
+    does. A word is tagged from the bigrams table, keyed on the tag of the word before it ('' for the first word) and the word itself;
+    failing that from the unigrams table, keyed on the word; and failing that with a WMTRegexpTagger
+    """
+    def __init__(self, bigrams, unigrams, tagging_regexes):
+        self.bigrams = bigrams
+        self.unigrams = unigrams
+        self.regexp_tagger = WMTRegexpTagger(tagging_regexes)
+
+    def tag(self, tokens):
+        """
+        Takes a list of words and returns a list of (word, tag) tuples. Words that do not match any regex are tagged None
+        """
+        (bigrams, unigrams, regex, regex_tags) = (self.bigrams, self.unigrams, self.regexp_tagger.regex, self.regexp_tagger.tags)
+        tags = []
+        tag = ''
+        for token in tokens:
+            tag = bigrams.get((tag, token)) or unigrams.get(token)
+            if not tag:
+                match = regex.match(token)
+                tag = match and regex_tags[match.lastgroup] or None
+            tags.append(tag)
+        return zip(tokens, tags)
+
+
+def save_tagger(bigrams, unigrams, tagging_regexes, filename):
+    """
+    Save the tables for a WMTBigramTagger to filename in the database directory
+
+    After the header, the file has one line for each entry of the tables, with tab-separated fields: "bigram", the previous tag, the
+    word and its tag; "unigram", the word and its tag; or "regex", the regex and its tag (empty for None). Regexes are kept in order
+    """
+    tagger_file = open(DB_PATH + '/' + filename, 'w')
+    tagger_file.write(TAGGER_FILE_HEADER)
+    for ((previous_tag, word), tag) in sorted(bigrams.items()):
+        tagger_file.write("bigram\t%s\t%s\t%s\n" % (previous_tag, word, tag))
+    for (word, tag) in sorted(unigrams.items()):
+        tagger_file.write("unigram\t%s\t%s\n" % (word, tag))
+    for (regex, tag) in tagging_regexes:
+        tagger_file.write("regex\t%s\t%s\n" % (regex, tag or ''))
+    tagger_file.close()
+
+
+def load_tagger(filename):
+    """
+    Load the tables produced by datatools.py from filename in the database directory, and return a WMTBigramTagger using them
+    """
+    logging.debug("Opening tagger %s", filename)
+    tagger_file = open(DB_PATH + '/' + filename)
+    if tagger_file.readline() != TAGGER_FILE_HEADER:
+        raise ValueError("%s is not a tagger file in a format we can read" % filename)
+    (bigrams, unigrams, tagging_regexes) = ({}, {}, [])
+    for line in tagger_file:
+        fields = line.rstrip('\n').split('\t')
+        if fields[0] == 'bigram':
+            bigrams[(fields[1], fields[2])] = fields[3]
+        elif fields[0] == 'unigram':
+            unigrams[fields[1]] = fields[2]
+        elif fields[0] == 'regex':
+            tagging_regexes.append((fields[1], fields[2] or None))
+    tagger_file.close()
+    return WMTBigramTagger(bigrams, unigrams, tagging_regexes)
+
+
+class WMTChunk(list):
+    """
+    A chunk of a parsed message - a list of tagged words and smaller chunks, with a node name. This behaves like nltk's Tree
+    """
+    def __init__(self, node, children):
+        list.__init__(self, children)
+        self.node = node
+
+    def __repr__(self):
+        return '(%s %s)' % (self.node, ' '.join([hasattr(child, 'node') and repr(child) or '%s/%s' % child for child in self]))
+
+
+class WMTChunkParser():
+    """
+    Purpose-built replacement for nltk's RegexpParser, which gives exactly the same parse trees for grammars made of chunk rules
+
+    The grammar is read the same way as RegexpParser's - each line of the form NAME: {<TAG_PATTERN>} is a stage of parsing; any
+    more {<TAG_PATTERN>} lines after it are extra rules for that stage. Each stage takes the sequence of tagged words and chunks made
+    so far, and makes every run of them matching one of its rules into a new chunk, named NAME
+
+    Rather than building a string of tags like "<ROUTE_NUMBER><FROM>" as nltk does, we give every tag a single-character code and
+    compile each rule into a regular expression over those codes, so matching each stage is a single pass of a small regex
+    """
+    # A match must not end inside an existing chunk, i.e. the next brace after it must be an opening one, or there must be none
+    IN_CHINK_PATTERN = r'(?=[^\}]*(\{|$))'
+    # Characters used to encode tags in the grammar; tags not in the grammar are all encoded as UNKNOWN_TAG_CODE
+    TAG_CODES = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    UNKNOWN_TAG_CODE = '#'
+
+    def __init__(self, grammar):
+        self.tag_codes = {}
+        self.stages = []
+        for line in grammar.split('\n'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = re.match(r'(\w+)\s*:\s*(.*)$', line)
+            if match:
+                (node, line) = match.groups()
+                self.get_tag_code(node)
+                self.stages.append((node, []))
+            if not self.stages or not (line.startswith('{') and line.endswith('}')):
+                raise ValueError('Illegal chunk rule: %s' % line)
+            self.stages[-1][1].append(re.compile('(?P<chunk>%s)%s' % (self.compile_tag_pattern(line[1:-1]), self.IN_CHINK_PATTERN)))
+
+    def get_tag_code(self, tag):
+        """
+        Return the single-character code for a tag, assigning it a new one if it does not have one yet
+        """
+        if tag not in self.tag_codes:
+            if len(self.tag_codes) == len(self.TAG_CODES):
+                raise ValueError('Too many tags in grammar')
+            self.tag_codes[tag] = self.TAG_CODES[len(self.tag_codes)]
+        return self.tag_codes[tag]
+
+    def compile_tag_pattern(self, tag_pattern):
+        """
+        Convert a tag pattern such as "^<ROUTE_NUMBER>+<FROM|TO>?" into a regular expression over our tag codes
+        """
+        def replace_tag(match):
+            """
+            Replace a <TAG> or <TAG|TAG...> with its code or a character class of their codes
+            """
+            codes = [self.get_tag_code(tag) for tag in match.group(1).split('|')]
+            return len(codes) == 1 and codes[0] or '[%s]' % ''.join(codes)
+        tag_pattern = re.sub(r'\s', '', tag_pattern)
+        regex = re.sub(r'<(\w+(?:\|\w+)*)>', replace_tag, tag_pattern)
+        if re.search(r'[<>{}.]', regex):
+            raise ValueError('Bad tag pattern: %s' % tag_pattern)
+        return regex
+
+    def parse(self, tagged_tokens):
+        """
+        Parse a list of (word, tag) tuples, and return a WMTChunk representing the parse tree
+        """
+        pieces = list(tagged_tokens)
+        codes = ''.join([self.tag_codes.get(tag, self.UNKNOWN_TAG_CODE) for (_word, tag) in pieces])
+        for (node, rules) in self.stages:
+            # Apply each rule in turn; as with nltk, chunks are marked by braces and empty chunks are thrown away
+            chunked_codes = codes
+            for rule in rules:
+                chunked_codes = rule.sub(add_braces, chunked_codes).replace('{}', '')
+            if chunked_codes == codes:
+                continue
+            # Turn the braced chunks into new WMTChunk objects, and work out the codes for the new sequence of pieces
+            node_code = self.tag_codes[node]
+            new_pieces = []
+            new_codes = []
+            chunk = None
+            position = 0
+            for code in chunked_codes:
+                if code == '{':
+                    chunk = WMTChunk(node, [])
+                    new_pieces.append(chunk)
+                    new_codes.append(node_code)
+                elif code == '}':
+                    chunk = None
+                elif chunk is not None:
+                    chunk.append(pieces[position])
+                    position += 1
+                else:
+                    new_pieces.append(pieces[position])
+                    new_codes.append(code)
+                    position += 1
+            pieces = new_pieces
+            codes = ''.join(new_codes)
+        return WMTChunk('S', pieces)
+
+
+def add_braces(match):
+    """
+    Wrap a regular expression match in braces, to mark it as a chunk
+    """
+    return '{' + match.group() + '}'
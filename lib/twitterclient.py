@@ -10,8 +10,9 @@ import logging
 import time
 from pprint import pprint
 
-# Tweepy is a Twitter API library available from https://github.com/tweepy/tweepy
-import tweepy
+# Tweepy is a Twitter API library available from https://github.com/tweepy/tweepy - it is imported by WMTTwitterClient.tweepy the
+# first time we talk to Twitter, so test runs, which never do, need not import it
+from lib.cache import lazy_property
 from lib.settings import WMTSettings
 
 
@@ -20,10 +21,7 @@ class WMTTwitterClient():
     A Twitter Client that fetches Tweets and manages follows for When's My Transport
     """
     def __init__(self, instance_name, consumer_key, consumer_secret, access_token, access_token_secret, testing=False):
-        logging.debug("Authenticating with Twitter")
-        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-        auth.set_access_token(access_token, access_token_secret)
-        self.api = tweepy.API(auth)
+        self.credentials = (consumer_key, consumer_secret, access_token, access_token_secret)
         self.settings = WMTSettings(instance_name)
         self.testing = testing
 
@@ -35,11 +33,29 @@ class WMTTwitterClient():
         if not self.testing:
             self.report_twitter_limit_status()
 
+    @lazy_property
+    def tweepy(self):
+        """
+        The Tweepy module, imported when we first need it
+        """
+        import tweepy
+        return tweepy
+
+    @lazy_property
+    def api(self):
+        """
+        Tweepy API object, authenticated with Twitter when we first use it
+        """
+        logging.debug("Authenticating with Twitter")
+        (consumer_key, consumer_secret, access_token, access_token_secret) = self.credentials
+        auth = self.tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, access_token_secret)
+        return self.tweepy.API(auth)
+
     def check_followers(self):
         """
         Check my followers. If any of them are not following me, try to follow them back
         """
-
         # Don't bother if we have run out of follower checks
         if not self.do_check_followers:
             return
@@ -73,7 +89,7 @@ class WMTTwitterClient():
             try:
                 person = self.api.create_friendship(twitter_id)
                 logging.info("Following user %s", person.screen_name)
-            except tweepy.error.TweepError:
+            except self.tweepy.error.TweepError:
                 protected_users_to_ignore.append(twitter_id)
                 logging.info("Error following user %s, most likely the account is protected", twitter_id)
                 continue
@@ -104,7 +120,7 @@ class WMTTwitterClient():
                 logging.info("Skipping DMs, endpoint exhausted")
                 direct_messages = []
 
-        except tweepy.error.TweepError, e:
+        except self.tweepy.error.TweepError, e:
             logging.error("Error: OAuth connection to Twitter failed, probably due to an invalid token")
             raise RuntimeError("Error: OAuth connection to Twitter failed, probably due to an invalid token")
 
@@ -126,7 +142,7 @@ class WMTTwitterClient():
         """
         try:
             limit_status = self.api.rate_limit_status()
-        except tweepy.error.TweepError as e:
+        except self.tweepy.error.TweepError as e:
             default_error = "Unknown Tweepy error"
             error = e.message and e.message[0].get('message', default_error) or default_error
             logging.info("Error checking Twitter API: %s" % error)
@@ -181,7 +197,7 @@ class WMTTwitterClient():
             # This catches any errors, most typically if we send multiple Tweets to the same person with the same content
             # - typically if the use sends the same bad request again and again, we will reply with same error
             # In which case, not much we can do about it, so we just ignore
-            except tweepy.error.TweepError:
+            except self.tweepy.error.TweepError:
                 continue
 
 
@@ -215,7 +231,9 @@ def is_direct_message(tweet):
     """
     Returns True if a Tweet object is that of Tweepy's Direct Message, False if any other kind
     """
-    return isinstance(tweet, tweepy.models.DirectMessage)
+    # If Tweepy has not been imported yet, the Tweet cannot have come from it
+    tweepy = sys.modules.get('tweepy')
+    return tweepy is not None and isinstance(tweet, tweepy.models.DirectMessage)
 
 
 def make_oauth_key(instance_name):
@@ -227,6 +245,7 @@ def make_oauth_key(instance_name):
     Log in as the user you want to authorise, visit the URL this script produces, then type in the PIN
     Twitter's OAuth servers provide you to get a key/secret pair
     """
+    import tweepy
     config = ConfigParser.SafeConfigParser()
     config.read('config.cfg')
 
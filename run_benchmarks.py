@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run performance benchmarks from our library
+"""
+import argparse
+import sys
+
+from tests import benchmarks
+
+
+def run_benchmarks():
+    """
+    Run some or all of the benchmarks for When's My Transport
+    """
+    parser = argparse.ArgumentParser(description="Performance benchmarks for When's My Transport?")
+    parser.add_argument("benchmark_names", action="store", nargs="*", default=benchmarks.benchmarks,
+                        help="Names of the benchmarks to run (default: all of them, which are: %s)" % ', '.join(benchmarks.benchmarks))
+    benchmark_names = parser.parse_args().benchmark_names
+
+    for benchmark_name in benchmark_names:
+        if benchmark_name not in benchmarks.benchmarks:
+            print "Error - %s is not a valid benchmark name" % benchmark_name
+            sys.exit(1)
+
+    for benchmark_name in benchmark_names:
+        print "Running benchmark %s" % benchmark_name
+        getattr(benchmarks, 'benchmark_%s' % benchmark_name)()
+        print ""
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#pylint: disable=C0103,W0142
+"""
+Performance benchmarks for When's My Bus? and When's My Tube?
+
+Each benchmark prints the time taken per call for one or more variations of the same task, so that the effect of an
+optimisation can be seen side by side with the slower way of doing things
+"""
+import time
+
+from tests.generic_tests import FakeTweet, get_test_message_corpus
+from whensmytransport import TESTING_TEST_LOCAL_DATA
+
+
+def time_function(function, repeats=10):
+    """
+    Call function repeats times and return the average time taken per call, in milliseconds
+    """
+    start = time.time()
+    for _i in range(0, repeats):
+        function()
+    return (time.time() - start) * 1000.0 / repeats
+
+
+def report(label, milliseconds, baseline=None):
+    """
+    Print the result of a benchmark, and the speed-up over a baseline time if one is given
+    """
+    if baseline:
+        print "  %-50s %10.3f ms  (x%0.1f)" % (label, milliseconds, baseline / milliseconds)
+    else:
+        print "  %-50s %10.3f ms" % (label, milliseconds)
+
+
+def benchmark_route_cache():
+    """
+    Time "to <destination>" requests from busy stations in our test data, searching the network graph with and without the
+    shortest path cache, and using the precomputed route tables
+    """
+    from whensmytrain import WhensMyTrain
+    bot = WhensMyTrain("whensmytube", testing=TESTING_TEST_LOCAL_DATA)
+    messages = ("District Line from Earl's Court to Edgware Road",
+                "Northern Line from Camden Town to Kennington",
+                "Victoria Line from Victoria to Walthamstow",
+                "Hammersmith and City Line from Liverpool St to Plaistow")
+    route_tables = bot.geodata.route_tables
+    cache_size = bot.geodata.shortest_paths.maximum_size
+
+    for message in messages:
+        tweet = FakeTweet('@%s %s' % (bot.username, message))
+        print message
+        bot.geodata.route_tables = {}
+        bot.geodata.shortest_paths.maximum_size = 0
+        bot.geodata.shortest_paths.clear()
+        uncached = time_function(lambda: bot.process_tweet(tweet))
+        report("Graph search, no cache", uncached)
+        bot.geodata.shortest_paths.maximum_size = cache_size
+        report("Graph search, shortest path cache", time_function(lambda: bot.process_tweet(tweet)), uncached)
+        bot.geodata.route_tables = route_tables
+        report("Precomputed route tables", time_function(lambda: bot.process_tweet(tweet)), uncached)
+
+
+def benchmark_network():
+    """
+    Time loading the network graphs, and a single-source shortest path search from a busy station on the whole network
+    """
+    from lib.network import load_network
+    report("Loading network graphs", time_function(lambda: load_network('whensmytrain.network.dat')))
+    network = load_network('whensmytrain.network.dat')
+    report("Shortest paths from Bank on all lines", time_function(lambda: network['All'].shortest_path('Bank:entrance')))
+
+
+def benchmark_direct_routes():
+    """
+    Time checking whether there is a direct route between every pair of stations on the Northern Line, by tracing the route through
+    the route tables and checking it (as we used to) and by looking the answer up in the route tables
+    """
+    from lib.locations import RailStationLocations
+    from lib.network import is_direct_path
+    geodata = RailStationLocations()
+    stations = [geodata.find_exact_match({'name': name, 'line': 'N'}) for name in sorted(geodata.route_tables['N'].station_ids)]
+    pairs = [(origin, destination) for origin in stations for destination in stations if origin != destination]
+    traced = time_function(lambda: [is_direct_path([stop[0] for stop in geodata.describe_route(origin, destination, 'N')]) for (origin, destination) in pairs], 3)
+    report("Tracing routes", traced)
+    report("Looking up route tables", time_function(lambda: [geodata.direct_route_exists(origin, destination, 'N') for (origin, destination) in pairs], 3), traced)
+
+
+def benchmark_train_filtering():
+    """
+    Time filtering a busy board of 100 Northern Line trains from Stockwell, going to 5 different destinations, to those that stop at
+    Euston - one train at a time, and in a batch
+    """
+    from lib.locations import RailStationLocations
+    from lib.models import TubeTrain
+    geodata = RailStationLocations()
+    find_station = lambda name: geodata.find_exact_match({'name': name, 'line': 'N'})
+    (stockwell, euston) = (find_station("Stockwell"), find_station("Euston"))
+    trains = []
+    for (destination, via) in (("High Barnet", "Bank"), ("Edgware", "Charing Cross"), ("Mill Hill East", "Bank"), ("Morden", None), ("Kennington", None)):
+        for minutes in range(0, 20):
+            train = TubeTrain("Unknown", "Northbound", "12%02d" % minutes, "N", "001")
+            (train.destination, train.via) = (find_station(destination), via and find_station(via))
+            trains.append(train)
+    one_by_one = time_function(lambda: [train for train in trains if geodata.does_train_stop_at(train, stockwell, euston)])
+    report("One train at a time", one_by_one)
+    report("In a batch", time_function(lambda: geodata.get_trains_stopping_at(trains, stockwell, euston)), one_by_one)
+
+
+def benchmark_coordinate_conversion():
+    """
+    Time converting 10,000 WGS84 positions across London to OS eastings & northings, one at a time and in a NumPy batch
+    """
+    import numpy
+    from lib.geo import convertWGS84toOSEastingNorthing, convertWGS84toOSEastingNorthingBatch
+    points = [(51.3 + 0.004 * i, -0.5 + 0.008 * j) for i in range(0, 100) for j in range(0, 100)]
+    (lats, lons) = (numpy.array([lat for (lat, lon) in points]), numpy.array([lon for (lat, lon) in points]))
+    one_by_one = time_function(lambda: [convertWGS84toOSEastingNorthing(lat, lon) for (lat, lon) in points], 3)
+    report("One point at a time", one_by_one)
+    report("In a batch", time_function(lambda: convertWGS84toOSEastingNorthingBatch(lats, lons), 3), one_by_one)
+
+
+def benchmark_grid_transform():
+    """
+    Time converting 10,000 WGS84 positions across London to OS eastings & northings, with the exact conversion and the fast
+    polynomial approximation
+    """
+    from lib.geo import convertWGS84toOSEastingNorthing, convertWGS84toOSEastingNorthingFast
+    points = [(51.3 + 0.004 * i, -0.5 + 0.008 * j) for i in range(0, 100) for j in range(0, 100)]
+    exact = time_function(lambda: [convertWGS84toOSEastingNorthing(lat, lon) for (lat, lon) in points], 3)
+    report("Exact conversion", exact)
+    report("Fast London transform", time_function(lambda: [convertWGS84toOSEastingNorthingFast(lat, lon) for (lat, lon) in points], 3), exact)
+
+
+def benchmark_textparser():
+    """
+    Time parsing every message in our tests with the bus and train parsers, using nltk's RegexpParser (and RegexpTagger for buses),
+    using our own compiled parser, and with every message already in the parse cache
+    """
+    import copy
+    import nltk
+    from lib.cache import LRUCache
+    from lib.textparser import WMTBusParser, WMTTrainParser
+    for parser in (WMTBusParser(), WMTTrainParser()):
+        # Leave out messages with no words the parser knows (e.g. blank ones), as nltk prints a warning for every one it is given
+        corpus = [message for message in get_test_message_corpus()
+                  if [tag for (_word, tag) in parser.tagger.tag(message.lower().split()) if tag]]
+        cached_parser = copy.copy(parser)
+        cached_parser.parse_cache = LRUCache(len(corpus))
+        parser.parse_cache = LRUCache(0)
+        nltk_parser = copy.copy(parser)
+        nltk_parser.parser = nltk.RegexpParser(parser.grammar)
+        if hasattr(parser.tagger, 'tagging_regexes'):
+            nltk_parser.tagger = nltk.RegexpTagger(parser.tagger.tagging_regexes)
+        print "%s, %s messages" % (parser.__class__.__name__, len(corpus))
+        nltk_time = time_function(lambda: [nltk_parser.parse_message(message) for message in corpus], 3)
+        report("nltk", nltk_time)
+        report("Compiled parser", time_function(lambda: [parser.parse_message(message) for message in corpus], 3), nltk_time)
+        [cached_parser.parse_message(message) for message in corpus]
+        report("Parse cache", time_function(lambda: [cached_parser.parse_message(message) for message in corpus], 3), nltk_time)
+
+
+def benchmark_tagger():
+    """
+    Time loading the train parser's tagger (in a fresh Python process, as the bot does) and tagging every message in our tests with
+    it, using the pickled nltk tagger and using our own tagger with flat lookup tables
+    """
+    import cPickle as pickle
+    import subprocess
+    import sys
+    from lib.textparser import DB_PATH, load_tagger
+    corpus = [message.lower().split() for message in get_test_message_corpus()]
+    load_in_new_process = lambda code: subprocess.call([sys.executable, '-c', 'from lib.textparser import *; %s' % code])
+    nltk_load = time_function(lambda: load_in_new_process("import cPickle; cPickle.load(open(DB_PATH + '/whensmytrain.tagger.obj'))"), 3)
+    report("Loading pickled nltk tagger", nltk_load)
+    report("Loading lookup tables", time_function(lambda: load_in_new_process("load_tagger('whensmytrain.tagger.dat')"), 3), nltk_load)
+    (nltk_tagger, tagger) = (pickle.load(open(DB_PATH + '/whensmytrain.tagger.obj')), load_tagger('whensmytrain.tagger.dat'))
+    nltk_time = time_function(lambda: [nltk_tagger.tag(tokens) for tokens in corpus], 3)
+    report("Tagging with nltk", nltk_time)
+    report("Tagging with lookup tables", time_function(lambda: [tagger.tag(tokens) for tokens in corpus], 3), nltk_time)
+
+
+def benchmark_models():
+    """
+    Time creating a BusStop for every stop in our database (as fuzzy matching does for all the stops on a route) and 1,000 TubeTrains,
+    and report how much memory each object takes with __slots__, compared to an old-style object holding the same attributes in an
+    instance dictionary. Also time normalising bus stop names, and using names precomputed by datatools instead, and cleaning up every
+    destination name TrackerNet has been known to give, and looking them up once done
+    """
+    import sys
+    from lib.database import WMTDatabase
+    from lib.locations import BusStopLocations
+    from lib.models import BusStop, TubeTrain, TUBE_DESTINATIONS, get_tube_destination_and_via
+
+    class DictionaryInstance:
+        """
+        Old-style object, that keeps its attributes in an instance dictionary
+        """
+        #pylint: disable=R0903
+        pass
+
+    def get_sizes(model):
+        """
+        Return a tuple of the size in bytes of the model, and the size of a DictionaryInstance with the same attributes
+        """
+        dictionary_instance = DictionaryInstance()
+        for cls in model.__class__.__mro__:
+            for attribute in getattr(cls, '__slots__', ()):
+                setattr(dictionary_instance, attribute, getattr(model, attribute))
+        return (sys.getsizeof(model), sys.getsizeof(dictionary_instance) + sys.getsizeof(dictionary_instance.__dict__))
+
+    rows = BusStopLocations().database.get_rows("SELECT * FROM locations")
+    report("Creating %s BusStops" % len(rows), time_function(lambda: [BusStop(**row) for row in rows], 3))
+    report("Creating 1000 TubeTrains", time_function(lambda: [TubeTrain("Edgware via CX", "Northbound", "12%02d" % (i % 60), "N", "001")
+                                                             for i in range(0, 1000)], 3))
+    for model in (BusStop(**rows[0]), TubeTrain("Edgware via CX", "Northbound", "1200", "N", "001")):
+        (size, dictionary_size) = get_sizes(model)
+        print "  %-50s %7s bytes" % ("%s with instance dictionary" % model.__class__.__name__, dictionary_size)
+        print "  %-50s %7s bytes  (x%0.1f)" % ("%s with __slots__" % model.__class__.__name__, size, float(dictionary_size) / size)
+
+    # Names precomputed by datatools are read from the database if it has them; we give them in here so this works either way
+    precomputed_rows = [dict(row, normalised_name=BusStop(row['name']).get_normalised_name()) for row in rows[:5000]]
+    computed = time_function(lambda: [BusStop(**row).get_normalised_name() for row in rows[:5000]], 3)
+    report("Normalising names of 5000 BusStops", computed)
+    report("Using precomputed normalised names", time_function(lambda: [BusStop(**row).get_normalised_name() for row in precomputed_rows], 3),
+           computed)
+
+    destination_names = [row[0] for row in WMTDatabase("whensmytube.destinationcodes.db").get_rows("SELECT destination_name FROM destination_codes")]
+    uncached = time_function(lambda: TUBE_DESTINATIONS.clear() or [get_tube_destination_and_via(name) for name in destination_names])
+    report("Cleaning up %s destination names" % len(destination_names), uncached)
+    report("Looking up cleaned-up destination names", time_function(lambda: [get_tube_destination_and_via(name) for name in destination_names]), uncached)
+
+
+def benchmark_departure_boards():
+    """
+    Time building the departure boards for every Tube station, DLR station and bus stop in our test data, from already-fetched data
+    """
+    import glob
+    import os.path
+    from xml.etree.ElementTree import fromstring
+    from lib.browser import WMTBrowser
+    from lib.clock import WMTClock
+    from lib.dataparsers import parse_bus_data, parse_dlr_data, parse_tube_data
+    from lib.models import RailStation
+    from whensmytransport import HOME_DIR
+    browser = WMTBrowser()
+    # As the bots do, take the time once per request rather than once per departure
+    clock = WMTClock()
+    get_name = lambda filename: os.path.splitext(os.path.basename(filename))[0]
+    tube_boards = [(browser.fetch_url("file://" + filename, 'tfl_server_down'), get_name(filename).split('-'))
+                   for filename in glob.glob(HOME_DIR + '/tests/data/tube/*-*.xml')]
+    dlr_boards = [(browser.fetch_xml_tree("file://" + filename), get_name(filename)) for filename in glob.glob(HOME_DIR + '/tests/data/dlr/*.xml')]
+    bus_boards = [browser.fetch_json("file://" + filename) for filename in glob.glob(HOME_DIR + '/tests/data/bus/*.json')]
+    bus_boards = [(bus_data, route) for bus_data in bus_boards for route in set([arrival['routeName'] for arrival in bus_data.get('arrivals', [])])]
+
+    # Tube boards used to be parsed into ElementTrees before we went through them; now we go through the XML as a stream, so give the
+    # time taken to build the trees alone for comparison
+    tree_building = time_function(lambda: [fromstring(tube_data) for (tube_data, _codes) in tube_boards], 20)
+    report("Building trees of %s Tube boards" % len(tube_boards), tree_building)
+    report("%s Tube boards" % len(tube_boards), time_function(lambda: [parse_tube_data(tube_data, RailStation(code=code), line_code, clock)
+                                                                       for (tube_data, (line_code, code)) in tube_boards], 20), tree_building)
+    report("%s DLR boards" % len(dlr_boards), time_function(lambda: [parse_dlr_data(dlr_data, RailStation(code=code), clock)
+                                                                     for (dlr_data, code) in dlr_boards], 20))
+    report("%s bus boards" % len(bus_boards), time_function(lambda: [parse_bus_data(bus_data, route, clock) for (bus_data, route) in bus_boards], 20))
+    departures = [train for (tube_data, (line_code, code)) in tube_boards
+                  for trains in parse_tube_data(tube_data, RailStation(code=code), line_code, clock).departure_data.values() for train in trains]
+    report("Sorting & formatting %s Tube trains" % len(departures), time_function(lambda: [departure.get_departure_time()
+                                                                                          for departure in sorted(departures)], 20))
+
+
+def benchmark_departure_collection():
+    """
+    Time adding 5,000 departures to a DepartureCollection, one at a time as the data parsers do, compared to copying the slot's list
+    each time, and then merging its slots as we do for DLR platforms. Then time merging the slots of the DLR boards in our test data,
+    which works out each slot's destinations afresh, alongside rendering the same boards for scale
+    """
+    from datetime import datetime
+    from lib.clock import WMTClock
+    from lib.models import DepartureCollection, Train
+    from tests.generic_tests import get_test_departure_collections
+    trains = [Train("Platform %s Terminus" % (i % 4), "%02d%02d" % divmod(i % 1440, 60)) for i in range(0, 5000)]
+
+    def add_by_copying():
+        """
+        Add each train to its slot by making a new list with it on the end, as add_to_slot() used to
+        """
+        departures = DepartureCollection()
+        for (i, train) in enumerate(trains):
+            departures.departure_data["P%s" % (i % 4)] = departures.departure_data.get("P%s" % (i % 4), []) + [train]
+        return departures
+
+    def add_in_place():
+        """
+        Add each train to its slot with add_to_slot()
+        """
+        departures = DepartureCollection()
+        for (i, train) in enumerate(trains):
+            departures.add_to_slot("P%s" % (i % 4), train)
+        return departures
+
+    copying = time_function(add_by_copying, 3)
+    report("Adding %s departures by copying" % len(trains), copying)
+    report("Adding %s departures in place" % len(trains), time_function(add_in_place, 3), copying)
+    report("Adding %s departures in place & merging slots" % len(trains), time_function(lambda: add_in_place().merge_common_slots(), 3))
+
+    # Merge each board once first, so every timed merge has the same slots to compare
+    boards = [departures for (label, departures) in get_test_departure_collections(WMTClock(datetime(2013, 8, 29, 21, 0), True))
+              if label.startswith("dlr/")]
+    [departures.merge_common_slots() for departures in boards]
+    report("Merging slots of %s DLR boards" % len(boards), time_function(lambda: [departures.merge_common_slots() for departures in boards], 100))
+    report("Rendering the same boards", time_function(lambda: [str(departures) for departures in boards], 100))
+
+
+def benchmark_rendering():
+    """
+    Time rendering the departure boards for every Tube station, DLR station and bus stop in our test data as they would be Tweeted,
+    as we used to (grouping by destination with nested loops, sorting with cmp and abbreviating each station name every time it
+    is used), in a single pass abbreviating every station name afresh, and in a single pass with the abbreviated names remembered
+    """
+    from datetime import datetime
+    from lib.clock import WMTClock
+    from lib.listutils import unique_values
+    from lib.models import ABBREVIATED_STATION_NAMES, BusStop
+    from tests.generic_tests import get_test_departure_collections
+    collections = [departures for (_label, departures) in get_test_departure_collections(WMTClock(datetime(2013, 8, 29, 21, 0), True))]
+
+    def get_destination(departure):
+        """
+        Return departure's abbreviated destination, abbreviating it afresh as we used to
+        """
+        ABBREVIATED_STATION_NAMES.clear()
+        return departure.get_destination(True)
+
+    def render_as_before(departure_collection):
+        """
+        Render departure_collection as DepartureCollection.__str__() used to
+        """
+        if not departure_collection.departure_data:
+            return ""
+        departures_output = {}
+        for slot in sorted(departure_collection.departure_data.keys()):
+            departures = unique_values(sorted(departure_collection.departure_data[slot]))[:5]
+            destinations = unique_values([get_destination(departure) for departure in departures])
+            departures_by_destination = {}
+            for destination in destinations:
+                departures_by_destination[destination] = [departure.get_departure_time() for departure in departures
+                                                          if get_destination(departure) == destination]
+            sort_earliest_departure_first = lambda (destination1, times1), (destination2, times2): cmp(times1[0], times2[0])
+            destinations_and_times = sorted(departures_by_destination.items(), sort_earliest_departure_first)
+            departures_for_this_slot = ["%s %s" % (destination, ' '.join(times[:3])) for (destination, times) in destinations_and_times]
+            departures_output[slot] = ', '.join([departure.strip() for departure in departures_for_this_slot])
+            if isinstance(slot, BusStop) and not departures_output[slot].startswith("None shown"):
+                departures_output[slot] = "%s to %s" % (slot.get_clean_name(), departures_output[slot])
+        return '; '.join([departures_output[slot] for slot in sorted(departures_output.keys())])
+
+    assert [render_as_before(departures) for departures in collections] == [str(departures) for departures in collections]
+    before = time_function(lambda: [render_as_before(departures) for departures in collections], 100)
+    report("Rendering %s boards as before" % len(collections), before)
+    uncached = time_function(lambda: [ABBREVIATED_STATION_NAMES.clear() or str(departures) for departures in collections], 100)
+    report("Rendering in a single pass", uncached, before)
+    report("Rendering with abbreviated names cached", time_function(lambda: [str(departures) for departures in collections], 100), before)
+
+
+def benchmark_startup():
+    """
+    Time importing each of the bots from cold, in a fresh Python process each time, and report the slowest modules they import
+    """
+    import subprocess
+    import sys
+    for module_name in ('whensmybus', 'whensmytrain'):
+        subprocess.call([sys.executable, '-m', 'tests.importtimes', module_name])
+
+# Definition of which benchmarks to run, and in which order
+benchmarks = ('route_cache', 'network', 'direct_routes', 'train_filtering', 'coordinate_conversion', 'grid_transform', 'textparser',
+              'tagger', 'models', 'departure_boards', 'departure_collection', 'rendering', 'startup')
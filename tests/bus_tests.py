@@ -114,6 +114,29 @@ class WhensMyBusTestCase(WhensMyTransportTestCase):
         self.assertFalse(self.bot.geodata.database.check_existence_of('locations', 'bus_stop_code', '47000'))
         self.assertEqual(self.bot.geodata.database.get_max_value('locations', 'run', {}), 6)
 
+        # Test stops found for a name are remembered, so repeated requests skip fuzzy matching
+        self.bot.location_cache.clear()
+        stops = self.bot.get_stops_by_stop_name('15', 'Limehouse Town Hall')
+        hits = self.bot.location_cache.hits
+        self.assertEqual(self.bot.get_stops_by_stop_name('15', 'Limehouse Town Hall'), stops)
+        self.assertEqual(self.bot.location_cache.hits, hits + 1)
+
+        # Test finding the closest stop to any of several points on each run gives the same answer as doing each point and run in turn
+        points = [(51.5124, -0.0397), (51.5106, -0.0851), (51.5148, -0.1415)]
+        closest_stops = self.bot.geodata.find_closest_in_each_group(points, {'route': '15'}, 'run')
+        for run in (1, 2):
+            stops = [self.bot.geodata.find_closest(point, {'route': '15', 'run': run}) for point in points]
+            self.assertEqual(closest_stops[run].number, min(stops).number)
+            self.assertAlmostEqual(closest_stops[run].distance_away, min(stops).distance_away)
+
+        # Test the local gazetteer finds places from the bus stop and station names, without needing the network
+        geocoder = self.bot.local_geocoder
+        points = geocoder.parse_geodata(geocoder.get_geocode_url("Blackfriars  Station"))
+        self.assertEqual(len(points), 1)
+        self.assertAlmostEqual(points[0][0], 51.5116, places=2)
+        self.assertAlmostEqual(points[0][1], -0.1036, places=2)
+        self.assertFalse(geocoder.parse_geodata(geocoder.get_geocode_url("qwerty")))
+
     def test_no_bus_number(self):
         """
         Test to confirm we are ignoring Tweets that do not have bus numbers in them
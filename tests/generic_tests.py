@@ -10,21 +10,44 @@ if sys.version_info < (2, 7):
     print "Please upgrade!"
     sys.exit(1)
 
+import ast
+import copy
+import cPickle as pickle
+from datetime import datetime
+import glob
 import logging
 import os.path
 import random
 import re
+import threading
 import time
+import types
 import unittest
 
+# NumPy is optional, only used for converting co-ordinates in bulk
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Abort if a dependency is not installed
 try:
-    from lib.dataparsers import parse_bus_data, parse_tube_data, parse_dlr_data
+    from lib.browser import WMTBrowser
+    from lib.cache import LRUCache, lazy_property
+    from lib.clock import WMTClock
+    from lib.dataparsers import parse_bus_data, parse_tube_data, parse_dlr_data, filter_tube_train
+    from lib.database import DB_PATH
     from lib.exceptions import WhensMyTransportException
+    from lib.geocache import WMTGeocodeCache
     from lib.geo import heading_to_direction, gridrefNumToLet, convertWGS84toOSEastingNorthing, LatLongToOSGrid, convertWGS84toOSGB36
+    from lib.geo import convertWGS84toOSEastingNorthingBatch, LatLongToOSGridBatch, convertWGS84toOSGB36Batch
+    from lib.geo import convertWGS84toOSEastingNorthingFast, convertOSEastingNorthingtoWGS84
+    from lib.geo import BaseGeocoder, GoogleGeocoder, RacingGeocoder, is_in_uk
     from lib.listutils import unique_values
     from lib.models import Location, RailStation, BusStop, Departure, NullDeparture, Train, TubeTrain, DLRTrain, Bus, DepartureCollection
+    from lib.models import TUBE_DESTINATIONS, get_tube_destination_and_via, ABBREVIATED_STATION_NAMES, get_abbreviated_station_name
     from lib.stringutils import capwords, get_name_similarity, get_best_fuzzy_match, cleanup_name_from_undesirables, gmt_to_localtime
+    from lib.stringutils import gmt_to_local_minutes, normalise_placename
     from lib.twitterclient import split_message_for_twitter
 
     from whensmytrain import LINE_NAMES, get_line_code, get_line_name
@@ -38,7 +61,6 @@ Sorry, testing failed because a package that WhensMyTransport depends on is not
 
 Missing packages can be downloaded as follows:
 
- * nltk: http://nltk.github.com/install.html
  * pygraph: http://code.google.com/p/python-graph/
  * tweepy: http://code.google.com/p/tweepy/
 """ % err
@@ -48,6 +70,49 @@ Missing packages can be downloaded as follows:
 HOME_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+def get_test_message_corpus():
+    """
+    Return a list of every string in our test scripts, to use as a corpus of messages for testing and benchmarking the text parsers.
+    Strings with %s in them are templates, so we fill them in with a variety of routes, places and directions
+    """
+    fillers = ('15', 'A1 25', 'Victoria', 'Victoria Line', 'DLR', 'Hammersmith and City', 'Sloane Square', 'from Hoxton', 'to Upminster',
+               'Eastbound', 'Elephant & Castle', '47000')
+    corpus = []
+    for filename in sorted(glob.glob(HOME_DIR + '/*_tests.py')):
+        for node in ast.walk(ast.parse(open(filename).read())):
+            if isinstance(node, ast.Str) and '\n' not in node.s:
+                corpus.append(node.s)
+                if '%s' in node.s:
+                    corpus += [node.s.replace('%s', filler, 1).replace('%s', filler2) for filler in fillers for filler2 in fillers[::-1]]
+    return sorted(set(corpus))
+
+
+def get_test_departure_collections(clock):
+    """
+    Return a list of (label, DepartureCollection) tuples, one for every Tube station, DLR station and bus stop in our test data,
+    with their departures judged against the WMTClock clock. Bus stops have a slot for each route that serves them
+    """
+    browser = WMTBrowser()
+    get_name = lambda filename: os.path.splitext(os.path.basename(filename))[0]
+    collections = []
+    for filename in sorted(glob.glob(HOME_DIR + '/data/tube/*-*.xml')):
+        (line_code, code) = get_name(filename).split('-')
+        collections.append(("tube/" + get_name(filename),
+                            parse_tube_data(browser.fetch_url("file://" + filename, 'tfl_server_down'), RailStation(code=code), line_code, clock)))
+    for filename in sorted(glob.glob(HOME_DIR + '/data/dlr/*.xml')):
+        collections.append(("dlr/" + get_name(filename),
+                            parse_dlr_data(browser.fetch_xml_tree("file://" + filename), RailStation(code=get_name(filename)), clock)))
+    for filename in sorted(glob.glob(HOME_DIR + '/data/bus/*.json')):
+        bus_data = browser.fetch_json("file://" + filename)
+        departures = DepartureCollection()
+        for (run, route_number) in enumerate(sorted(set([arrival['routeName'] for arrival in bus_data.get('arrivals', [])]))):
+            departures[BusStop("Stop %s Route %s" % (get_name(filename), route_number), distance=run, run=run)] = \
+                parse_bus_data(bus_data, route_number, clock)
+        departures.cleanup(lambda stop: NullDeparture("West", clock))
+        collections.append(("bus/" + get_name(filename), departures))
+    return collections
+
+
 class FakeTweet:
     """
     Fake Tweet object to simulate tweepy's Tweet object being passed to various functions
@@ -143,11 +208,117 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(LatLongToOSGrid(*osgb36), easting_northing)
         self.assertEqual(convertWGS84toOSEastingNorthing(*wgs84), easting_northing)
         self.assertEqual(gridrefNumToLet(*easting_northing), gridref)
+        for (value, expected_value) in zip(convertOSEastingNorthingtoWGS84(*easting_northing), wgs84):
+            self.assertAlmostEqual(value, expected_value, places=5)
+
+        # Test batch co-ordinate conversions agree with the above on a spread of points across London, if NumPy is installed
+        if numpy:
+            points = [(51.5 + 0.0123 * i, -0.5 + 0.0247 * j) for i in range(-20, 20) for j in range(0, 40)] + [wgs84]
+            (lats, lons) = (numpy.array([lat for (lat, lon) in points]), numpy.array([lon for (lat, lon) in points]))
+            (new_lats, new_lons, _heights) = convertWGS84toOSGB36Batch(lats, lons)
+            (eastings, northings) = LatLongToOSGridBatch(new_lats, new_lons)
+            self.assertEqual(zip(eastings, northings), [convertWGS84toOSEastingNorthing(*point) for point in points])
+            for (point, new_lat, new_lon) in zip(points, new_lats, new_lons):
+                self.assertAlmostEqual(convertWGS84toOSGB36(*point)[0], new_lat, places=6)
+                self.assertAlmostEqual(convertWGS84toOSGB36(*point)[1], new_lon, places=6)
+            self.assertEqual(zip(*convertWGS84toOSEastingNorthingBatch(lats, lons)), zip(eastings, northings))
+
+        # Test the fast London transform is within a metre of the exact conversion inside its box, and the same outside it
+        self.assertEqual(convertWGS84toOSEastingNorthingFast(*wgs84), easting_northing)
+        for point in [(51.21 + 0.0119 * i, -0.64 + 0.0217 * j) for i in range(0, 50) for j in range(0, 50)]:
+            (exact_easting, exact_northing) = convertWGS84toOSEastingNorthing(*point)
+            (fast_easting, fast_northing) = convertWGS84toOSEastingNorthingFast(*point)
+            self.assertLessEqual(abs(exact_easting - fast_easting), 1)
+            self.assertLessEqual(abs(exact_northing - fast_northing), 1)
+        for point in ((52.2053, 0.1218), (51.4545, -2.5879), (51.5, 0.6), (51.9, -0.1)):
+            self.assertEqual(convertWGS84toOSEastingNorthingFast(*point), convertWGS84toOSEastingNorthing(*point))
+
+        # Test racing geocoders returns the quickest answer in the UK, and keeps count of which geocoder won
+        class FakeGeocoder(BaseGeocoder):
+            """
+            Geocoder that waits for delay seconds and then answers with the points given, or fails if points is None
+            """
+            def __init__(self, delay, points):
+                BaseGeocoder.__init__(self)
+                (self.delay, self.points) = (delay, points)
+
+            def geocode(self, placename, browser):
+                """
+                Pretend to look up placename
+                """
+                time.sleep(self.delay)
+                if self.points is None:
+                    raise WhensMyTransportException('geocoder_server_down')
+                return self.points
+        (SlowGeocoder, FastGeocoder, EmptyGeocoder, ParisGeocoder) = [types.ClassType(name, (FakeGeocoder,), {})
+                                                                      for name in ('SlowGeocoder', 'FastGeocoder', 'EmptyGeocoder', 'ParisGeocoder')]
+        geocoders = [SlowGeocoder(0.1, [(51.5, -0.1)]), FastGeocoder(0.01, [wgs84]), EmptyGeocoder(0, []), ParisGeocoder(0, [(48.86, 2.35)])]
+        racing_geocoder = RacingGeocoder(geocoders)
+        self.assertEqual(racing_geocoder.geocode("St James's Park", None), [wgs84])
+        self.assertEqual(racing_geocoder.geocode("St James's Park", None), [wgs84])
+        self.assertEqual(RacingGeocoder(geocoders[0:1] + geocoders[2:]).geocode("St James's Park", None), [(51.5, -0.1)])
+        self.assertEqual(RacingGeocoder(geocoders[2:]).geocode("St James's Park", None), [])
+        self.assertRaises(WhensMyTransportException, RacingGeocoder([FakeGeocoder(0, None)]).geocode, "St James's Park", None)
+        self.assertRaises(WhensMyTransportException, RacingGeocoder([FakeGeocoder(0.1, [wgs84])], timeout=0.01).geocode, "St James's Park", None)
+        self.assertEqual(racing_geocoder.get_win_rates()['FastGeocoder'], 1.0)
+        self.assertEqual(racing_geocoder.get_win_rates()['EmptyGeocoder'], 0.0)
+        self.assertGreater(racing_geocoder.get_mean_latencies()['FastGeocoder'], 0.01)
+
+        # Test geocoders build their query URLs without changing their own parameters, so they can be shared between threads
+        google_geocoder = GoogleGeocoder()
+        self.assertIn('Camberwell', google_geocoder.get_geocode_url(u"Camberwell"))
+        self.assertNotIn('address', google_geocoder.params)
+        self.assertTrue(is_in_uk(*wgs84))
+        self.assertFalse(is_in_uk(48.86, 2.35))
 
         # Test heading_to_direction with a series of preset values
         for (heading, direction) in ((0, "North"), (90, "East"), (135, "SE"), (225, "SW"),):
             self.assertEqual(heading_to_direction(heading), direction)
 
+    def test_cache(self):
+        """
+        Unit test for caching utilities
+        """
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used item and so gets evicted
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # A cache of zero size never holds anything
+        cache = LRUCache(0)
+        cache['a'] = 1
+        self.assertNotIn('a', cache)
+
+        # Lazy properties are only worked out once, on first use, even if used from several threads at once
+        class LazyObject():
+            """
+            Object that counts how often its lazy property has been computed
+            """
+            calls = []
+
+            @lazy_property
+            def value(self):
+                """
+                Slow-to-compute value
+                """
+                time.sleep(0.01)
+                self.calls.append(1)
+                return len(self.calls)
+        lazy_object = LazyObject()
+        self.assertEqual(LazyObject.calls, [])
+        threads = [threading.Thread(target=lambda: lazy_object.value) for _i in range(0, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lazy_object.value, 1)
+        self.assertEqual(LazyObject.calls, [1])
+
     def test_listutils(self):
         """
         Unit test for listutils methods
@@ -174,6 +345,10 @@ class WhensMyTransportTestCase(unittest.TestCase):
             self.assertNotEqual(test_string.lower(), capwords(test_string))
             self.assertNotEqual(test_string.upper(), capwords(test_string))
 
+        # Check placename normalisation
+        self.assertEqual(normalise_placename(" Elephant  & Castle!"), "elephant & castle")
+        self.assertEqual(normalise_placename("St. John's  Wood"), "st john s wood")
+
         # Check to see cleanup string is working
         random_string = lambda a, b: "".join([chr(random.Random().randint(a, b)) for _i in range(0, 10)])
         dirty_strings = [random_string(48, 122) for _i in range(0, 10)]
@@ -201,10 +376,14 @@ class WhensMyTransportTestCase(unittest.TestCase):
             self.assertEqual(gmt_to_localtime("2359"), "0059")
             self.assertEqual(gmt_to_localtime("23:59"), "0059")
             self.assertEqual(gmt_to_localtime("Tue 00:01"), "0101")
+            self.assertEqual(gmt_to_local_minutes("Tue 00:01"), 61)
         else:
             self.assertEqual(gmt_to_localtime("2359"), "2359")
             self.assertEqual(gmt_to_localtime("23:59"), "2359")
             self.assertEqual(gmt_to_localtime("Tue 00:01"), "0001")
+            self.assertEqual(gmt_to_local_minutes("Tue 00:01"), 1)
+        self.assertEqual(gmt_to_local_minutes("23:59", is_dst=True), 59)
+        self.assertEqual(gmt_to_local_minutes("23:59", is_dst=False), 23 * 60 + 59)
 
     def test_tubeutils(self):
         """
@@ -247,12 +426,20 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(bus_stop2.get_similarity("Charing Cross Station"), 95)
         self.assertEqual(bus_stop.get_similarity("Charing Cross"), 90)
         self.assertEqual(bus_stop2.get_similarity("Charing Cross"), 91)
+        # Names precomputed by datatools are used in preference to working them out
+        stored_bus_stop = BusStop("TRAFALGAR SQUARE / CHARING CROSS STATION <> # [DLR] >T<", clean_name="Trafalgar Sq", normalised_name="TSQ")
+        self.assertEqual(stored_bus_stop.get_clean_name(), "Trafalgar Sq")
+        self.assertEqual(stored_bus_stop.get_normalised_name(), "TSQ")
+        self.assertEqual(bus_stop.clean_name, "Trafalgar Square / Charing Cross Station")
 
         # RailStation complex functions
         station = RailStation("King's Cross St. Pancras", "KXX", 530237, 182944)
         station2 = RailStation("Earl's Court", "ECT")
         self.assertEqual(station.get_abbreviated_name(), "Kings X St P")
         self.assertEqual(station2.get_abbreviated_name(), "Earls Ct")
+        self.assertEqual(get_abbreviated_station_name("King's Cross St. Pancras"), "Kings X St P")
+        self.assertIn("King's Cross St. Pancras", ABBREVIATED_STATION_NAMES)
+        self.assertEqual(RailStation("King's Cross St. Pancras", abbreviated_name="KX").get_abbreviated_name(), "KX")
         self.assertEqual(station.get_similarity(station.name), 100)
         self.assertGreaterEqual(station.get_similarity("Kings Cross St Pancras"), 95)
         self.assertGreaterEqual(station.get_similarity("Kings Cross St Pancreas"), 90)
@@ -266,6 +453,17 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(str(departure), "Trafalgar Square 2359")
         self.assertEqual(departure.get_destination(), "Trafalgar Square")
         self.assertEqual(departure.get_departure_time(), "2359")
+        # Times are kept as minutes past midnight, and can be given as such
+        self.assertEqual(departure, Departure("Trafalgar Square", 23 * 60 + 59))
+        self.assertEqual(Departure("Trafalgar Square", 5).get_departure_time(), "0005")
+        # Departures made against a frozen clock are judged by that time, not the time now
+        late_clock = WMTClock(datetime(2013, 8, 29, 23, 30), False)
+        self.assertEqual(late_clock.minutes, 23 * 60 + 30)
+        self.assertLess(Departure("Trafalgar Square", "2359", late_clock), Departure("Trafalgar Square", "0001", late_clock))
+        self.assertEqual(Departure("Trafalgar Square", "0001", late_clock).get_departure_time(), "0001")
+        early_clock = WMTClock(datetime(2013, 8, 29, 0, 30), False)
+        self.assertGreater(Departure("Trafalgar Square", "2359", early_clock), Departure("Trafalgar Square", "0001", early_clock))
+        self.assertEqual(NullDeparture("East", late_clock).departure_time, late_clock.minutes)
 
         # NullDeparture
         null_departure = NullDeparture("East")
@@ -295,11 +493,19 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(tube_train4.get_destination(), "Heathrow Terminal 5")
         self.assertEqual(tube_train.get_destination_no_via(), "Charing Cross")
         self.assertEqual(tube_train.get_via(), "Bank")
+        self.assertEqual(TUBE_DESTINATIONS["Charing Cross via Bank then depot"], ("Charing Cross", "Bank"))
+        self.assertEqual(get_tube_destination_and_via("Charing Cross via Bank then depot"), ("Charing Cross", "Bank"))
 
         # DLRTrain
         dlr_train = DLRTrain("Beckton", "1200")
         self.assertEqual(dlr_train.line_code, "DLR")
 
+        # Models are kept small with __slots__, so have no instance dictionary. Stations compare by name & code, and are not hashable
+        for model in (location, bus_stop, station, departure, null_departure, bus, train, tube_train, dlr_train):
+            self.assertFalse(hasattr(model, '__dict__'))
+        self.assertEqual(station, RailStation("King's Cross St. Pancras", "KXX"))
+        self.assertRaises(TypeError, hash, station)
+
         # DepartureCollection fundamentals
         departures = DepartureCollection()
         departures[bus_stop] = [bus]
@@ -333,6 +539,21 @@ class WhensMyTransportTestCase(unittest.TestCase):
         departures.filter(lambda train: train.get_destination() != "Tower Gateway", True)
         self.assertEqual(str(departures), "Bank 1200 1207 1210")
 
+        # DepartureCollection does not change lists it is given, and merges slots by their destinations at the time of merging
+        departures = DepartureCollection()
+        platform_trains = [Train("Bank", "1200")]
+        departures["P1"] = platform_trains
+        departures.add_to_slot("P1", Train("Lewisham", "1201"))
+        departures.add_to_slot("P2", Train("Lewisham", "1202"))
+        self.assertEqual(len(platform_trains), 1)
+        departures["P2"][0].destination = RailStation("Tower Gateway")
+        departures.merge_common_slots()
+        self.assertEqual(sorted(departures), ["P1", "P2"])
+        departures["P2"][0].destination = RailStation("Bank")
+        departures.merge_common_slots()
+        self.assertEqual(sorted(departures), ["P1 & P2"])
+        self.assertEqual(len(departures["P1 & P2"]), 3)
+
     # Fundamental non-unit functionality tests. These need a WMT bot set up and are thus contingent on a
     # config.cfg files to test things such as a particular instance's databases, geocoder and browser
     def test_init(self):
@@ -400,6 +621,14 @@ class WhensMyTransportTestCase(unittest.TestCase):
             row = self.bot.geodata.database.get_row("SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" % name)
             self.assertIsNotNone(row, '%s table does not exist' % name)
 
+        # Any names precomputed by datatools must be the same as the models would work out for themselves
+        column_names = [row['name'] for row in self.bot.geodata.database.get_rows("PRAGMA table_info(locations)")]
+        precomputed_column_names = [name for name in ('clean_name', 'normalised_name', 'abbreviated_name') if name in column_names]
+        for row in self.bot.geodata.database.get_rows("SELECT * FROM locations GROUP BY name LIMIT 500"):
+            location = self.bot.geodata.returned_object(row['name'])
+            for column_name in precomputed_column_names:
+                self.assertEqual(row[column_name], getattr(location, 'get_%s' % column_name)())
+
     @unittest.skipIf('--live-data' in sys.argv, "Data parser unit test will fail on live data")
     def test_dataparsers(self):
         """
@@ -408,11 +637,37 @@ class WhensMyTransportTestCase(unittest.TestCase):
         # Check against our test data and make sure we are correctly parsing & fetching the right objects from the data
         bus_data = parse_bus_data(self.bot.browser.fetch_json(self.bot.urls.BUS_URL % "53410"), '15')
         self.assertEqual(bus_data[0], Bus("Regent Street", gmt_to_localtime("1831")))
-        tube_data = parse_tube_data(self.bot.browser.fetch_xml_tree(self.bot.urls.TUBE_URL % ("D", "ECT")), RailStation("Earl's Court"), "D")
+        tube_xml = self.bot.browser.fetch_url(self.bot.urls.TUBE_URL % ("D", "ECT"), 'tfl_server_down')
+        tube_data = parse_tube_data(tube_xml, RailStation("Earl's Court"), "D")
         self.assertEqual(tube_data["Eastbound"][0], TubeTrain("Edgware Road", "Eastbound", "2139", "D", "075"))
+        # Only trains on the line asked for are kept, and out of service trains are filtered out
+        self.assertFalse(parse_tube_data(tube_xml, RailStation("Earl's Court"), "C"))
+        self.assertNotIn("Out Of Service", [train.get_destination() for slot in tube_data for train in tube_data[slot]])
+        self.assertFalse(filter_tube_train({'Destination': "Special", 'DestCode': '0'}))
+        self.assertRaises(WhensMyTransportException, parse_tube_data, "<html>Service Unavailable", RailStation("Earl's Court"), "D")
+        # Trains before the time the data was published, or a publication time we cannot read, are the server's fault too
+        when_created = "<WhenCreated>15 Mar 2012 21:39:40</WhenCreated>"
+        (late_timestamp, bad_timestamp) = (tube_xml.replace(when_created, ""), tube_xml.replace("15 Mar 2012", "Thursday"))
+        late_timestamp = late_timestamp.replace("</ROOT>", when_created + "</ROOT>")
+        for bad_tube_xml in (late_timestamp, bad_timestamp):
+            self.assertRaises(WhensMyTransportException, parse_tube_data, bad_tube_xml, RailStation("Earl's Court"), "D")
         dlr_data = parse_dlr_data(self.bot.browser.fetch_xml_tree(self.bot.urls.DLR_URL % "pop"), RailStation("Poplar"))
         self.assertEqual(dlr_data['P1'][0], Train("Beckton", "2107"))
 
+    def test_departure_rendering(self):
+        """
+        Test that departure boards made from our test data are rendered for Tweeting exactly as they always have been
+        """
+        expected_output = {}
+        for line in open(HOME_DIR + '/data/unit/departures.txt'):
+            (label, output) = line.rstrip('\n').split('\t')
+            expected_output[label] = output
+        for clock in (WMTClock(datetime(2013, 8, 29, 21, 0), True), WMTClock(datetime(2013, 12, 2, 0, 30), False)):
+            for (label, departures) in get_test_departure_collections(clock):
+                label = "%s %s" % (clock.now.strftime("%H%M"), label)
+                self.assertEqual(str(departures), expected_output.pop(label))
+        self.assertFalse(expected_output)
+
     def test_geocoder(self):
         """
         Unit tests for Geocoder objects
@@ -424,9 +679,7 @@ class WhensMyTransportTestCase(unittest.TestCase):
                           "Wembley Stadium": (51.5558, -0.2797),
                           "qwerty": None}
         for (name, value) in test_locations.items():
-            geocode_url = self.bot.geocoder.get_geocode_url(name)
-            geodata = self.bot.browser.fetch_json(geocode_url)
-            points = self.bot.geocoder.parse_geodata(geodata)
+            points = self.bot.geocoder.geocode(name, self.bot.browser)
             if value is None:
                 self.assertFalse(points)
             else:
@@ -451,6 +704,74 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.bot.twitter_client.settings.update_setting("_test_time", test_time)
         self.assertEqual(test_time, self.bot.twitter_client.settings.get_setting("_test_time"))
 
+    def test_geocode_cache(self):
+        """
+        Test to see if the geocode cache remembers, expires and throws away results properly
+        """
+        cache = WMTGeocodeCache('%s_test' % self.bot.instance_name, maximum_size=2)
+        try:
+            self.assertIsNone(cache.get_points("Brixton", "TestGeocoder"))
+            cache.set_points("Brixton", "TestGeocoder", [(51.4627, -0.1145)])
+            self.assertEqual(cache.get_points("brixton", "TestGeocoder"), [(51.4627, -0.1145)])
+            self.assertIsNone(cache.get_points("Brixton", "OtherGeocoder"))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertAlmostEqual(cache.get_hit_rate(), 1.0 / 3)
+            # Results that are too old are ignored
+            cache.database.write_query("update geocodes set time = time - ?", (cache.maximum_age + 1,))
+            self.assertIsNone(cache.get_points("Brixton", "TestGeocoder"))
+            # Empty results are not remembered, as they may just mean the geocoder was throttled or too slow
+            cache.set_points("Camberwell", "TestGeocoder", [])
+            self.assertIsNone(cache.get_points("Camberwell", "TestGeocoder"))
+            # Adding more results than the cache can hold throws away the oldest
+            cache.set_points("Camberwell", "TestGeocoder", [(51.4740, -0.0906)])
+            cache.set_points("Peckham", "TestGeocoder", [(51.4740, -0.0692)])
+            self.assertIsNone(cache.get_points("Brixton", "TestGeocoder"))
+            self.assertEqual(cache.get_points("Camberwell", "TestGeocoder"), [(51.4740, -0.0906)])
+            self.assertEqual(cache.database.get_value("select count(*) from geocodes"), 2)
+            self.assertEqual(cache.database.get_value("select count(*) from geocodes where placename = 'brixton'"), 0)
+        finally:
+            os.remove('%s/%s_test.geocache.db' % (DB_PATH, self.bot.instance_name))
+
+    def test_textparser_corpus(self):
+        """
+        Test our compiled text parser gives exactly the same results as parsing with nltk, for every message in our tests. The train
+        parser's tagger is checked against the pickled nltk tagger it was built from. nltk is not needed to run the bots, so this test is
+        skipped if it is not installed
+        """
+        try:
+            import nltk
+        except ImportError:
+            self.skipTest("nltk is not installed, so there is no reference parser to test against")
+        parser = self.bot.parser
+        reference_parser = copy.copy(parser)
+        reference_parser.parse_cache = LRUCache(0)
+        reference_parser.parser = nltk.RegexpParser(parser.grammar)
+        if hasattr(parser.tagger, 'tagging_regexes'):
+            reference_parser.tagger = nltk.RegexpTagger(parser.tagger.tagging_regexes)
+        else:
+            reference_parser.tagger = pickle.load(open(DB_PATH + '/whensmytrain.tagger.obj'))
+            for tokens in (['please', 'victoria', 'line'], ['from', 'thanks', 'waterloo'], [u'to', u'hammersmith', u'central'], []):
+                self.assertEqual(parser.tagger.tag(tokens), reference_parser.tagger.tag(tokens))
+        as_tuples = lambda tree: (tree.node, tuple([hasattr(child, 'node') and as_tuples(child) or tuple(child) for child in tree]))
+
+        corpus = get_test_message_corpus()
+        self.assertGreater(len(corpus), 1000)
+        for message in corpus:
+            tokens = message.lower().split()
+            self.assertEqual(parser.tagger.tag(tokens), reference_parser.tagger.tag(tokens))
+            tagged_tokens = parser.fix_unknown_tokens([(word, tag) for (word, tag) in parser.tagger.tag(tokens) if tag])
+            if tagged_tokens:
+                self.assertEqual(as_tuples(parser.parser.parse(tagged_tokens)), as_tuples(reference_parser.parser.parse(tagged_tokens)))
+            self.assertEqual(parser.parse_uncached_message(message), reference_parser.parse_message(message))
+
+        # Parsing the same message again, in any case, gives the same result from the cache
+        for message in [message for message in corpus if message][:100]:
+            parsed_message = parser.parse_message(message)
+            hits = parser.parse_cache.hits
+            self.assertEqual(parser.parse_message(message.upper()), parsed_message)
+            self.assertEqual(parser.parse_cache.hits, hits + 1)
+            self.assertEqual(parsed_message, reference_parser.parse_message(message))
+
     def test_twitter_tools(self):
         """
         Test to see if Twitter helper functions such as message splitting work properly
@@ -584,8 +905,8 @@ class WhensMyTransportTestCase(unittest.TestCase):
 # Definition of which unit tests and in which order to run them in
 #
 # Init tests (same for all)
-unit_tests = ('exceptions', 'geo', 'listutils', 'models', 'stringutils', 'tubeutils')
-local_tests = ('init', 'browser', 'database', 'dataparsers', 'location', 'logger', 'settings', 'textparser', 'twitter_tools')
+unit_tests = ('exceptions', 'cache', 'geo', 'listutils', 'models', 'stringutils', 'tubeutils')
+local_tests = ('init', 'browser', 'database', 'dataparsers', 'departure_rendering', 'location', 'logger', 'settings', 'geocode_cache', 'textparser', 'textparser_corpus', 'twitter_tools')
 remote_tests = ('geocoder', 'twitter_client',)
 
 # Common errors for all
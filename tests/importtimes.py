@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#pylint: disable=W0142
+"""
+Import-time report for When's My Transport
+
+Imports a module and prints how long each module it imports took to load, both cumulatively (including all the modules it
+imported in turn) and by itself. Needs to be run in a fresh Python process for the timings to mean anything, e.g.
+
+    python -m tests.importtimes whensmybus
+"""
+import __builtin__
+import sys
+import time
+
+
+def time_imports(module_name):
+    """
+    Import the module called module_name, and return a tuple of the total time taken in milliseconds, and a list of (module,
+    cumulative milliseconds, self milliseconds) tuples for every module that was loaded, slowest first
+    """
+    original_import = __builtin__.__import__
+    timings = {}
+    # Stack of time spent importing the children of each import currently in progress
+    children_times = []
+
+    def timed_import(name, *args, **kwargs):
+        """
+        Replacement for __import__ that records how long modules not yet loaded take to load
+        """
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+        start = time.time()
+        children_times.append(0)
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children_time = children_times.pop()
+            if children_times:
+                children_times[-1] += elapsed
+            timings.setdefault(name, (elapsed * 1000, (elapsed - children_time) * 1000))
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        __import__(module_name)
+    finally:
+        __builtin__.__import__ = original_import
+    total = (time.time() - start) * 1000
+    report = sorted([(name, cumulative, own) for (name, (cumulative, own)) in timings.items()], key=lambda row: -row[1])
+    return (total, report)
+
+
+def print_import_times(module_name, limit=20):
+    """
+    Print a report of the limit slowest modules imported by the module called module_name
+    """
+    (total, report) = time_imports(module_name)
+    print "Importing %s took %0.1f ms" % (module_name, total)
+    print "  %-40s %10s %10s" % ("Module", "Cumulative", "Self")
+    for (name, cumulative, own) in report[:limit]:
+        print "  %-40s %7.1f ms %7.1f ms" % (name, cumulative, own)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python -m tests.importtimes <module>"
+        sys.exit(1)
+    print_import_times(sys.argv[1])
@@ -7,11 +7,14 @@ A set of unit tests for When's My Train?
 IMPORTANT: These unit tests require Python 2.7, although When's My Train will happily run in Python 2.6
 """
 from tests.generic_tests import FakeTweet, WhensMyTransportTestCase
+from math import ceil
 import sys
 import time
 import unittest
 from whensmytrain import WhensMyTrain
 from lib.exceptions import WhensMyTransportException
+from lib.models import TubeTrain
+from lib.network import NO_NODE
 
 
 class WhensMyTubeTestCase(WhensMyTransportTestCase):
@@ -101,6 +104,14 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertEqual(self.bot.geodata.find_fuzzy_match("Kings Cross", {}).code, "KXX")
         self.assertEqual(self.bot.geodata.find_fuzzy_match("Kings Cross", {'line': 'M'}).code, "KXX")
 
+        # Test station names are remembered once they have been matched
+        self.bot.location_cache.clear()
+        self.assertEqual(self.bot.get_station_by_station_name("Kings Cross", 'M').code, "KXX")
+        hits = self.bot.location_cache.hits
+        self.assertIs(self.bot.get_station_by_station_name("Kings Cross", 'M'), self.bot.get_station_by_station_name("Kings Cross", 'M'))
+        self.assertEqual(self.bot.location_cache.hits, hits + 2)
+        self.assertIsNone(self.bot.get_station_by_station_name("Qwerty", 'M'))
+
         # Test route-tracing works as expected
         stockwell = self.bot.geodata.find_fuzzy_match("Stockwell", {})
         bank = self.bot.geodata.find_fuzzy_match("Bank", {})
@@ -112,6 +123,48 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertIn(('Oxford Circus', '', 'Victoria'), self.bot.geodata.describe_route(stockwell, euston))
         self.assertIn(('Charing Cross', '', 'Northern'), self.bot.geodata.describe_route(stockwell, euston, "N"))
         self.assertIn(('Bank', '', 'Northern'), self.bot.geodata.describe_route(stockwell, euston, "N", bank))
+        # Answering from the route tables should not have needed the network graph to be loaded
+        self.assertFalse('network' in self.bot.geodata.__dict__)
+
+        # Test precomputed fastest lines agree with working them out
+        fastest_lines = self.bot.geodata.fastest_lines
+        stations = [stockwell, bank, euston] + [self.bot.geodata.find_fuzzy_match(name, {}) for name in ("Baker Street", "Earl's Court", "Poplar", "Hainault")]
+        for (origin, destination) in [(origin, destination) for origin in stations for destination in stations]:
+            self.bot.geodata.fastest_lines = {}
+            lines_worked_out = self.bot.geodata.get_lines_serving(origin, destination)
+            self.bot.geodata.fastest_lines = fastest_lines
+            self.assertEqual(self.bot.geodata.get_lines_serving(origin, destination), lines_worked_out)
+
+        # Test precomputed route tables agree with searching the network graph
+        route_tables = self.bot.geodata.route_tables
+        self.bot.geodata.route_tables = {}
+        shortest_paths = self.bot.geodata.shortest_paths
+        (hits, misses) = (shortest_paths.hits, shortest_paths.misses)
+        for (origin, destination, line_code) in ((stockwell, euston, 'All'), (stockwell, euston, 'N'), (bank, stockwell, 'N'), (euston, bank, 'V')):
+            length_by_search = self.bot.geodata.length_of_route(origin, destination, line_code)
+            route_by_search = self.bot.geodata.describe_route(origin, destination, line_code)
+            self.assertEqual(route_tables[line_code].length_of_route(origin.name, destination.name), length_by_search)
+            self.assertEqual(route_tables[line_code].describe_route(origin.name, destination.name), route_by_search)
+        self.bot.geodata.route_tables = route_tables
+
+        # Without route tables, each origin is only searched from once per line, and the search reused from the shortest path cache
+        self.assertEqual(shortest_paths.misses - misses, 4)
+        self.assertEqual(shortest_paths.hits - hits, 4)
+
+        # Test our own shortest path search reproduces the route tables (which were made with pygraph's) exactly, for every station
+        for line_code in ('N', 'All'):
+            network = self.bot.geodata.network[line_code]
+            route_table = route_tables[line_code]
+            node_names = [':'.join(node) for node in route_table.nodes]
+            node_ids = dict([(node_name, i) for (i, node_name) in enumerate(node_names)])
+            for (origin_name, origin_id) in route_table.station_ids.items():
+                (previous, distances) = network.shortest_path(origin_name + ':entrance')
+                for destination_name in route_table.station_ids:
+                    self.assertEqual(int(ceil(distances.get(destination_name + ':exit', -1))),
+                                     route_table.length_of_route(origin_name, destination_name))
+                predecessors = [node_ids[previous[node_name]] if previous.get(node_name) is not None else NO_NODE for node_name in node_names]
+                offset = origin_id * len(node_names)
+                self.assertEqual(predecessors, list(route_table.predecessors[offset:offset + len(node_names)]))
 
         # Test route-testing works as expected
         west_ruislip = self.bot.geodata.find_fuzzy_match("West Ruislip", {})
@@ -130,6 +183,19 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertFalse(self.bot.geodata.direct_route_exists(snaresbrook, heathrow123, "All"))
         self.assertFalse(self.bot.geodata.direct_route_exists(snaresbrook, heathrow123, "C"))
 
+        # Test route tables tell us if routes are direct exactly as well as tracing the routes does
+        self.bot.geodata.route_tables = {}
+        for line_code in ('C', 'N'):
+            route_table = route_tables[line_code]
+            stations = [self.bot.geodata.find_exact_match({'name': station_name}) for station_name in sorted(route_table.station_ids)]
+            stations = [station for station in stations if station]
+            for (origin, destination) in [(origin, destination) for origin in stations for destination in stations if origin != destination]:
+                for (via, must_stop_at) in [(None, None)] + [(station, None) for station in stations[::12]] + \
+                                           [(None, station) for station in stations[::12]] + zip(stations[::12], stations[6::12]):
+                    self.assertEqual(route_table.direct_route_exists(origin.name, destination.name, via and via.name, must_stop_at and must_stop_at.name),
+                                     self.bot.geodata.direct_route_exists(origin, destination, line_code, via, must_stop_at))
+        self.bot.geodata.route_tables = route_tables
+
         # Test direction-finding works as expected
         morden = self.bot.geodata.find_fuzzy_match("Morden", {})
         high_barnet = self.bot.geodata.find_fuzzy_match("High Barnet", {})
@@ -140,6 +206,22 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertFalse(self.bot.geodata.is_correct_direction("Southbound", snaresbrook, wanstead, 'C'))
         self.assertFalse(self.bot.geodata.is_correct_direction("Southbound", morden, high_barnet, 'N'))
 
+        # Test checking trains in a batch gives the same results as checking them one by one
+        trains = []
+        for (destination, via, direction) in ((high_barnet, bank, "Northbound"), (high_barnet, None, "Northbound"), (morden, None, "Southbound"),
+                                              (high_barnet, bank, "Northbound"), (None, None, "Northbound"), (None, None, "Southbound")):
+            for departure_time in ("1200", "1205"):
+                train = TubeTrain("Unknown", direction, departure_time, "N", "001")
+                (train.destination, train.via) = (destination, via)
+                trains.append(train)
+        for desired_station in (euston, bank, morden):
+            trains_stopping = self.bot.geodata.get_trains_stopping_at(trains, stockwell, desired_station)
+            self.assertEqual([id(train) for train in trains_stopping],
+                             [id(train) for train in trains if self.bot.geodata.does_train_stop_at(train, stockwell, desired_station)])
+        trains_in_direction = self.bot.geodata.get_trains_in_direction(trains, stockwell, "Northbound", "N")
+        self.assertEqual([id(train) for train in trains_in_direction],
+                         [id(train) for train in trains if self.bot.geodata.is_correct_direction("Northbound", stockwell, train.destination, "N")])
+
         # DLR Location tests
         self.assertEqual(self.bot.geodata.find_closest((51.5124, -0.0397), {}).code, "lim")
         self.assertEqual(self.bot.geodata.find_closest((51.5124, -0.0397), {'line': 'DLR'}).code, "lim")
@@ -225,6 +307,17 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         network_name = self.bot.default_requested_route  # Either 'Tube' or 'DLR'
         self._test_correct_exception_produced(tweet, 'rail_station_name_not_found', 'Wxitythr Park', network_name)
 
+    def test_server_down(self):
+        """
+        Test to confirm departure data that is not XML is reported as the server being down, and is not kept in the browser's cache
+        """
+        url = self.bot.urls.TUBE_URL % ('N', 'BNK')
+        self.bot.browser.cache[url] = {'data': '<html><body>Service Unavailable</body>', 'time': time.time()}
+        message = 'Northern Line from Bank'
+        tweet = FakeTweet(self.at_reply + message)
+        self._test_correct_exception_produced(tweet, 'tfl_server_down')
+        self.assertNotIn(url, self.bot.browser.cache)
+
     @unittest.skipIf('--live-data' in sys.argv, "No trains unit test will fail on live data")
     def test_no_trains(self):
         """
@@ -375,6 +468,13 @@ class WhensMyDLRTestCase(WhensMyTubeTestCase):
         """
         return
 
+    def test_server_down(self):
+        """
+        DLR data is parsed by WMTBrowser.fetch_xml_tree, which already clears bad data from the cache, so override with a return
+        """
+        return
+
 tube_errors = ('bad_line_name',)
-station_errors = ('bad_routing', 'missing_station_data', 'station_line_mismatch', 'no_trains', 'no_line_specified', 'known_problems')
+station_errors = ('bad_routing', 'missing_station_data', 'station_line_mismatch', 'server_down', 'no_trains', 'no_line_specified',
+                  'known_problems')
 tube_successes = ('nonstandard_messages', 'standard_messages',)
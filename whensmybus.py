@@ -22,7 +22,7 @@ from pprint import pprint  # For debugging
 # From other modules in this package
 from whensmytransport import WhensMyTransport
 from lib.dataparsers import parse_bus_data
-from lib.geo import heading_to_direction
+from lib.geo import heading_to_direction, LocalGazetteerGeocoder
 from lib.exceptions import WhensMyTransportException
 from lib.locations import BusStopLocations
 from lib.models import NullDeparture, DepartureCollection
@@ -41,6 +41,7 @@ class WhensMyBus(WhensMyTransport):
         WhensMyTransport.__init__(self, 'whensmybus', testing)
         self.parser = WMTBusParser()
         self.geodata = BusStopLocations()
+        self.local_geocoder = LocalGazetteerGeocoder(self.geodata.database)
 
     def process_individual_request(self, route_number, origin, destination, direction, position=None):
         """
@@ -140,6 +141,12 @@ class WhensMyBus(WhensMyTransport):
         if match:
             return self.get_stops_by_stop_number(route_number, stop_name)
 
+        # We may have been asked for this stop before, in which case we already know the answer
+        key = (route_number, stop_name)
+        if key in self.location_cache:
+            logging.debug("Using stops previously found for %s on route %s", stop_name, route_number)
+            return dict(self.location_cache.get(key))
+
         # First off, try to get a match against bus stop names in database
         # Users may not give exact details, so we try to match fuzzily
         logging.debug("Attempting to get a match on placename %s", stop_name)
@@ -153,32 +160,31 @@ class WhensMyBus(WhensMyTransport):
                 logging.info("Found stop name %s for Run %s by fuzzy matching", best_match.name, best_match.run)
                 relevant_stops[run] = best_match
 
-        # If we can't find a location for either Run 1 or 2, use the geocoder to find a location on that Run matching our name
-        for run in (1, 2):
-            if run not in relevant_stops and self.geocoder:
-                logging.debug("No match found for run %s, attempting to get geocode placename %s", run, stop_name)
-                geocode_url = self.geocoder.get_geocode_url(stop_name)
-                try:
-                    geodata = self.browser.fetch_json(geocode_url, 'geocoder_server_down')
-                except WhensMyTransportException:
-                    logging.debug("Error connecting to geocoder, skipping")
-                    continue
-
-                points = self.geocoder.parse_geodata(geodata)
-                if not points:
-                    logging.debug("Could not find any matching location for %s", stop_name)
-                    continue
+        # If we can't find a location for either Run 1 or 2, use the geocoder to find locations matching our name, and then find the
+        # closest stop to any of them on each of those Runs
+        missing_runs = [run for run in (1, 2) if run not in relevant_stops]
+        if missing_runs and (self.geocoder or self.local_geocoder):
+            logging.debug("No match found for runs %s, attempting to get geocode placename %s", missing_runs, stop_name)
+            try:
+                points = self.geocode(stop_name)
+            except WhensMyTransportException:
+                logging.debug("Error connecting to geocoder, skipping")
+                # Don't remember what we have found, as the geocoder might find something next time
+                return relevant_stops
 
+            if points:
                 logging.debug("Have found %s matching points", len(points))
-                # For each of the places found, get the nearest stop that serves this run
-                possible_stops = [self.get_stops_by_geolocation(route_number, point).get(run, None) for point in points]
-                possible_stops = [stop for stop in possible_stops if stop]
-                if possible_stops:
-                    relevant_stops[run] = sorted(possible_stops)[0]
-                    logging.debug("Have found stop named: %s", relevant_stops[run].name)
-                else:
-                    logging.debug("Found a location, but could not find a nearby stop for %s", stop_name)
+                closest_stops = self.geodata.find_closest_in_each_group(points, {'route': route_number}, 'run')
+                for run in missing_runs:
+                    if run in closest_stops:
+                        relevant_stops[run] = closest_stops[run]
+                        logging.debug("Have found stop named: %s", relevant_stops[run].name)
+                    else:
+                        logging.debug("Found a location, but could not find a nearby stop for %s", stop_name)
+            else:
+                logging.debug("Could not find any matching location for %s", stop_name)
 
+        self.location_cache[key] = dict(relevant_stops)
         return relevant_stops
 
     def get_departure_data(self, relevant_stops, route_number, must_stop_at=None, direction=None):
@@ -193,7 +199,7 @@ class WhensMyBus(WhensMyTransport):
         for (run, stop) in relevant_stops.items():
             tfl_url = self.urls.BUS_URL % stop.number
             bus_data = self.browser.fetch_json(tfl_url)
-            departures[stop] = parse_bus_data(bus_data, route_number)
+            departures[stop] = parse_bus_data(bus_data, route_number, self.clock)
             if departures[stop]:
                 logging.debug("Stop %s produced buses: %s", stop.get_clean_name(), ', '.join([str(bus) for bus in departures[stop]]))
             else:
@@ -206,7 +212,7 @@ class WhensMyBus(WhensMyTransport):
                 if run in relevant_stops.keys() and not departures[relevant_stops[run]]:
                     del departures[relevant_stops[run]]
 
-        null_constructor = lambda stop: NullDeparture(stop_directions[stop.run])
+        null_constructor = lambda stop: NullDeparture(stop_directions[stop.run], self.clock)
         departures.cleanup(null_constructor)
         return departures
 
@@ -161,10 +161,16 @@ class WhensMyTrain(WhensMyTransport):
         Take a string specifying station name and optional line_code, and return best match as a RailStation
         If no match can be found, returns None
         """
+        # We may have been asked for this station before, in which case we already know the answer
+        key = (station_name, line_code)
+        if key in self.location_cache:
+            return self.location_cache.get(key)
         params = {}
         if line_code:
             params['line'] = line_code
-        return self.geodata.find_fuzzy_match(station_name, params)
+        station = self.geodata.find_fuzzy_match(station_name, params)
+        self.location_cache[key] = station
+        return station
 
     def get_canonical_station_name(self, station_name, line_code):
         """
@@ -190,12 +196,18 @@ class WhensMyTrain(WhensMyTransport):
         # DLR and Tube have different APIs and different structures (Tube data contains compass directions, DLR does not)
         if line_code == 'DLR':
             dlr_data = self.browser.fetch_xml_tree(self.urls.DLR_URL % origin.code)
-            departures = parse_dlr_data(dlr_data, origin)
-            null_constructor = lambda platform: NullDeparture("from " + platform)
+            departures = parse_dlr_data(dlr_data, origin, self.clock)
+            null_constructor = lambda platform: NullDeparture("from " + platform, self.clock)
         else:
-            tube_data = self.browser.fetch_xml_tree(self.urls.TUBE_URL % (line_code, origin.code))
-            departures = parse_tube_data(tube_data, origin, line_code)
-            null_constructor = lambda direction: NullDeparture(direction)
+            tube_url = self.urls.TUBE_URL % (line_code, origin.code)
+            tube_data = self.browser.fetch_url(tube_url, 'tfl_server_down')
+            try:
+                departures = parse_tube_data(tube_data, origin, line_code, self.clock)
+            # If it is not XML, it is probably an error page, so make sure we fetch it afresh next time rather than use the cached copy
+            except WhensMyTransportException:
+                del self.browser.cache[tube_url]
+                raise
+            null_constructor = lambda direction: NullDeparture(direction, self.clock)
 
         # Turn parsed destination & via station names into canonical versions for this train so we can do lookups & checks
         for slot in departures:
@@ -223,14 +235,16 @@ class WhensMyTrain(WhensMyTransport):
         departures.filter(does_not_terminate_here, delete_existing_empty_slots=False)
         # If we've specified a station to stop at, filter out any that do not stop at that station or are not in its direction
         # Note that unlike the above, this will turn all existing empty lists into Nones (and thus deletable) as well
+        # Trains are checked in one batch, so trains going to the same place only need checking once; we then keep those that pass
+        all_trains = [train for slot in departures for train in departures[slot]]
         if must_stop_at:
-            filter_by_stop_at = lambda train: self.geodata.does_train_stop_at(train, origin, must_stop_at)
-            departures.filter(filter_by_stop_at, delete_existing_empty_slots=True)
+            trains_stopping = set([id(train) for train in self.geodata.get_trains_stopping_at(all_trains, origin, must_stop_at)])
+            departures.filter(lambda train: id(train) in trains_stopping, delete_existing_empty_slots=True)
         # Else filter by direction - Tubs is already classified by direction, DLR is not direction-aware so must calculate manually
         elif direction:
             if line_code == 'DLR':
-                filter_by_direction = lambda train: self.geodata.is_correct_direction(direction, origin, train.destination, line_code)
-                departures.filter(filter_by_direction, delete_existing_empty_slots=True)
+                trains_in_direction = set([id(train) for train in self.geodata.get_trains_in_direction(all_trains, origin, direction, line_code)])
+                departures.filter(lambda train: id(train) in trains_in_direction, delete_existing_empty_slots=True)
             else:
                 for slot in list(departures):
                     if slot != direction:
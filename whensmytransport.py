@@ -28,14 +28,19 @@ from pprint import pprint # For debugging
 
 # From library modules in this package
 from lib.browser import WMTBrowser, WMTURLProvider
+from lib.cache import LRUCache, lazy_property
+from lib.clock import WMTClock
 from lib.exceptions import WhensMyTransportException
-from lib.geo import convertWGS84toOSEastingNorthing, gridrefNumToLet, GoogleGeocoder
+from lib.geo import convertWGS84toOSEastingNorthingFast, gridrefNumToLet, BingGeocoder, GoogleGeocoder, RacingGeocoder, YahooGeocoder
+from lib.geocache import WMTGeocodeCache
 from lib.logger import setup_logging
 from lib.twitterclient import WMTTwitterClient, is_direct_message
 
 # Some constants we use
 VERSION_NUMBER = 0.90
 HOME_DIR = os.path.dirname(os.path.abspath(__file__))
+# Number of requested station or stop names to remember what they matched
+LOCATION_CACHE_SIZE = 512
 
 TESTING_NONE = 0
 TESTING_TEST_LOCAL_DATA = 1
@@ -61,6 +66,7 @@ class WhensMyTransport:
             open(HOME_DIR + '/' + config_file)
             config = ConfigParser.SafeConfigParser({'debug_level': 'INFO',
                                                     'yahoo_app_id': None,
+                                                    'bing_api_key': None,
                                                     'silent_mode' : 0 })
             config.read(HOME_DIR + '/' + config_file)
             config.get(self.instance_name, 'debug_level')
@@ -89,9 +95,20 @@ class WhensMyTransport:
         # These get overridden by subclasses
         self.geodata = None
         self.parser = None
-
-        # Setup geocoder for looking up place names
-        self.geocoder = GoogleGeocoder()
+        # Stations or stops found for names users have asked for, so that repeated requests skip fuzzy matching & geocoding
+        self.location_cache = LRUCache(LOCATION_CACHE_SIZE)
+        # Time at which the request being processed was made, so all its departures are judged against the same time
+        self.clock = WMTClock()
+
+        # Setup geocoder for looking up place names. If we have keys for Bing or Yahoo! as well as Google, we race them against each
+        # other. Child classes with a gazetteer of their own can set up a local geocoder too, which is tried first
+        geocoders = [GoogleGeocoder()]
+        if config.get(self.instance_name, 'bing_api_key'):
+            geocoders.append(BingGeocoder(config.get(self.instance_name, 'bing_api_key')))
+        if config.get(self.instance_name, 'yahoo_app_id'):
+            geocoders.append(YahooGeocoder(config.get(self.instance_name, 'yahoo_app_id')))
+        self.geocoder = RacingGeocoder(geocoders) if len(geocoders) > 1 else geocoders[0]
+        self.local_geocoder = None
 
         # Setup Twitter client
 
@@ -187,6 +204,9 @@ class WhensMyTransport:
         Each reply might be more than 140 characters
         No replies at all are given if the message is a thank-you or does not include a route or line
         """
+        # Take the time once for this request
+        self.clock = WMTClock()
+
         # Don't do anything if this is a thank-you
         if self.check_politeness(tweet):
             logging.debug("This Tweet is a thank-you Tweet, skipping")
@@ -268,7 +288,7 @@ class WhensMyTransport:
         if self.tweet_has_geolocation(tweet):
             logging.debug("Detecting geolocation on Tweet")
             position = tweet.geo['coordinates']
-            easting, northing = convertWGS84toOSEastingNorthing(*position)
+            easting, northing = convertWGS84toOSEastingNorthingFast(*position)
             # Grid reference provides us an easy way with checking to see if in the UK - it returns blank string if not in UK bounds
             if not gridrefNumToLet(easting, northing):
                 raise WhensMyTransportException('not_in_uk')
@@ -288,6 +308,36 @@ class WhensMyTransport:
             else:
                 raise WhensMyTransportException('dms_not_taggable', user_request)
 
+    @lazy_property
+    def geocode_cache(self):
+        """
+        Cache of geocoder results - only opened when we first geocode something, as most runs of the bot never need to
+        """
+        return WMTGeocodeCache(self.instance_name)
+
+    def geocode(self, placename):
+        """
+        Look up placename with the geocoder, and return a list of matching places, each a (latitude, longitude) tuple. We try the
+        local geocoder first, if there is one; places the geocoder finds are remembered in the geocode cache, so it is only asked
+        about each place once
+
+        Raises a WhensMyTransportException if the geocoder cannot be reached
+        """
+        if self.local_geocoder:
+            points = self.local_geocoder.geocode(placename, self.browser)
+            if points:
+                logging.debug("Found %s in local gazetteer", placename)
+                return points
+        if not self.geocoder:
+            return []
+        provider = self.geocoder.__class__.__name__
+        points = self.geocode_cache.get_points(placename, provider)
+        if points is None:
+            points = self.geocoder.geocode(placename, self.browser)
+            self.geocode_cache.set_points(placename, provider, points)
+        logging.debug("Geocode cache hit rate is now %0.2f", self.geocode_cache.get_hit_rate())
+        return points
+
     @abstractmethod
     def process_individual_request(self, code, origin, destination, direction, position):
         """